@@ -0,0 +1,88 @@
+# per-message cost of the ontext handler wrappers, before and after compiling their patterns
+# usage: python -m bench.handlers [messages]
+import re
+import sys
+import time
+import dispatch
+import handlers
+import identifiers
+import remotes
+import strings
+import userdata
+
+HANDLERS = 30
+
+
+def legacyontext(textmatch, targetmatch):
+    # the ontext decorator as it was: string patterns and regex based CTCP detection
+    def wrap(handler):
+        def wrapped(self, prefix, command, args):
+            if re.match("^\\001.*\\001$", args[1]):
+                return
+
+            if not (re.match(targetmatch, args[0]) and re.match(textmatch, args[1])):
+                return
+
+            nick = self.id.nick(strings.getnick(prefix), prefix)
+            target = self.id.channel(args[0]) if strings.ischannel(args[0]) else self.id.nick(args[0])
+            return handler(self, nick, target, args[1])
+
+        wrapped.ishandler = True
+        wrapped.command = "PRIVMSG"
+        return wrapped
+
+    return wrap
+
+
+def makeremote(decorator):
+    # a remote with a number of commands, none of which are triggered by the benchmark messages
+    namespace = {}
+    for i in range(HANDLERS):
+        def texthandler(self, nick, target, msg):
+            pass
+        namespace["handler{}".format(i)] = decorator("^!command{} ".format(i), "#")(texthandler)
+
+    remoteclass = type("BenchRemote", (remotes.Remote,), namespace)
+    return remoteclass(None, identifiers.IdentifierSet(userdata.UserData()), {}, {})
+
+
+def callall(remote, lines):
+    wrappers = [getattr(remote, "handler{}".format(i)) for i in range(HANDLERS)]
+    for prefix, command, args in lines:
+        for h in wrappers:
+            h(prefix, command, args)
+
+
+def callindexed(remote, lines):
+    index = dispatch.HandlerIndex()
+    for i in range(HANDLERS):
+        index.add(getattr(remote, "handler{}".format(i)))
+
+    for prefix, command, args in lines:
+        rawhandlers, commandhandlers = index.lookup(command, args)
+        for h in commandhandlers:
+            h(prefix, command, args)
+
+
+def measure(name, function, remote, lines):
+    start = time.perf_counter()
+    function(remote, lines)
+    elapsed = time.perf_counter() - start
+    print("{:<34} {:>10.0f} ns/message".format(name, elapsed / len(lines) * 1e9))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    lines = [("user{}!~u@host".format(i % 50), "PRIVMSG", ["#channel", "just chatting, message {}".format(i)])
+             for i in range(count)]
+    # fill the re module cache the way a bot with many patterns would
+    for i in range(600):
+        re.match("^pattern{}".format(i), "")
+
+    measure("legacy wrappers", callall, makeremote(legacyontext), lines)
+    measure("compiled wrappers", callall, makeremote(handlers.ontext), lines)
+    measure("compiled wrappers, indexed", callindexed, makeremote(handlers.ontext), lines)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# compares the line framer/parser against the original split-based parsing of Bot.receive_data
+# usage: python -m bench.parser [lines]
+import math
+import random
+import sys
+import time
+import message
+from strings import decode
+
+CHUNKSIZE = 8192
+ROUNDS = 20
+
+
+def netsplitburst(count, seed=1):
+    # synthetic stand-in for a captured netsplit: quits, rejoins, ops and names
+    rng = random.Random(seed)
+    nicks = ["user{}".format(i) for i in range(count // 4)]
+    lines = []
+    while len(lines) < count:
+        nick = rng.choice(nicks)
+        prefix = "{}!~{}@host-{}.example.net".format(nick, nick, rng.randrange(1000))
+        kind = rng.random()
+        if kind < 0.35:
+            lines.append(":{} QUIT :*.net *.split".format(prefix))
+        elif kind < 0.7:
+            lines.append(":{} JOIN #channel{}".format(prefix, rng.randrange(20)))
+        elif kind < 0.8:
+            lines.append(":hub.example.net MODE #channel{} +oo {} {}".format(rng.randrange(20), nick,
+                                                                             rng.choice(nicks)))
+        elif kind < 0.9:
+            names = " ".join(rng.choice(("@", "+", "")) + rng.choice(nicks) for _ in range(30))
+            lines.append(":irc.example.net 353 me = #channel{} :{}".format(rng.randrange(20), names))
+        else:
+            lines.append(":{} PRIVMSG #channel{} :back again".format(prefix, rng.randrange(20)))
+
+    data = "".join(line + "\r\n" for line in lines).encode("utf-8")
+    return [data[i:i + CHUNKSIZE] for i in range(0, len(data), CHUNKSIZE)]
+
+
+def legacy(chunks):
+    # the parsing done by Bot.receive_data before the framer was introduced
+    read_buffer = b""
+    parsed = 0
+    for data in chunks:
+        read_buffer += data
+        encoded_lines = read_buffer.split(b"\r\n")
+        read_buffer = encoded_lines.pop(-1)
+
+        for encoded_line in encoded_lines:
+            line = decode(encoded_line)
+
+            prefix = ''
+            if line[0] == ':':
+                prefix, line = line[1:].split(' ', 1)
+
+            if line.find(' :') != -1:
+                line, trailing = line.split(' :', 1)
+                args = line.split()
+                args.append(trailing)
+            else:
+                args = line.split()
+
+            command = args.pop(0)
+            parsed += 1
+
+    return parsed
+
+
+def framed(chunks):
+    # reading everything, as Bot.receive_data does
+    framer = message.LineFramer()
+    parsed = 0
+    for data in chunks:
+        framer.feed(data)
+        for msg in framer:
+            prefix = msg.prefix
+            command = msg.command
+            args = msg.args
+            parsed += 1
+
+    return parsed
+
+
+def measure(parsers, chunks):
+    # the best of a number of rounds, taking turns so a slow moment does not favour either parser
+    best = {name: math.inf for name, function in parsers}
+    parsed = {}
+    for _ in range(ROUNDS):
+        for name, function in parsers:
+            start = time.perf_counter()
+            parsed[name] = function(chunks)
+            best[name] = min(best[name], time.perf_counter() - start)
+
+    for name, function in parsers:
+        print("{:<28} {:>8} lines {:>8.3f} s {:>10.0f} lines/s".format(name, parsed[name], best[name],
+                                                                       parsed[name] / best[name]))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    chunks = netsplitburst(count)
+
+    measure([("legacy split parser", legacy), ("framer", framed)], chunks)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# replays a capture (see capture.py) or one of the scenarios in bench/scenarios.py into a real Bot over
+# loopback, and reports lines/s, dispatch latency percentiles, peak memory and the outbound byte rate
+# usage: python -m bench.replay [scenario or capture file ...] [--speed N | --speed max] [--unthrottled]
+#        without arguments all scenarios are replayed at maximum speed
+import argparse
+import asyncio
+import logging
+import resource
+import time
+import bot
+import capture
+from bench import scenarios
+from config.bot import settings as defaultsettings
+
+# ends a replay: the bot processes lines in order, so its PONG means everything before was dispatched
+DONE = "PING :replay-done"
+
+
+class FakeIrcd(object):
+    # loopback stand-in for a server: waits for the bot to register, then replays the entries
+
+    def __init__(self, entries, speed):
+        self.entries = entries
+        self.speed = speed  # None for maximum speed
+        self.outbound = 0
+        self.started = None
+        self.finished = None
+        self.done = asyncio.Event()
+
+    async def handle(self, reader, writer):
+        registered = set()
+        while not {"NICK", "USER"} <= registered:
+            line = await reader.readline()
+            if not line:
+                return
+            self.outbound += len(line)
+            registered.add(line.split(b" ", 1)[0].decode())
+
+        replying = asyncio.ensure_future(self.readreplies(reader))
+        await self.replay(writer)
+
+        await self.done.wait()
+        replying.cancel()
+        writer.close()
+
+    async def replay(self, writer):
+        loop = asyncio.get_running_loop()
+        self.started = loop.time()
+        first = self.entries[0][0] if self.entries else 0.0
+
+        pending = []
+        for timestamp, line in self.entries:
+            if self.speed:
+                due = self.started + (timestamp - first) / self.speed
+                if due > loop.time():
+                    writer.write("".join(pending).encode("utf-8", "surrogateescape"))
+                    pending = []
+                    await writer.drain()
+                    await asyncio.sleep(due - loop.time())
+
+            pending.append(line + "\r\n")
+            if len(pending) >= 256:
+                writer.write("".join(pending).encode("utf-8", "surrogateescape"))
+                pending = []
+                await writer.drain()
+
+        pending.append(DONE + "\r\n")
+        writer.write("".join(pending).encode("utf-8", "surrogateescape"))
+        await writer.drain()
+
+    async def readreplies(self, reader):
+        loop = asyncio.get_running_loop()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            self.outbound += len(line)
+            if line.startswith(b"PONG") and b"replay-done" in line:
+                self.finished = loop.time()
+                self.done.set()
+
+
+def timeprocess(remoteset, latencies):
+    # records how long every line takes to dispatch
+    process = remoteset.process
+
+    def timed(prefix, command, args):
+        start = time.perf_counter()
+        process(prefix, command, args)
+        latencies.append(time.perf_counter() - start)
+
+    remoteset.process = timed
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+async def replay(name, entries, speed, unthrottled):
+    loop = asyncio.get_running_loop()
+    ircd = FakeIrcd(entries, speed)
+    server = await asyncio.start_server(ircd.handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    # the flood filter would drop most of a busy scenario, which is not what is being measured
+    settings = dict(defaultsettings, server="127.0.0.1", port=port, capture=None, wirelog={"enabled": False},
+                    floodfilter={"enabled": False})
+    if unthrottled:
+        settings["throttle"] = dict(settings.get("throttle", {}), penalty=0, bytepenalty=0)
+
+    b = bot.Bot(loop, settings)
+    b.loadmodules()
+    latencies = []
+    timeprocess(b.remoteset, latencies)
+
+    running = asyncio.ensure_future(b.mainloop())
+    await ircd.done.wait()
+    running.cancel()
+    b.tasks.executors.shutdown()
+    server.close()
+
+    elapsed = ircd.finished - ircd.started
+    latencies.sort()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print("{:<12} {:>7} lines {:>8.3f} s {:>9.0f} lines/s   dispatch p50 {:>6.1f} us p99 {:>7.1f} us "
+          "max {:>8.1f} us   peak rss {:>6.1f} MiB   out {:>8.1f} B/s".format(
+              name, len(entries), elapsed, len(entries) / elapsed, percentile(latencies, 50) * 1e6,
+              percentile(latencies, 99) * 1e6, latencies[-1] * 1e6 if latencies else 0, peak,
+              ircd.outbound / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured or generated traffic into a Bot.")
+    parser.add_argument("sources", nargs="*", default=list(scenarios.SCENARIOS),
+                        help="scenario names or capture files")
+    parser.add_argument("--speed", default="max", help="replay speed factor, or max")
+    parser.add_argument("--unthrottled", action="store_true", help="turn off output flood control")
+    options = parser.parse_args()
+
+    # only warnings, logging every line would be measured as well
+    logging.basicConfig(level=logging.WARNING)
+    speed = None if options.speed == "max" else float(options.speed)
+
+    for source in options.sources:
+        if source in scenarios.SCENARIOS:
+            entries = scenarios.SCENARIOS[source]()
+        else:
+            entries = list(capture.readcapture(source))
+
+        asyncio.run(replay(source, entries, speed, options.unthrottled))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# standard traffic scenarios for bench/replay.py, generated deterministically as (timestamp, line) pairs
+# usage: python -m bench.scenarios <directory>   (writes a capture file per scenario)
+import os
+import random
+import sys
+import capture
+
+SERVER = "irc.bench.test"
+NICK = "vorobot"
+ME = "{}!vorobot@bot.bench.test".format(NICK)
+
+# lines per second for the timestamps, replaying at 1x follows these
+RATE = 2000
+
+ISUPPORT = ("PREFIX=(ov)@+ CHANMODES=b,k,l,imnpst CHANTYPES=# CASEMAPPING=rfc1459 MODES=6 NICKLEN=15 "
+            "TARGMAX=PRIVMSG:4,NOTICE:4,JOIN: WHOX")
+
+
+class Timeline(object):
+    # collects lines, spaced at a steady rate unless added as a burst
+
+    def __init__(self, rate=RATE):
+        self.entries = []
+        self.time = 0.0
+        self.step = 1 / rate
+
+    def add(self, line):
+        self.time += self.step
+        self.entries.append((self.time, line))
+
+    def burst(self, lines):
+        # lines arriving at the same moment, as after a netsplit
+        self.time += self.step
+        self.entries.extend((self.time, line) for line in lines)
+
+    def pause(self, seconds):
+        self.time += seconds
+
+
+# --- helpers ---
+
+def user(i):
+    return "user{}!u{}@host{}.bench.test".format(i, i, i % 997)
+
+
+def nick(i):
+    return "user{}".format(i)
+
+
+def register(timeline):
+    timeline.add(":{} 001 {} :Welcome to the bench network {}".format(SERVER, NICK, ME))
+    timeline.add(":{} 005 {} {} :are supported by this server".format(SERVER, NICK, ISUPPORT))
+    timeline.add(":{} 396 {} bot.bench.test :is now your hidden host".format(SERVER, NICK))
+
+
+def names(timeline, channel, nicks):
+    # RPL_NAMREPLY lines packed the way servers do, followed by RPL_ENDOFNAMES
+    start = ":{} 353 {} = {} :".format(SERVER, NICK, channel)
+    line = start
+    for n in nicks:
+        if len(line) + len(n) + 1 > 500:
+            timeline.add(line.rstrip())
+            line = start
+        line += n + " "
+    timeline.add(line.rstrip())
+    timeline.add(":{} 366 {} {} :End of /NAMES list.".format(SERVER, NICK, channel))
+
+
+def joinchannel(timeline, channel, nicks):
+    timeline.add(":{} JOIN {}".format(ME, channel))
+    names(timeline, channel, ["@" + NICK] + nicks)
+
+
+# --- scenarios ---
+
+def joinflood(users=5000, seed=1):
+    # a channel being flooded with joins of new users
+    timeline = Timeline()
+    register(timeline)
+    joinchannel(timeline, "#flood", [])
+    for i in range(users):
+        timeline.add(":{} JOIN #flood".format(user(i)))
+
+    return timeline.entries
+
+
+def netsplit(users=4000, seed=1):
+    # half of a channel splitting off and rejoining, with the server restoring their modes
+    rng = random.Random(seed)
+    timeline = Timeline()
+    register(timeline)
+    joinchannel(timeline, "#split", [rng.choice(["", "", "+", "@"]) + nick(i) for i in range(users)])
+
+    split = range(0, users, 2)
+    timeline.pause(1)
+    timeline.burst(":{} QUIT :{} leaf.bench.test".format(user(i), SERVER) for i in split)
+    timeline.pause(5)
+    timeline.burst(":{} JOIN #split".format(user(i)) for i in split)
+
+    restored = [nick(i) for i in split if rng.random() < 0.3]
+    timeline.burst(":leaf.bench.test MODE #split +{} {}".format("o" * len(restored[j:j + 6]),
+                                                                 " ".join(restored[j:j + 6]))
+                   for j in range(0, len(restored), 6))
+
+    return timeline.entries
+
+
+def names5k(users=5000, channels=4, seed=1):
+    # joining several big channels, with an overlapping set of users
+    rng = random.Random(seed)
+    timeline = Timeline()
+    register(timeline)
+    for c in range(channels):
+        members = rng.sample(range(users * 2), users)
+        joinchannel(timeline, "#big{}".format(c), [rng.choice(["", "", "", "+", "@"]) + nick(i) for i in members])
+
+    return timeline.entries
+
+
+def modestorm(users=500, modes=5000, seed=1):
+    # opping, voicing and banning at a high rate
+    rng = random.Random(seed)
+    timeline = Timeline()
+    register(timeline)
+    joinchannel(timeline, "#storm", [nick(i) for i in range(users)])
+
+    for _ in range(modes):
+        changes = []
+        args = []
+        for _ in range(rng.randint(1, 6)):
+            adding = rng.choice("+-")
+            mode = rng.choice("oovvb")
+            changes.append(adding + mode)
+            args.append("*!*@host{}.bench.test".format(rng.randrange(997)) if mode == "b"
+                        else nick(rng.randrange(users)))
+
+        source = user(rng.randrange(users))
+        timeline.add(":{} MODE #storm {} {}".format(source, "".join(changes), " ".join(args)))
+
+    return timeline.entries
+
+
+def firehose(users=500, channels=10, messages=50000, seed=1):
+    # a steady stream of channel messages, some of which trigger a reply
+    rng = random.Random(seed)
+    timeline = Timeline()
+    register(timeline)
+    for c in range(channels):
+        joinchannel(timeline, "#chat{}".format(c), [nick(i) for i in range(users)])
+
+    for m in range(messages):
+        source = user(rng.randrange(users))
+        channel = "#chat{}".format(rng.randrange(channels))
+        r = rng.random()
+        if r < 0.01:
+            text = ":test"
+        elif r < 0.05:
+            text = "\001ACTION waves at message {}\001".format(m)
+        else:
+            text = "message {} with some text to push the line towards a typical length".format(m)
+        timeline.add(":{} PRIVMSG {} :{}".format(source, channel, text))
+
+    return timeline.entries
+
+
+SCENARIOS = {
+    "joinflood": joinflood,
+    "netsplit": netsplit,
+    "names5k": names5k,
+    "modestorm": modestorm,
+    "firehose": firehose,
+}
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else "."
+    for name, scenario in SCENARIOS.items():
+        path = os.path.join(directory, name + ".cap")
+        entries = scenario()
+        capture.writecapture(path, entries)
+        print("{:<12} {:>7} lines  {}".format(name, len(entries), path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# pushes queued lines through the send loop into a loopback stand-in server
+# reports lines/s and enqueue-to-wire latency for the original queue based send loop, the scheduler
+# based send loop writing line by line and the batched send loop
+# usage: python -m bench.sendloop [lines]
+import asyncio
+import sys
+import bot
+from strings import encode
+
+BURSTSIZE = 100
+ROUNDS = 5
+
+
+class Sink(object):
+    # stand-in server recording when each numbered line arrives
+
+    def __init__(self, count):
+        self.count = count
+        self.arrivals = {}
+        self.done = asyncio.Event()
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        while len(self.arrivals) < self.count:
+            line = await reader.readline()
+            if not line:
+                break
+
+            words = line.split()
+            if words[0] == b"PRIVMSG":
+                self.arrivals[int(words[-1])] = loop.time()
+
+        self.done.set()
+
+
+async def legacysendloop(writer, queue):
+    # the send loop as it was: concatenating queued data and draining after every flush
+    data = b""
+    while True:
+        data += await queue.get()
+
+        if queue.empty():
+            writer.write(data)
+            await writer.drain()
+            data = b""
+
+
+async def unbatchedsendloop(writer, scheduler):
+    # the scheduler based send loop before batching: one write and drain per line
+    while True:
+        writer.write(await scheduler.get())
+        await writer.drain()
+
+
+async def run(name, count, mode):
+    loop = asyncio.get_running_loop()
+    sink = Sink(count)
+    server = await asyncio.start_server(sink.handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+    if mode != "queue":
+        # unthrottled, so only the send path itself is measured
+        settings = {"throttle": {"penalty": 0, "bytepenalty": 0}, "wirelog": {"enabled": False}}
+        b = bot.Bot(loop, settings)
+        b.writer = writer
+        b.scheduler.reset()
+        if mode == "batched":
+            sender = asyncio.ensure_future(b.sendloop())
+        else:
+            sender = asyncio.ensure_future(unbatchedsendloop(writer, b.scheduler))
+        enqueue = b.send
+    else:
+        queue = asyncio.Queue()
+        sender = asyncio.ensure_future(legacysendloop(writer, queue))
+
+        def enqueue(line):
+            queue.put_nowait(encode("{}\r\n".format(line)))
+
+    enqueued = {}
+    start = loop.time()
+    for i in range(count):
+        enqueued[i] = loop.time()
+        enqueue("PRIVMSG #channel :benchmark line {}".format(i))
+        if i % BURSTSIZE == BURSTSIZE - 1:
+            await asyncio.sleep(0)
+
+    await sink.done.wait()
+    elapsed = loop.time() - start
+
+    sender.cancel()
+    writer.close()
+    server.close()
+    await server.wait_closed()
+
+    latencies = sorted(sink.arrivals[i] - enqueued[i] for i in sink.arrivals)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    return count / elapsed, p99
+
+
+def main():
+    # the run with the best throughput out of a number of rounds, taking turns so a slow moment does not
+    # favour any of the send loops
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    modes = [("original queue sendloop", "queue"), ("scheduler, write and drain per line", "unbatched"),
+             ("scheduler, batched writelines", "batched")]
+    best = {}
+    for _ in range(ROUNDS):
+        for name, mode in modes:
+            result = asyncio.run(run(name, count, mode))
+            if name not in best or result[0] > best[name][0]:
+                best[name] = result
+
+    for name, mode in modes:
+        rate, p99 = best[name]
+        print("{:<36} {:>10.0f} lines/s   p99 enqueue-to-wire {:>8.2f} ms".format(name, rate, p99 * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# schedules many timers under the original one-coroutine-per-timer TaskSet and the bucketed scheduler
+# reports the cost of adding and running them, peak memory and how late repeating timers end up
+# usage: python -m bench.timers [timers]
+import asyncio
+import random
+import sys
+import time
+import tracemalloc
+import tasks
+
+# spread of the timer delays in seconds
+SPREAD = 1.0
+# repeating timers used for measuring drift
+REPEATERS = 100
+REPEATS = 20
+REPEATDELAY = 0.05
+
+
+class LegacyTaskSet(object):
+    # TaskSet.addtimer as it was: a coroutine sleeping in a loop for every timer
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.timers = {}
+
+    def addtimer(self, name, delay, reps, command):
+        async def timerprocess():
+            i = reps if reps != 0 else -1
+            while i != 0:
+                await asyncio.sleep(delay)
+                try:
+                    command()
+                except Exception:
+                    pass
+
+                if i > 0:
+                    i -= 1
+
+            if name in self.timers:
+                del self.timers[name]
+
+        self.timers[name] = asyncio.ensure_future(timerprocess(), loop=self.loop)
+
+
+async def run(name, taskclass, count):
+    loop = asyncio.get_running_loop()
+    taskset = taskclass(loop)
+    rng = random.Random(1)
+    fired = [0]
+    lateness = []
+
+    def fire():
+        fired[0] += 1
+
+    def repeater(start, index):
+        # how late the n-th repetition is compared to start + n * delay
+        counter = [0]
+
+        def command():
+            counter[0] += 1
+            lateness.append(loop.time() - (start + counter[0] * REPEATDELAY))
+            # some work, which a drifting timer adds to every interval
+            time.sleep(0.0001)
+        return command
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(count):
+        taskset.addtimer("timer{}".format(i), rng.random() * SPREAD, 1, fire)
+    added = time.perf_counter() - start
+
+    now = loop.time()
+    for i in range(REPEATERS):
+        taskset.addtimer("repeater{}".format(i), REPEATDELAY, REPEATS, repeater(now, i))
+
+    while fired[0] < count or len(lateness) < REPEATERS * REPEATS:
+        await asyncio.sleep(0.05)
+    total = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    final = sorted(lateness[-REPEATERS:])
+    print("{:<24} add {:>7.3f} s   all fired after {:>6.3f} s   peak {:>6.1f} MiB   "
+          "last repetition late by {:>6.1f} ms (median)".format(name, added, total, peak / 2 ** 20,
+                                                                  final[len(final) // 2] * 1000))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    asyncio.run(run("coroutine per timer", LegacyTaskSet, count))
+    asyncio.run(run("bucketed scheduler", tasks.TaskSet, count))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,114 @@
 import asyncio
-import collections
+import capture
 import errno
+import floodfilter
 import logging
 import socket
+import time
+import isupport
+import message
+import persist
+import queries
+import reconnect
 import remotes
+import stats
 import tasks
+import throttle
+import wirelog
 from config.bot import settings as defaultsettings
-from strings import encode, decode
 
-# flood control setting
-RECEIVE_QUEUE_SIZE = 1024
 
+# default transport write buffer limits in bytes, the send loop only waits for the connection above these
+WRITE_HIGH = 16384
+WRITE_LOW = 4096
+
+# IRCv3 capabilities requested when the server offers them
+CAPABILITIES = ("account-notify", "extended-join", "multi-prefix")
 
 # determine acceptable socket error
 ERR = errno.WSAEWOULDBLOCK if hasattr(errno, "WSAEWOULDBLOCK") else errno.EINPROGRESS
 
 
 class Bot(object):
-    def __init__(self, loop, settings):
+    # whether nicks and remote variables live in this process, and are persisted here (see shard.py)
+    keepsstate = True
+
+    def __init__(self, loop, settings, supervisor=None):
         self.loop = loop
 
         self.settings = settings
-        self.tasks = tasks.TaskSet(self.loop)
-        self.remoteset = remotes.RemoteSet(self.send, self.tasks)
+        self.name = settings.get("name", "bot")
+        # set when running alongside other connections, which share executor pools and the wire log writer
+        self.supervisor = supervisor
+
+        executorset = supervisor.executors if supervisor else None
+        self.tasks = tasks.TaskSet(self.loop, pools=settings.get("executors"), executorset=executorset)
+        # protocol details of the server, filled in from RPL_ISUPPORT by UserData
+        self.profile = isupport.ServerProfile()
+        # optional instrumentation, read through IdentifierSet.stats()
+        self.stats = stats.Stats(settings.get("stats"))
+        network = supervisor.networkcommands if supervisor else None
+        self.remoteset = remotes.RemoteSet(self.send, self.tasks, self.profile, self.stats, network)
 
         self.reader = None
         self.writer = None
-        self.read_buffer = b""
-        self.send_queue = asyncio.Queue(loop=loop)
-        self.send_buffer = collections.deque()
-
-        self.allow_send = True
-        self.bytes_buffered = 0
+        self.framer = message.LineFramer()
+        # lines sent and received are logged lazily, from a separate thread (see wirelog.py)
+        self.wirelog = wirelog.WireLog(settings.get("wirelog"), self.name, shared=supervisor is not None)
+        self.scheduler = throttle.SendScheduler(loop, settings, self.profile, self.wirelog)
+        self.scheduler.prefixlength = self.remoteset.cmd.builder.prefixlength
+
+        # inbound lines are recorded for replaying if a capture file is set (see capture.py)
+        self.capture = capture.Capture(settings["capture"]) if settings.get("capture") else None
+
+        self.stats.watch("send", self.scheduler.stats)
+        self.stats.watch("executors", self.tasks.executors.stats)
+        self.stats.watch("queries", self.remoteset.userdata.queries.stats)
+        self.stats.watch("handlertasks", self.remoteset.taskstats)
+
+        # messages of flooding users are dropped before dispatching (see floodfilter.py)
+        self.remoteset.floodfilter = floodfilter.FloodFilter(settings.get("floodfilter"), self.remoteset.userdata)
+        self.stats.watch("floodfilter", self.remoteset.floodfilter.stats)
+        self.stats.start(self.tasks)
+
+        # resolved server addresses, kept across connection attempts
+        self.dns = reconnect.DNSCache(loop)
+        # channels are joined again after reconnecting (see UserData.rejoin)
+        self.remoteset.userdata.autorejoin = settings.get("rejoin", True)
+        # results of WHOIS, WHO, USERHOST and ISON queries are cached (see queries.py)
+        queriessettings = settings.get("queries") or {}
+        self.remoteset.userdata.queries.ttl = queriessettings.get("ttl", queries.QUERYTTL)
+        self.remoteset.userdata.queries.cachesize = queriessettings.get("cachesize", queries.CACHESIZE)
+
+        # accounts, hosts, remote variables and remote storage are kept across restarts if a file is set,
+        # without one remote storage is kept in memory (see persist.py)
+        persistsettings = settings.get("persist") or {}
+        self.database = persist.Database(loop, persistsettings.get("file") or ":memory:")
+        self.persistence = None
+        if persistsettings.get("file") and self.keepsstate:
+            self.persistence = persist.StateStore(loop, self.tasks, self.database, persistsettings)
+            self.persistence.attach(self.remoteset)
+        self.storage = persist.RemoteStorage(loop, self.tasks, self.database, persistsettings)
+        self.storage.attach(self.remoteset)
 
         self.connect_success = False
+        self.registered = None  # loop time at which the server welcomed us
+        self.offered_caps = set()
 
     # --- connection handling ---
 
     async def mainloop(self):
-        failed = 0
+        servers = reconnect.serverlist(self.settings)
+        settings = self.settings.get("reconnect", {})
+        backoff = reconnect.Backoff(settings.get("base", reconnect.BASEDELAY), settings.get("cap", reconnect.MAXDELAY))
+        stable = settings.get("stable", reconnect.STABLEAFTER)
+        current = 0
+
         # keep on trying to connect
         while True:
             # try to connect and keep on receiving while connected
-            if await self.connect():
+            host, port = servers[current]
+            if await self.connect(host, port):
                 send_future = asyncio.ensure_future(self.sendloop(), loop=self.loop)
                 while True:
                     try:
@@ -56,60 +122,97 @@ class Bot(object):
                         logging.warning("Disconnected.")
                         send_future.cancel()
                         self.writer.close()
+                        if self.capture:
+                            self.capture.flush()
 
                         # send _DISCONNECT pseudo-command for all loaded modules
                         self.remoteset.process("", "_DISCONNECT", "")
 
                         break
 
-            # exponentially delay reconnect if previous attempt(s) was/were unsuccessful
+            # reconnect to the same server if we were registered there: right away after a session that lasted,
+            # otherwise after backing off (the server may be dropping us on purpose)
             if self.connect_success:
-                failed = 0
-                logging.info("Reconnecting.")
+                if self.loop.time() - self.registered >= stable:
+                    backoff.reset()
+                    logging.info("Reconnecting.")
+                    continue
 
-            else:
-                failed += 1
-                delay = 10 ** failed
-                logging.info("Reconnecting in {} seconds.".format(delay))
+                delay = backoff.next()
+                logging.info("Disconnected soon after registering, reconnecting in {:.1f} seconds.".format(delay))
                 await asyncio.sleep(delay)
+                continue
+
+            # try the alternates right away, back off once all of them failed
+            current = (current + 1) % len(servers)
+            if current:
+                logging.info("Trying {}:{}.".format(*servers[current]))
+                continue
 
-    async def connect(self):
+            delay = backoff.next()
+            logging.info("Reconnecting in {:.1f} seconds.".format(delay))
+            await asyncio.sleep(delay)
+
+    async def connect(self, host=None, port=None):
         # make sure queues, buffers, etc. are reset
         self.reader = None
         self.writer = None
-        self.read_buffer = b""
-        self.send_queue = asyncio.Queue(loop=self.loop)
-
-        self.allow_send = True
-        self.bytes_buffered = 0
+        self.framer.reset()
+        self.scheduler.reset()
+        self.profile.reset()
 
         self.connect_success = False
+        self.offered_caps = set()
+        timeout = self.settings.get("reconnect", {}).get("timeout", reconnect.CONNECTTIMEOUT)
 
+        host = host or self.settings['server']
+        port = int(port or self.settings['port'])
         try:
-            self.reader, self.writer = await asyncio.open_connection(self.settings['server'],
-                                                                     int(self.settings['port']),
-                                                                     loop=self.loop)
-
+            addresses = await self.dns.resolve(host, port)
         except socket.error as e:
-            message = e.args[0]
-            if message != ERR:
-                logging.warning("Could not make connection: {}".format(message))
-                return False
+            logging.warning("Could not resolve {!r}: {}".format(host, e))
+            return False
+
+        # resolved addresses are kept, so every address of a server is tried before giving up on it
+        for address in addresses:
+            try:
+                self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(*address), timeout)
+                break
+            except asyncio.TimeoutError:
+                logging.warning("Could not make connection to {}: timed out after {} seconds.".format(address[0],
+                                                                                                  timeout))
+            except socket.error as e:
+                message = e.args[0]
+                if message != ERR:
+                    logging.warning("Could not make connection to {}: {}".format(address[0], e))
+        else:
+            self.dns.expire(host, port)
+            return False
 
+        # servers without capability negotiation ignore this
+        self.send("CAP LS 302")
         self.send("USER {} * * :{}".format(self.settings['username'], self.settings['realname']))
         self.send("NICK {}".format(self.settings['desired_nick']))
 
         return True
 
     async def sendloop(self):
-        data = b""
+        writebuffer = self.settings.get("writebuffer", {})
+        high = writebuffer.get("high", WRITE_HIGH)
+        low = writebuffer.get("low", WRITE_LOW)
+
+        transport = self.writer.transport
+        transport.set_write_buffer_limits(high, low)
+
+        # the scheduler holds lines back until the server will process them without delay
         while True:
-            data += await self.send_queue.get()
+            frames = [await self.scheduler.get()]
+            frames.extend(self.scheduler.getready(high))
+            self.writer.writelines(frames)
 
-            if self.send_queue.empty():
-                self.writer.write(data)
+            # only wait for the connection while the transport holds more than the high water mark
+            if transport.get_write_buffer_size() > high:
                 await self.writer.drain()
-                data = b""
 
     async def receive_data(self):
         data = await self.reader.read(8192)
@@ -118,96 +221,106 @@ class Bot(object):
             # assume disconnect
             return False
 
-        self.read_buffer += data
-        encoded_lines = self.read_buffer.split(b"\r\n")
-        # leave incomplete lines in buffer
-        self.read_buffer = encoded_lines.pop(-1)
+        self.framer.feed(data)
 
-        for encoded_line in encoded_lines:
-            line = decode(encoded_line)
-            logging.info("<- {}".format(line))
+        if self.stats.enabled:
+            self.receive_timed()
+            return True
 
-            # split up line in prefix, command, args
-            prefix = ''
-            trailing = []
+        for msg in self.framer:
+            self.wirelog.received(msg.line)
+            if self.capture:
+                self.capture.record(msg.line)
 
-            if line[0] == ':':
-                prefix, line = line[1:].split(' ', 1)
+            prefix = msg.prefix
+            command = msg.command
+            args = msg.args
 
-            if line.find(' :') != -1:
-                line, trailing = line.split(' :', 1)
-                args = line.split()
-                args.append(trailing)
+            self.basic_responses(command, args)
+            self.remoteset.process(prefix, command, args)
 
-            else:
-                args = line.split()
+        return True
 
-            command = args.pop(0)
+    def receive_timed(self):
+        # same as the loop in receive_data, recording parse and dispatch times per command
+        # (lines are parsed one at a time here, rather than all at once, to time them per command)
+        start = time.perf_counter()
+        lines = self.framer.lines()
+        framed = time.perf_counter()
+        self.stats.framing += framed - start
+
+        for line in lines:
+            if not line:
+                continue
+
+            self.wirelog.received(line)
+            if self.capture:
+                self.capture.record(line)
+
+            start = time.perf_counter()
+            msg = message.Message(line)
+            prefix = msg.prefix
+            command = msg.command
+            args = msg.args
+            parsed = time.perf_counter()
 
             self.basic_responses(command, args)
             self.remoteset.process(prefix, command, args)
-
-        return True
+            self.stats.command(command, parsed - start, time.perf_counter() - parsed)
 
     # --- interaction ---
 
     def basic_responses(self, command, args):
-        # deal with response to anti-flood check
-        if len(args) == 3 and (command, args[1]) == ("421", "SPLIDGEPLOIT"):
-            self.bytes_buffered = 0
-            self.allow_send = True
-
-            while len(self.send_buffer) > 0:
-                line = self.send_buffer.pop()
-                encoded_line = encode("{}\r\n".format(line))
-                encoded_line_len = len(encoded_line)
-
-                if self.bytes_buffered + encoded_line_len <= RECEIVE_QUEUE_SIZE:
-                    logging.info("-> {}".format(line))
-                    self.send_queue.put_nowait(encoded_line)
-                    self.bytes_buffered += encoded_line_len
-                else:
-                    self.send_buffer.append(line)
-                    self.allow_send = False
-                    logging.info("-> SPLIDGEPLOIT")
-                    self.send_queue.put_nowait(encode("SPLIDGEPLOIT\r\n"))
-                    break
-
         # respond to ping
         if command == "PING":
             self.send("PONG :{}".format(args[0]))
             return
 
+        if command == "CAP" and len(args) > 2:
+            self.negotiate_caps(args)
+            return
+
         # make sure initial nickname is obtained
         if self.connect_success:
             return
 
         if command == "001":
             self.connect_success = True
+            self.registered = self.loop.time()
             return
 
         if command == "433":
             self.send("NICK {}`".format(args[1]))
             return
 
-    def send(self, line):
-        encoded_line = encode("{}\r\n".format(line))
-        encoded_line_len = len(encoded_line)
-
-        if self.allow_send:
-            # wait for my commands to be processed after I have sent a critical amount of bytes
-            # note: I do not control the amount of bytes the server separately queues up to send me
-            if self.bytes_buffered + encoded_line_len <= RECEIVE_QUEUE_SIZE:
-                logging.info("-> {}".format(line))
-                self.send_queue.put_nowait(encoded_line)
-                self.bytes_buffered += encoded_line_len
+    def negotiate_caps(self, args):
+        # CAP <nick> LS [*] :<caps>, CAP <nick> ACK :<caps>, CAP <nick> NAK :<caps>
+        subcommand = args[1]
+
+        if subcommand == "LS":
+            self.offered_caps.update(c.split("=")[0] for c in args[-1].split())
+
+            # wait for the rest of a multiline reply
+            if len(args) > 3 and args[2] == "*":
                 return
 
-            self.allow_send = False
-            logging.info("-> SPLIDGEPLOIT")
-            self.send_queue.put_nowait(encode("SPLIDGEPLOIT\r\n"))
+            wanted = [c for c in CAPABILITIES if c in self.offered_caps]
+            if wanted:
+                self.send("CAP REQ :{}".format(" ".join(wanted)))
+            else:
+                self.send("CAP END")
 
-        self.send_buffer.appendleft(line)
+        elif subcommand == "ACK":
+            self.profile.caps.update(args[-1].split())
+            if not self.connect_success:
+                self.send("CAP END")
+
+        elif subcommand == "NAK" and not self.connect_success:
+            self.send("CAP END")
+
+    def send(self, line, priority=None):
+        # lines are queued per priority lane (see throttle.PRIORITIES) and sent when our penalty allows
+        self.scheduler.put(line, priority)
 
     # ----------
 
@@ -215,17 +328,34 @@ class Bot(object):
         for m in self.settings["modules"]:
             self.remoteset.loadremote(m)
 
+    def close(self):
+        # shared pools are shut down by the supervisor
+        if not self.supervisor:
+            self.tasks.executors.shutdown()
+        if self.capture:
+            self.capture.close()
+        if self.persistence:
+            self.persistence.close()
+        self.storage.close()
+        self.database.close()
+        self.wirelog.close()
+
 
 def runbot(settings):
+    # a single connection, see supervisor.runbots for running several
     loop = asyncio.get_event_loop()
 
     bot = Bot(loop, settings)
     bot.loadmodules()
 
-    loop.run_until_complete(bot.mainloop())
-    loop.close()
+    try:
+        loop.run_until_complete(bot.mainloop())
+    finally:
+        bot.close()
+        loop.close()
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
+    # lines sent and received are logged separately, see the "wirelog" setting
+    logging.basicConfig(level=logging.INFO)
     runbot(defaultsettings)
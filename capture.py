@@ -0,0 +1,71 @@
+import logging
+import queue
+import threading
+import time
+
+# NOTE: a capture holds one received line per line of text, preceded by the time it was received:
+#   <seconds since the epoch, 6 decimals> <line as received, without line ending>
+# lines that were not valid UTF-8 are stored as decoded by strings.decode
+
+# flush recorded lines to disk after this many lines
+FLUSHLINES = 256
+
+
+class Capture(object):
+    # records inbound lines, see bench/replay.py for playing them back
+    # batches of lines are handed to a queue and written by a thread of its own (like the wire log, see
+    # wirelog.py), so the event loop never waits for the disk
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a", encoding="utf-8", errors="surrogateescape")
+        self.pending = []
+        self.batches = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.write, name="capture", daemon=True)
+        self.writer.start()
+
+    def record(self, line):
+        self.pending.append("{:.6f} {}\n".format(time.time(), line))
+        if len(self.pending) >= FLUSHLINES:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.batches.put(self.pending)
+            self.pending = []
+
+    def write(self):
+        # not meant to be called directly, runs in the writer thread until handed None
+        while True:
+            lines = self.batches.get()
+            if lines is None:
+                break
+
+            try:
+                self.file.writelines(lines)
+                self.file.flush()
+            except OSError as e:
+                logging.warning("Could not write capture {!r}: {}".format(self.path, e))
+
+    def close(self):
+        # writes out everything recorded before closing the file
+        self.flush()
+        self.batches.put(None)
+        self.writer.join()
+        self.file.close()
+
+
+def readcapture(path):
+    # yields (timestamp, line) for every line in a capture
+    with open(path, encoding="utf-8", errors="surrogateescape") as f:
+        for entry in f:
+            timestamp, _, line = entry.rstrip("\n").partition(" ")
+            if line:
+                yield float(timestamp), line
+
+
+def writecapture(path, entries):
+    # writes (timestamp, line) pairs, e.g. from one of the scenarios in bench/scenarios.py
+    with open(path, "w", encoding="utf-8", errors="surrogateescape") as f:
+        for timestamp, line in entries:
+            f.write("{:.6f} {}\n".format(timestamp, line))
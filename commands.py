@@ -1,11 +1,28 @@
+import modes
+import outbound
+
+
 class CommandSet(object):
-    def __init__(self, sendcommand, tasks, loadcommand, unloadcommand):
+    def __init__(self, sendcommand, tasks, loadcommand, unloadcommand, networkcommand=None, builder=None,
+                 modequeue=None, rejoincommand=None, holdrejoincommand=None, querywatch=None):
         self.send = sendcommand
         self.tasks = tasks
         self.loadcommand = loadcommand
         self.unloadcommand = unloadcommand
+        self.networkcommand = networkcommand
+        # splits messages to fit a line and packs their targets (see outbound.py)
+        self.builder = builder
+        # gathers channel mode changes into as few lines as possible (see modes.py)
+        self.modequeue = modequeue
+        # join channels again after reconnecting (see UserData.rejoin)
+        self.rejoincommand = rejoincommand
+        self.holdrejoincommand = holdrejoincommand
+        # told about raw lines, so replies to them are not taken for replies to queries (see queries.py)
+        self.querywatch = querywatch
 
     def raw(self, command):
+        if self.querywatch:
+            self.querywatch(command)
         self.send(command)
 
     # --- specialized commands ---
@@ -47,13 +64,15 @@ class CommandSet(object):
         self.raw("NICK {}".format(nick))
 
     def notice(self, target, msg):
-        self.raw("NOTICE {} :{}".format(target, msg))
+        # target may be a Nick or Channel, a comma separated string, or a list of either
+        self._message("NOTICE", target, msg)
 
     def part(self, channels):
         self.raw("PART {}".format(channels))
 
     def msg(self, target, msg):
-        self.send("PRIVMSG {} :{}".format(target, msg))
+        # target may be a Nick or Channel, a comma separated string, or a list of either
+        self._message("PRIVMSG", target, msg)
 
     def quit(self, msg=None):
         if msg:
@@ -100,13 +119,67 @@ class CommandSet(object):
     # --- special messages ---
 
     def describe(self, target, msg):
-        self.msg(target, "\001ACTION {}\001".format(msg))
+        self._message("PRIVMSG", target, msg, "ACTION")
 
     def ctcp(self, target, request):
         self.msg(target, "\001{}\001".format(request.upper()))
 
     def ctcpreply(self, target, request, msg):
-        self.notice(target, "\001{} {}\001".format(request.upper(), msg))
+        self._message("NOTICE", target, msg, request.upper())
+
+    def _message(self, command, target, msg, ctcp=None):
+        # not meant to be called directly
+        if self.builder is None:
+            target = ",".join(outbound.targetnames(target))
+            if ctcp:
+                msg = "\001{} {}\001".format(ctcp, msg)
+            self.send("{} {} :{}".format(command, target, msg))
+            return
+
+        for line in self.builder.messages(command, target, msg, ctcp):
+            self.send(line)
+
+    # --- reconnecting ---
+
+    def rejoin(self, channels=None):
+        # joins channels along with the channels from before a disconnect, each of them once
+        self.rejoincommand(channels)
+
+    def holdrejoin(self):
+        # channels from before a disconnect are joined by a call to rejoin() rather than at the end of the
+        # MOTD, e.g. to join them once our host is hidden
+        self.holdrejoincommand()
+
+    # --- queued mode changes ---
+
+    # these return a future that is set to True once the server has made all changes, or False if any of
+    # them is not made; changes are sent together with others to the same channel within a short window
+
+    def changemode(self, channel, flags, args=None):
+        return self.modequeue.change(channel, flags, args)
+
+    def op(self, channel, nicks):
+        return self._repeatmode(channel, "+", "o", nicks)
+
+    def deop(self, channel, nicks):
+        return self._repeatmode(channel, "-", "o", nicks)
+
+    def voice(self, channel, nicks):
+        return self._repeatmode(channel, "+", "v", nicks)
+
+    def devoice(self, channel, nicks):
+        return self._repeatmode(channel, "-", "v", nicks)
+
+    def ban(self, channel, masks):
+        return self._repeatmode(channel, "+", "b", masks)
+
+    def unban(self, channel, masks):
+        return self._repeatmode(channel, "-", "b", masks)
+
+    def _repeatmode(self, channel, sign, mode, args):
+        # not meant to be called directly
+        args = modes.modeargs(args)
+        return self.changemode(channel, sign + mode * len(args), args)
 
     # --- task commands ---
 
@@ -117,8 +190,18 @@ class CommandSet(object):
     def timerdel(self, *args):
         self.tasks.removetimer(*args)
 
-    def bgprocess(self, command):
-        self.tasks.dobgprocess(command)
+    def bgprocess(self, command, *args, **kwargs):
+        return self.tasks.dobgprocess(command, *args, **kwargs)
+
+    # --- other connections ---
+
+    def network(self, name):
+        # commands for another connection run by the same supervisor, by its name or the network it belongs
+        # to (the least busy one of several connections to a network), None if there is no such connection
+        if self.networkcommand is None:
+            return None
+
+        return self.networkcommand(name)
 
     # --- module loading/unloading ---
 
@@ -1,8 +1,97 @@
 settings = {
+    # connection name, used by other connections to address this one (see supervisor.py)
+    "name": "quakenet",
+    # connections sharing a network name are clones, CommandSet.network picks the least busy one
+    "network": "quakenet",
     "server": "irc.quakenet.org",
     "port": 6667,
+    # alternate (server, port) pairs, tried right away when connecting to the previous one fails
+    "servers": [],
+    # delays between connection attempts once all servers failed: doubling from base to at most cap seconds,
+    # reset once a session lasted stable seconds; connecting to an address gives up after timeout seconds
+    "reconnect": {
+        "base": 2,
+        "cap": 300,
+        "stable": 60,
+        "timeout": 30,
+    },
+    # join the channels we were on again after reconnecting
+    "rejoin": True,
     "username": "vorobot",
     "realname": "vorobot",
     "desired_nick": "vorobot",
     "modules": ["quakenet", "test"],
-}
\ No newline at end of file
+    # output flood control (see throttle.py), following the network's penalty rules
+    "throttle": {
+        "burst": 10,
+        "penalty": 2,
+        "bytepenalty": 120,
+        # None follows the server's TARGMAX
+        "maxtargets": None,
+        # messages to these targets are never held back, as they are used for authentication
+        "services": ["Q@CServe.quakenet.org"],
+    },
+    # transport write buffer limits in bytes
+    "writebuffer": {
+        "high": 16384,
+        "low": 4096,
+    },
+    # background process pools (see executors.py), policy is "reject" or "dropoldest" for full queues
+    "executors": {
+        "io": {"kind": "thread", "workers": 4, "queue": 256, "policy": "reject"},
+        "cpu": {"kind": "process", "workers": 2, "queue": 64, "policy": "reject"},
+    },
+    # handler and hot path instrumentation (see stats.py), snapshots are appended to dumpfile as JSON lines
+    "stats": {
+        "enabled": False,
+        "dumpfile": None,
+        "dumpinterval": 60,
+    },
+    # accounts, hosts, remote variables and remote storage kept in a SQLite file (see persist.py), file None
+    # to disable (remote storage is then kept in memory)
+    "persist": {
+        "file": None,
+        "flushinterval": 5,
+        "staleafter": 24 * 3600,
+        "pruneafter": 30 * 24 * 3600,
+        "cachesize": 4096,
+        "batchsize": 512,
+        "maxvaluesize": 64 * 1024,
+    },
+    # seconds WHOIS, WHO, USERHOST and ISON results of remotes are cached for, and how many (see queries.py)
+    "queries": {
+        "ttl": 60,
+        "cachesize": 1024,
+    },
+    # when enabled, messages of users sending more than userlines per userwindow seconds are dropped and they
+    # are ignored for ignoretime seconds, messages to channels beyond channellines (None for no limit) per
+    # channelwindow seconds are dropped; lines from exempt hostmasks (services) and users authed as exempt
+    # accounts (admins, our own) always pass
+    "floodfilter": {
+        "enabled": False,
+        "userlines": 8,
+        "userwindow": 10,
+        "channellines": None,
+        "channelwindow": 10,
+        "ignoretime": 120,
+        "slots": 4096,
+        "exempt": ["Q!TheQBot@CServe.quakenet.org", "L!TheLBot@lightweight.quakenet.org"],
+        "exemptaccounts": [],
+    },
+    # file received lines are appended to for replaying (see capture.py and bench/replay.py), None to disable
+    "capture": None,
+    # logging of lines sent and received (see wirelog.py), file None logs to the console
+    "wirelog": {
+        "enabled": True,
+        "level": "INFO",
+        "file": None,
+        "format": "text",
+        "maxbytes": 10 * 2 ** 20,
+        "backups": 5,
+        "sample": 1,
+        "ratelimit": None,
+    },
+}
+
+# connections run by supervisor.py, e.g. [settings, dict(settings, name="quakenet2", desired_nick="vorobot2")]
+bots = [settings]
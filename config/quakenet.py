@@ -2,5 +2,6 @@ settings = {
     "authname": "myauth",
     "password": "mypassword",
     "channels": "#pwnagedeluxe",
+    # hostmasks (e.g. "*!*@adminauth.users.quakenet.org") or nicks
     "admins": ["adminauth"],
 }
@@ -0,0 +1,220 @@
+import logging
+import re
+import types
+
+# command used by handlers that see every incoming line (matched on numeric instead)
+RAWCOMMAND = "_RAW"
+
+# commands of handlers run when a remote is (un)loaded rather than offered lines
+LIFECYCLE = ("_LOAD", "_UNLOAD")
+
+# patterns that cannot safely be folded into a combined matcher
+BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+
+# NOTE: handlers are indexed on attributes set by the decorators in handlers.py:
+#   command     -- command the handler is registered for ("_RAW" for raw handlers)
+#   numeric     -- command a raw handler actually responds to
+#   targetmatch -- pattern matched against the first argument (channel or nick)
+#   textmatch   -- pattern matched against the message text (or all arguments for raw handlers)
+#   dispatch    -- handler body without the matching logic, called once the index accepts a line
+#   handlername -- name of the decorated function, used for instrumentation (see stats.py)
+
+class HandlerGroup(object):
+    # handlers sharing a dispatch key, in order of registration
+
+    def __init__(self):
+        self.handlers = []
+        self.entries = []
+        self.targets = []
+        self.prefilter = None
+        self.matcher = None
+        self.alltext = False
+        self.stale = True
+
+    def __len__(self):
+        return len(self.handlers)
+
+    def add(self, seq, handler):
+        self.handlers.append((seq, handler))
+        self.stale = True
+
+    def remove(self, handler):
+        self.handlers = [(s, h) for s, h in self.handlers if h != handler]
+        self.stale = True
+
+    def build(self):
+        targetpatterns = []
+        textpatterns = []
+        self.entries = []
+
+        for seq, handler in self.handlers:
+            try:
+                targetslot = -1
+                pattern = getpattern(handler, "targetmatch")
+                if pattern:
+                    if pattern not in targetpatterns:
+                        re.compile(pattern)
+                        targetpatterns.append(pattern)
+                    targetslot = targetpatterns.index(pattern)
+
+                textslot = -1
+                textre = None
+                pattern = getpattern(handler, "textmatch")
+                if pattern:
+                    textre = re.compile(pattern)
+                    if not BACKREFERENCE.search(pattern):
+                        textslot = len(textpatterns)
+                        textpatterns.append(pattern)
+                        textre = None
+            except re.error as e:
+                warning = "Could not index handler in module {!r} / remote {!r}: {}"
+                logging.warning(warning.format(handler.__self__.__module__.split(".")[-1],
+                                               handler.__self__.__class__.__name__, e))
+                continue
+
+            # call the handler body directly, the index already did the matching
+            if hasattr(handler, "dispatch"):
+                call = types.MethodType(handler.dispatch, handler.__self__)
+            else:
+                call = handler
+
+            self.entries.append((seq, call, targetslot, textslot, textre))
+
+        self.targets = [re.compile(p) for p in targetpatterns]
+        self.prefilter, self.matcher, groups = combine(textpatterns)
+
+        if self.matcher:
+            # position of each pattern's group in match.groups()
+            self.entries = [(seq, call, targetslot, groups[textslot] if textslot >= 0 else -1, textre)
+                            for seq, call, targetslot, textslot, textre in self.entries]
+        elif textpatterns:
+            # fall back to separate matching if the patterns do not combine
+            self.entries = [(seq, call, targetslot, -1, re.compile(textpatterns[textslot]) if textslot >= 0 else textre)
+                            for seq, call, targetslot, textslot, textre in self.entries]
+
+        # lines no text pattern accepts can be rejected as a whole
+        self.alltext = self.matcher is not None and all(e[3] >= 0 for e in self.entries)
+
+        self.stale = False
+
+    def select(self, target, text):
+        if self.stale:
+            self.build()
+
+        textok = None
+        if self.matcher and text is not None:
+            if self.prefilter.match(text):
+                textok = self.matcher.match(text).groups()
+            elif self.alltext:
+                return []
+
+        targetok = [p.match(target) is not None for p in self.targets] if target is not None else None
+
+        selected = []
+        for seq, call, targetslot, textslot, textre in self.entries:
+            if targetslot >= 0 and (targetok is None or not targetok[targetslot]):
+                continue
+
+            if textslot >= 0:
+                if textok is None or textok[textslot] is None:
+                    continue
+            elif textre:
+                if text is None or not textre.match(text):
+                    continue
+
+            selected.append((seq, call))
+
+        return selected
+
+
+class HandlerIndex(object):
+    # looks up the handlers that accept an incoming line
+
+    def __init__(self, stats=None):
+        self.seq = 0
+        self.raw = {}  # raw handlers per numeric
+        self.commands = {}  # command specific handlers per command
+        self.stats = stats  # optional instrumentation, every indexed handler is registered (see stats.py)
+
+    def __contains__(self, command):
+        return command in self.commands
+
+    def add(self, handler):
+        groups, key = self._locate(handler)
+        if key not in groups:
+            groups[key] = HandlerGroup()
+
+        self.seq += 1
+        groups[key].add(self.seq, handler)
+
+        # handlers that never accept a line are listed too, with all lines of their command rejected
+        if self.stats is not None and handler.command not in LIFECYCLE:
+            self.stats.handler(handler, key if groups is self.raw else handler.command)
+
+    def remove(self, handler):
+        groups, key = self._locate(handler)
+        groups[key].remove(handler)
+
+        if self.stats is not None:
+            self.stats.forget(handler)
+
+        if not groups[key]:
+            del groups[key]
+
+    def lookup(self, command, args):
+        # returns (raw handlers, command specific handlers) accepting the line
+        raw = []
+        if self.raw:
+            text = " ".join(args)
+            for key in (command, None):
+                if key in self.raw:
+                    raw.extend(self.raw[key].select(None, text))
+
+            if len(raw) > 1:
+                raw.sort(key=lambda e: e[0])
+
+        specific = []
+        if command in self.commands:
+            target = args[0] if args else None
+            text = args[1] if len(args) > 1 else None
+            specific = self.commands[command].select(target, text)
+
+        return [call for seq, call in raw], [call for seq, call in specific]
+
+    def _locate(self, handler):
+        # not meant to be called directly
+        if handler.command == RAWCOMMAND:
+            return self.raw, getattr(handler, "numeric", None)
+
+        return self.commands, handler.command
+
+
+# --- helpers ---
+
+def getpattern(handler, name):
+    pattern = getattr(handler, name, None)
+    return getattr(pattern, "pattern", pattern)
+
+
+def combine(patterns):
+    # returns (prefilter, matcher, group positions)
+    # the prefilter is a plain alternation that tells whether any pattern accepts the text; in the
+    # matcher every pattern sits in its own optional lookahead at the start of the text, so a single
+    # match() reports which patterns accept the text through their groups
+    if not patterns:
+        return None, None, ()
+
+    groups = []
+    position = 0
+    for p in patterns:
+        groups.append(position)
+        position += 1 + re.compile(p).groups
+
+    try:
+        prefilter = re.compile("|".join("(?:{})".format(p) for p in patterns))
+        matcher = re.compile("".join("(?:(?=({}))|)".format(p) for p in patterns))
+    except re.error:
+        return None, None, ()
+
+    return prefilter, matcher, groups
@@ -0,0 +1,237 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+
+# default pools: threads for blocking I/O, processes for CPU-bound work
+DEFAULTPOOLS = {
+    "io": {"kind": "thread", "workers": 4, "queue": 256, "policy": "reject"},
+    "cpu": {"kind": "process", "workers": 2, "queue": 64, "policy": "reject"},
+}
+DEFAULTPOOL = "io"
+
+# what to do with a submitted job when the queue is full
+REJECT = "reject"  # fail the new job with asyncio.QueueFull
+DROPOLDEST = "dropoldest"  # cancel the oldest queued job to make room
+
+# latencies kept per pool for the counters
+LATENCYSAMPLES = 256
+
+
+class Job(object):
+    __slots__ = ("function", "args", "future", "queued", "started")
+
+    def __init__(self, function, args, future, queued):
+        self.function = function
+        self.args = args
+        self.future = future
+        self.queued = queued
+        self.started = None
+
+
+class ExecutorPool(object):
+    # a thread or process pool behind a bounded queue, only as many jobs as there are workers are handed to
+    # the executor at a time so the queue depth and waiting times are known on the event loop's side
+    # results are always delivered to the event loop thread
+
+    def __init__(self, loop, name, kind="thread", workers=4, queue=256, policy=REJECT):
+        self.loop = loop
+        self.name = name
+        self.kind = kind
+        self.workers = workers
+        self.maxqueue = queue
+        self.policy = policy
+
+        self.executor = None
+        self.queue = collections.deque()
+        self.running = 0
+        self.closed = False  # no new jobs are accepted once shut down or drained
+        self.space = asyncio.Event()
+        self.space.set()
+
+        self.counters = collections.Counter()
+        self.waits = collections.deque(maxlen=LATENCYSAMPLES)  # seconds from submitting to starting
+        self.runs = collections.deque(maxlen=LATENCYSAMPLES)  # seconds from starting to finishing
+
+    def submit(self, function, *args, callback=None):
+        # returns a future for the result, callback (if given) is called with the result as well
+        future = self.loop.create_future()
+        if callback:
+            future.add_done_callback(lambda f: self._callback(f, callback))
+
+        if self.closed:
+            self.counters["rejected"] += 1
+            future.set_exception(RuntimeError("Executor pool {!r} is shut down.".format(self.name)))
+            return future
+
+        if len(self.queue) >= self.maxqueue:
+            if self.policy == DROPOLDEST and self.queue:
+                dropped = self.queue.popleft()
+                dropped.future.cancel()
+                self.counters["dropped"] += 1
+                logging.warning("Dropped oldest job from full executor pool {!r}.".format(self.name))
+            else:
+                self.counters["rejected"] += 1
+                logging.warning("Rejected job for full executor pool {!r}.".format(self.name))
+                future.set_exception(asyncio.QueueFull())
+                return future
+
+        self.counters["submitted"] += 1
+        self.queue.append(Job(function, args, future, self.loop.time()))
+        self._update()
+        self._start()
+        return future
+
+    async def put(self, function, *args, callback=None):
+        # like submit, but waits for room in the queue instead of applying the policy
+        while len(self.queue) >= self.maxqueue:
+            self.space.clear()
+            await self.space.wait()
+
+        return self.submit(function, *args, callback=callback)
+
+    def stats(self):
+        return {
+            "queued": len(self.queue),
+            "running": self.running,
+            "maxqueued": self.counters["maxqueued"],
+            "submitted": self.counters["submitted"],
+            "completed": self.counters["completed"],
+            "failed": self.counters["failed"],
+            "rejected": self.counters["rejected"],
+            "dropped": self.counters["dropped"],
+            "wait": average(self.waits),
+            "maxwait": max(self.waits, default=0.0),
+            "run": average(self.runs),
+            "maxrun": max(self.runs, default=0.0),
+        }
+
+    def shutdown(self, wait=None):
+        self.closed = True
+        for job in self.queue:
+            job.future.cancel()
+        self.queue.clear()
+        self._update()
+
+        if self.executor:
+            # worker processes have to be joined before the interpreter exits, threads can be left to finish
+            self.executor.shutdown(wait=self.kind == "process" if wait is None else wait)
+            self.executor = None
+
+    def drain(self):
+        # for shutting down without losing work: stops accepting jobs, waits for the running ones and runs
+        # the queued ones in the calling thread, in order. the event loop does not have to be running
+        self.closed = True
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+        while self.queue:
+            job = self.queue.popleft()
+            if job.future.cancelled():
+                continue
+
+            try:
+                result = job.function(*job.args)
+            except Exception as e:
+                self.counters["failed"] += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                self.counters["completed"] += 1
+                if not job.future.done():
+                    job.future.set_result(result)
+
+        self._update()
+
+    def _start(self):
+        # not meant to be called directly
+        while self.queue and self.running < self.workers:
+            job = self.queue.popleft()
+            if job.future.cancelled():
+                continue
+
+            if self.executor is None:
+                if self.kind == "process":
+                    self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+                else:
+                    self.executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+
+            job.started = self.loop.time()
+            self.waits.append(job.started - job.queued)
+            self.running += 1
+            try:
+                result = self.loop.run_in_executor(self.executor, job.function, *job.args)
+            except Exception as e:
+                self.running -= 1
+                self.counters["failed"] += 1
+                job.future.set_exception(e)
+                continue
+
+            result.add_done_callback(lambda r, job=job: self._finish(job, r))
+
+        self._update()
+
+    def _finish(self, job, result):
+        # not meant to be called directly
+        self.running -= 1
+        self.runs.append(self.loop.time() - job.started)
+
+        if result.cancelled():
+            job.future.cancel()
+        elif result.exception() is not None:
+            self.counters["failed"] += 1
+            if not job.future.done():
+                job.future.set_exception(result.exception())
+        else:
+            self.counters["completed"] += 1
+            if not job.future.done():
+                job.future.set_result(result.result())
+
+        self._start()
+
+    def _update(self):
+        # not meant to be called directly
+        self.counters["maxqueued"] = max(self.counters["maxqueued"], len(self.queue))
+        if len(self.queue) < self.maxqueue:
+            self.space.set()
+
+    def _callback(self, future, callback):
+        # not meant to be called directly
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        try:
+            callback(future.result())
+        except Exception as e:
+            logging.warning("Failed to execute callback for pool {!r}: {}".format(self.name, e))
+
+
+class ExecutorSet(object):
+    # named executor pools, as configured in the "executors" setting
+
+    def __init__(self, loop, settings=None):
+        self.loop = loop
+        self.pools = {}
+
+        for name, options in (settings or DEFAULTPOOLS).items():
+            self.pools[name] = ExecutorPool(loop, name, **options)
+
+    def __getitem__(self, name):
+        return self.pools[name]
+
+    def __contains__(self, name):
+        return name in self.pools
+
+    def stats(self):
+        return {name: pool.stats() for name, pool in self.pools.items()}
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown()
+
+
+# --- helpers ---
+
+def average(samples):
+    return sum(samples) / len(samples) if samples else 0.0
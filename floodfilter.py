@@ -0,0 +1,176 @@
+import array
+import logging
+import time
+import masks
+import strings
+
+# default flood filter settings
+DEFAULTS = {
+    "enabled": False,
+    # messages a user (by user@host) may send within window seconds, beyond which they are ignored
+    "userlines": 8,
+    "userwindow": 10,
+    # messages to a channel within window seconds, beyond which messages to it are dropped; None for no
+    # limit, as all messages to a busy channel (loggers' included) are dropped once it is reached
+    "channellines": None,
+    "channelwindow": 10,
+    # seconds a flooding user is ignored for
+    "ignoretime": 120,
+    # counters per table, users or channels sharing a counter are counted together
+    "slots": 4096,
+    # hostmasks (e.g. services) and account names (e.g. admins, our own) that are never filtered
+    "exempt": [],
+    "exemptaccounts": [],
+}
+
+# commands filtered, everything else (and anything from servers) always passes
+FILTERED = frozenset(("PRIVMSG", "NOTICE"))
+
+
+class WindowCounter(object):
+    # sliding window counters in fixed size tables: the count of the previous window is weighed by how much
+    # of it still overlaps with the sliding window. keys hashing to the same slot are counted together
+
+    def __init__(self, slots, window):
+        self.slots = slots
+        self.window = window
+        self.windows = array.array("q", [-1]) * slots  # number of the current window per slot
+        self.current = array.array("L", [0]) * slots
+        self.previous = array.array("L", [0]) * slots
+
+    def add(self, key, now):
+        # counts a line, returns the estimated count over the last window seconds
+        i = hash(key) % self.slots
+        number = int(now // self.window)
+        passed = number - self.windows[i]
+
+        if passed:
+            self.previous[i] = self.current[i] if passed == 1 else 0
+            self.current[i] = 0
+            self.windows[i] = number
+
+        self.current[i] += 1
+        overlap = 1.0 - (now % self.window) / self.window
+        return self.current[i] + self.previous[i] * overlap
+
+
+class FloodFilter(object):
+    # drops messages before they are dispatched to handlers: from ignored users, from users sending more
+    # than userlines messages per userwindow seconds (who are then ignored for ignoretime seconds), and to
+    # channels receiving more than channellines messages per channelwindow seconds
+    # user data is still updated for dropped lines, only handlers (and their replies) are skipped
+    # users ignored for flooding are looked up by user@host; ignores set by hostmask go into a MaskIndex
+    # we ourselves, users matching an exempt hostmask and users authed as an exempt account are not counted
+
+    def __init__(self, settings, userdata):
+        settings = dict(DEFAULTS, **(settings or {}))
+        self.enabled = settings["enabled"]
+        self.userlines = settings["userlines"]
+        self.channellines = settings["channellines"]
+        self.ignoretime = settings["ignoretime"]
+        self.userdata = userdata
+
+        self.users = WindowCounter(settings["slots"], settings["userwindow"])
+        self.channels = WindowCounter(settings["slots"], settings["channelwindow"])
+        self.ignores = {}  # expiry times per user@host, None for ignoring until unignored
+        self.purgeat = 64  # amount of ignores at which expired ones are removed
+        self.maskignores = masks.MaskIndex(userdata.profile)  # expiry times per hostmask
+
+        self.exempt = masks.MaskIndex(userdata.profile)
+        for mask in settings["exempt"]:
+            self.exempt.add(mask)
+        self.exemptaccounts = {a.lower() for a in settings["exemptaccounts"]}
+
+        # counters, see stats()
+        self.dropped = 0
+        self.ignored = 0
+
+    def allow(self, prefix, command, args):
+        if not self.enabled or command not in FILTERED or "!" not in prefix:
+            return True
+
+        now = time.monotonic()
+        userhost = prefix.partition("!")[2].lower()
+        if userhost in self.ignores:
+            expiry = self.ignores[userhost]
+            if expiry is None or expiry > now:
+                self.dropped += 1
+                return False
+            del self.ignores[userhost]
+
+        if self.maskignores and self.ignoredmask(prefix, now):
+            self.dropped += 1
+            return False
+
+        # exempt users are never ignored for flooding, only by an explicit ignore()
+        if self.isexempt(prefix):
+            return True
+
+        if self.users.add(userhost, now) > self.userlines:
+            self.ignore(userhost, self.ignoretime, now)
+            logging.warning("Ignoring {!r} for {} seconds for flooding.".format(prefix, self.ignoretime))
+            self.dropped += 1
+            return False
+
+        target = args[0] if args else ""
+        if self.channellines is not None and self.userdata.profile.ischannel(target) and \
+                self.channels.add(self.userdata.key(target), now) > self.channellines:
+            self.dropped += 1
+            return False
+
+        return True
+
+    def isexempt(self, prefix):
+        # not meant to be called directly
+        userdata = self.userdata
+        nickname = strings.getnick(prefix)
+        if userdata.me and userdata.key(nickname) == userdata.key(userdata.me):
+            return True
+
+        if self.exemptaccounts:
+            nick = userdata.nicks.get(userdata.key(nickname))
+            if nick is not None and nick.account and nick.account.lower() in self.exemptaccounts:
+                return True
+
+        return bool(self.exempt) and self.exempt.matches(prefix)
+
+    def ignoredmask(self, prefix, now):
+        # not meant to be called directly
+        ignored = False
+        for mask in self.maskignores.match(prefix):
+            expiry = self.maskignores.get(mask)
+            if expiry is None or expiry > now:
+                ignored = True
+            else:
+                self.maskignores.remove(mask)
+
+        return ignored
+
+    def ignore(self, mask, duration=None, now=None):
+        # ignores user@host, or a nick!user@host mask (wildcards allowed), for duration seconds or until
+        # unignored
+        expiry = None
+        if duration is not None:
+            expiry = (now if now is not None else time.monotonic()) + duration
+        self.ignored += 1
+
+        if "!" in mask or "*" in mask or "?" in mask:
+            self.maskignores.add(mask if "!" in mask else "*!" + mask, expiry)
+            return
+
+        self.ignores[mask.lower()] = expiry
+
+        if len(self.ignores) >= self.purgeat:
+            now = time.monotonic()
+            self.ignores = {k: e for k, e in self.ignores.items() if e is None or e > now}
+            self.purgeat = max(2 * len(self.ignores), 64)
+
+    def unignore(self, mask):
+        if self.maskignores.remove(mask) or "!" not in mask and self.maskignores.remove("*!" + mask):
+            return True
+
+        return self.ignores.pop(mask.lower(), False) is not False
+
+    def stats(self):
+        return {"dropped": self.dropped, "ignored": self.ignored,
+                "ignoring": len(self.ignores) + len(self.maskignores)}
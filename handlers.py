@@ -12,17 +12,32 @@ import strings
 #                 command = "CTCPREPLY"
 
 
+# NOTE: patterns are compiled once, when the remote class is defined
+
+# NOTE: handlers may be coroutine functions (async def); they are then run as tasks of their remote (see
+# Remote.maxtasks), while other handlers run inline
+
 def raw(numeric, argmatch):
+    argmatch = re.compile(argmatch)
+
     def wrap(handler):
+        def dispatch(self, prefix, command, args):
+            # (self, args1, args2, ...)
+            return handler(self, *args)
+
         def wrapped(self, prefix, command, args):
-            if command != numeric or not re.match(argmatch, " ".join(args)):
+            if command != numeric or not argmatch.match(" ".join(args)):
                 return
 
-            # (self, args1, args2, ...)
-            return handler(self, *args)
+            return dispatch(self, prefix, command, args)
 
         wrapped.ishandler = True
+        wrapped.handlername = handler.__name__
         wrapped.command = "_RAW"
+        wrapped.numeric = dispatch.numeric = numeric
+        wrapped.textmatch = argmatch
+        wrapped.dispatch = dispatch
+        dispatch.handlername = handler.__name__
         return wrapped
 
     return wrap
@@ -33,52 +48,76 @@ def onload(handler):
         return handler(self)
 
     wrapped.ishandler = True
+    wrapped.handlername = handler.__name__
     wrapped.command = "_LOAD"
 
     return wrapped
 
 
+def onunload(handler):
+    def wrapped(self):
+        return handler(self)
+
+    wrapped.ishandler = True
+    wrapped.handlername = handler.__name__
+    wrapped.command = "_UNLOAD"
+
+    return wrapped
+
+
 def onconnect(handler):
     def wrapped(self, prefix, command, args):
         return handler(self)
 
     wrapped.ishandler = True
+    wrapped.handlername = handler.__name__
     wrapped.command = "001"
 
     return wrapped
 
 
-def onjoin(channelmatch):
-    def wrap(handler):
-        def wrapped(self, prefix, command, args):
-            if not re.match(channelmatch, args[0]):
-                return
+def onjoin(channelmatch, ordered=True):
+    channelmatch = re.compile(channelmatch)
 
+    def wrap(handler):
+        def dispatch(self, prefix, command, args):
             nick = self.id.nick(strings.getnick(prefix), prefix)
 
             # (self, nick, channel)
             newargs = (self, nick, args[0])
             return handler(*newargs)
 
+        def wrapped(self, prefix, command, args):
+            if not channelmatch.match(args[0]):
+                return
+
+            return dispatch(self, prefix, command, args)
+
         wrapped.ishandler = True
+        wrapped.handlername = handler.__name__
         wrapped.command = "JOIN"
+        # async handlers for the same target are run one after the other
+        wrapped.ordered = dispatch.ordered = ordered
+        wrapped.targetmatch = channelmatch
+        wrapped.dispatch = dispatch
+        dispatch.handlername = handler.__name__
         return wrapped
 
     return wrap
 
 
-def onnotice(textmatch, targetmatch):
+def onnotice(textmatch, targetmatch, ordered=True):
+    textmatch = re.compile(textmatch)
+    targetmatch = re.compile(targetmatch)
+
     def wrap(handler):
-        def wrapped(self, prefix, command, args):
+        def dispatch(self, prefix, command, args):
             if strings.isctcp(args[1]):
                 return
 
-            if not (re.match(targetmatch, args[0]) and re.match(textmatch, args[1])):
-                return
-
             nick = self.id.nick(strings.getnick(prefix), prefix)
 
-            if strings.ischannel(args[0]):
+            if self.id.ischannel(args[0]):
                 target = self.id.channel(args[0])
             else:
                 target = self.id.nick(args[0])
@@ -87,25 +126,38 @@ def onnotice(textmatch, targetmatch):
             newargs = (self, nick, target, args[1])
             return handler(*newargs)
 
+        def wrapped(self, prefix, command, args):
+            if not (targetmatch.match(args[0]) and textmatch.match(args[1])):
+                return
+
+            return dispatch(self, prefix, command, args)
+
         wrapped.ishandler = True
+        wrapped.handlername = handler.__name__
         wrapped.command = "NOTICE"
+        # async handlers for the same target are run one after the other
+        wrapped.ordered = dispatch.ordered = ordered
+        wrapped.targetmatch = targetmatch
+        wrapped.textmatch = textmatch
+        wrapped.dispatch = dispatch
+        dispatch.handlername = handler.__name__
         return wrapped
 
     return wrap
 
 
-def ontext(textmatch, targetmatch):
+def ontext(textmatch, targetmatch, ordered=True):
+    textmatch = re.compile(textmatch)
+    targetmatch = re.compile(targetmatch)
+
     def wrap(handler):
-        def wrapped(self, prefix, command, args):
+        def dispatch(self, prefix, command, args):
             if strings.isctcp(args[1]):
                 return
 
-            if not (re.match(targetmatch, args[0]) and re.match(textmatch, args[1])):
-                return
-
             nick = self.id.nick(strings.getnick(prefix), prefix)
 
-            if strings.ischannel(args[0]):
+            if self.id.ischannel(args[0]):
                 target = self.id.channel(args[0])
             else:
                 target = self.id.nick(args[0])
@@ -114,8 +166,21 @@ def ontext(textmatch, targetmatch):
             newargs = (self, nick, target, args[1])
             return handler(*newargs)
 
+        def wrapped(self, prefix, command, args):
+            if not (targetmatch.match(args[0]) and textmatch.match(args[1])):
+                return
+
+            return dispatch(self, prefix, command, args)
+
         wrapped.ishandler = True
+        wrapped.handlername = handler.__name__
         wrapped.command = "PRIVMSG"
+        # async handlers for the same target are run one after the other
+        wrapped.ordered = dispatch.ordered = ordered
+        wrapped.targetmatch = targetmatch
+        wrapped.textmatch = textmatch
+        wrapped.dispatch = dispatch
+        dispatch.handlername = handler.__name__
         return wrapped
 
     return wrap
@@ -1,9 +1,11 @@
+import masks
 import strings
 
 
 class IdentifierSet(object):
-    def __init__(self, userdata):
+    def __init__(self, userdata, stats=None):
         self.userdata = userdata
+        self.statistics = stats
 
     def nick(self, nickname, host=""):
         return self.userdata.getnick(nickname, host)
@@ -17,5 +19,24 @@ class IdentifierSet(object):
     def me(self):
         return self.userdata.getme()
 
+    def accounts(self):
+        # see userdata.AccountTracker
+        return self.userdata.accounts
+
+    def queries(self):
+        # awaitable WHOIS, WHO, USERHOST and ISON, see queries.QueryManager
+        return self.userdata.queries
+
+    def maskindex(self):
+        # a new, empty index of hostmasks in the server's case mapping, see masks.MaskIndex
+        return masks.MaskIndex(self.userdata.profile)
+
+    def stats(self):
+        # see stats.Stats, None when the bot was started without instrumentation
+        return self.statistics
+
+    def ischannel(self, name):
+        return self.userdata.profile.ischannel(name)
+
     def irclower(self, string):
         return strings.irclower(string)
@@ -0,0 +1,114 @@
+import sys
+import strings
+
+# assumed until the server tells otherwise in RPL_ISUPPORT (005), mostly following RFC 1459
+DEFAULTS = {
+    "CHANMODES": "b,k,l,imnpst",
+    "PREFIX": "(qaohv)~&@%+",
+    "CHANTYPES": "#&",
+    "CASEMAPPING": strings.DEFAULTCASEMAPPING,
+    "MODES": "3",
+    "NICKLEN": "9",
+    "USERLEN": "10",
+    "HOSTLEN": "63",
+}
+
+# amount of targets for commands the server does not give a limit for
+DEFAULTTARGETS = 1
+# used for an empty (unlimited) TARGMAX entry
+UNLIMITED = sys.maxsize
+
+
+class ServerProfile(object):
+    # protocol details of the server we are connected to, built from RPL_ISUPPORT
+    # everything is turned into lookup tables once, when the tokens come in
+
+    def __init__(self):
+        self.tokens = {}
+        self.caps = set()
+        self.reset()
+
+    def reset(self):
+        self.tokens = dict(DEFAULTS)
+        # IRCv3 capabilities acknowledged by the server
+        self.caps = set()
+        self.build()
+
+    def update(self, tokens):
+        # tokens as sent in 005: NAME, NAME=value or -NAME
+        for token in tokens:
+            if token.startswith("-"):
+                name = token[1:].upper()
+                if name in DEFAULTS:
+                    self.tokens[name] = DEFAULTS[name]
+                else:
+                    self.tokens.pop(name, None)
+            else:
+                name, _, value = token.partition("=")
+                self.tokens[name.upper()] = value
+
+        self.build()
+
+    def build(self):
+        tokens = self.tokens
+
+        # PREFIX=(modes)symbols, highest rank first
+        modes, _, symbols = tokens.get("PREFIX", "").lstrip("(").partition(")")
+        self.prefixes = dict(zip(symbols, modes))
+        self.modebits = {mode: 1 << i for i, mode in enumerate(modes)}
+        self.modestrings = {0: ""}
+
+        # CHANMODES=A,B,C,D: list modes, modes that always take an argument, modes that only take an
+        # argument when set and modes that never take one
+        types = (tokens.get("CHANMODES", "").split(",") + ["", "", "", ""])[:4]
+        self.listmodes = frozenset(types[0])
+        self.setargmodes = frozenset(types[0] + types[1] + types[2] + modes)
+        self.unsetargmodes = frozenset(types[0] + types[1] + modes)
+
+        self.chantypes = frozenset(tokens.get("CHANTYPES", ""))
+
+        casemapping = tokens.get("CASEMAPPING", "").lower()
+        if casemapping not in strings.casemappings:
+            casemapping = strings.DEFAULTCASEMAPPING
+        self.casemapping = strings.casemappings[casemapping]
+
+        self.modes = toint(tokens.get("MODES"), UNLIMITED)
+        self.nicklen = toint(tokens.get("NICKLEN"), UNLIMITED)
+        self.userlen = toint(tokens.get("USERLEN"), toint(DEFAULTS["USERLEN"], 0))
+        self.hostlen = toint(tokens.get("HOSTLEN"), toint(DEFAULTS["HOSTLEN"], 0))
+
+        # TARGMAX=PRIVMSG:4,NOTICE:4,JOIN:, ... (older servers send MAXTARGETS for messages)
+        self.targmax = {}
+        if "MAXTARGETS" in tokens:
+            maxtargets = toint(tokens["MAXTARGETS"], UNLIMITED)
+            self.targmax = {"PRIVMSG": maxtargets, "NOTICE": maxtargets}
+        for entry in tokens.get("TARGMAX", "").split(","):
+            command, _, limit = entry.partition(":")
+            if command:
+                self.targmax[command.upper()] = toint(limit, UNLIMITED)
+
+        self.whox = "WHOX" in tokens
+
+    # --- lookups ---
+
+    def ischannel(self, name):
+        return name[:1] in self.chantypes
+
+    def maxtargets(self, command):
+        return self.targmax.get(command, DEFAULTTARGETS)
+
+    def modestring(self, bits):
+        # mode letters for a combination of prefix mode bits
+        if bits not in self.modestrings:
+            self.modestrings[bits] = "".join(m for m, b in self.modebits.items() if bits & b)
+
+        return self.modestrings[bits]
+
+
+# --- helpers ---
+
+def toint(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,276 @@
+import collections
+import re
+import strings
+
+# NOTE: masks are nick!user@host patterns where "*" matches any run of characters and "?" any single one,
+# compared in the server's case mapping (RFC 1459 until the server says otherwise).
+
+WILDCARDS = re.compile(r"[*?]+")
+
+
+class MaskIndex(object):
+    # finds every mask matching a prefix without trying the masks one by one: the longest literal part of
+    # each mask (e.g. ".users.quakenet.org" in "*!*@*.users.quakenet.org") goes into an Aho-Corasick
+    # automaton, a single pass over the prefix finds the literal parts it contains, and only masks with one
+    # of those are verified with their compiled pattern. masks without any literal part are always verified
+    # the automaton is updated in place: adding a literal part links its new nodes and redirects the failure
+    # links of the existing nodes it is now the longest suffix of (found through the failure links in
+    # reverse), removing one prunes the nodes nothing else needs; both only touch the nodes concerned rather
+    # than rebuilding the whole automaton
+
+    def __init__(self, profile=None):
+        # with a server profile (see isupport.py) its case mapping is followed, also when it changes
+        self.profile = profile
+        self.table = self.casemapping()
+        self.clear()
+
+    def casemapping(self):
+        # not meant to be called directly
+        if self.profile is not None:
+            return self.profile.casemapping
+
+        return strings.casemappings[strings.DEFAULTCASEMAPPING]
+
+    def normalize(self, string):
+        return string.translate(self.table)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __contains__(self, mask):
+        self.checkcasemapping()
+        return self.normalize(mask) in self.masks
+
+    def __iter__(self):
+        return iter(list(self.originals.values()))
+
+    def get(self, mask, default=None):
+        # the value a mask was added with
+        self.checkcasemapping()
+        entry = self.masks.get(self.normalize(mask))
+        return entry[2] if entry else default
+
+    # --- changing ---
+
+    def add(self, mask, value=None):
+        self.checkcasemapping()
+        normalized = self.normalize(mask)
+        if normalized in self.masks:
+            self.remove(mask)
+
+        literal = max(WILDCARDS.split(normalized), key=len)
+        self.masks[normalized] = (compilemask(normalized), literal, value)
+        self.originals[normalized] = mask
+
+        if not literal:
+            self.unanchored.add(normalized)
+            return
+
+        if literal not in self.byliteral:
+            self.insert(literal)
+        self.byliteral[literal].add(normalized)
+
+    def remove(self, mask):
+        # returns whether the mask was in the index
+        self.checkcasemapping()
+        normalized = self.normalize(mask)
+        entry = self.masks.pop(normalized, None)
+        if entry is None:
+            return False
+
+        del self.originals[normalized]
+        literal = entry[1]
+        if not literal:
+            self.unanchored.discard(normalized)
+        else:
+            self.byliteral[literal].discard(normalized)
+            if not self.byliteral[literal]:
+                del self.byliteral[literal]
+                self.delete(literal)
+
+        return True
+
+    def clear(self):
+        self.masks = {}  # (pattern, literal part, value) per normalized mask
+        self.originals = {}  # masks as added, per normalized mask
+        self.byliteral = collections.defaultdict(set)  # normalized masks per literal part
+        self.unanchored = set()  # normalized masks without a literal part
+
+        # automaton, per node: transitions, failure link, nearest node with a literal part along the failure
+        # links, the literal part ending here (if any), parent, character from the parent, depth, and the
+        # nodes whose failure link points here. unused nodes are kept in free for reuse
+        self.goto = [{}]
+        self.fail = [0]
+        self.outlink = [0]
+        self.literal = [None]
+        self.parent = [0]
+        self.char = [""]
+        self.depth = [0]
+        self.failkids = [set()]
+        self.free = []
+
+    # --- automaton ---
+
+    def newnode(self, parent, c):
+        # not meant to be called directly
+        if self.free:
+            node = self.free.pop()
+            self.goto[node] = {}
+            self.literal[node] = None
+            self.parent[node] = parent
+            self.char[node] = c
+            self.depth[node] = self.depth[parent] + 1
+            self.failkids[node] = set()
+        else:
+            node = len(self.goto)
+            self.goto.append({})
+            self.fail.append(0)
+            self.outlink.append(0)
+            self.literal.append(None)
+            self.parent.append(parent)
+            self.char.append(c)
+            self.depth.append(self.depth[parent] + 1)
+            self.failkids.append(set())
+
+        self.goto[parent][c] = node
+        return node
+
+    def setfail(self, node, target):
+        # not meant to be called directly
+        self.failkids[self.fail[node]].discard(node)
+        self.fail[node] = target
+        self.failkids[target].add(node)
+
+    def insert(self, literal):
+        # not meant to be called directly
+        goto, fail, failkids = self.goto, self.fail, self.failkids
+        node = 0
+        changed = []
+        for c in literal:
+            following = goto[node].get(c)
+            if following is None:
+                following = self.newnode(node, c)
+
+                # the longest suffix in the trie, found the usual way as the parent's is known
+                state = fail[node]
+                while state and c not in goto[state]:
+                    state = fail[state]
+                target = goto[state].get(c, 0) if node else 0
+                fail[following] = target
+                failkids[target].add(following)
+                changed.append(following)
+
+                # existing nodes ending in the parent's string followed by c now have a longer suffix in the
+                # trie: the new node. they are c-children of the nodes whose failure links lead to the parent,
+                # where a node that has a c-child of its own already covers the nodes below it
+                stack = [k for k in failkids[node] if k != following]
+                while stack:
+                    other = stack.pop()
+                    child = goto[other].get(c)
+                    if child is None:
+                        stack.extend(failkids[other])
+                    elif child != following:
+                        failkids[fail[child]].discard(child)
+                        fail[child] = following
+                        failkids[following].add(child)
+                        changed.append(child)
+            node = following
+
+        self.literal[node] = literal
+        changed.sort(key=self.depth.__getitem__)
+        for changednode in changed:
+            self.linkoutput(changednode)
+        # nodes failing to the end of the literal part find it as their nearest output now
+        for kid in failkids[node]:
+            self.linkoutput(kid)
+
+    def delete(self, literal):
+        # not meant to be called directly
+        node = 0
+        for c in literal:
+            node = self.goto[node][c]
+
+        self.literal[node] = None
+        for kid in list(self.failkids[node]):
+            self.linkoutput(kid)
+
+        # prune nodes that lead nowhere, the nodes failing to them fail to their failure link instead (their
+        # longest suffix in the trie after the pruned one's)
+        while node and not self.goto[node] and self.literal[node] is None:
+            parent = self.parent[node]
+            del self.goto[parent][self.char[node]]
+            target = self.fail[node]
+            for kid in list(self.failkids[node]):
+                self.setfail(kid, target)
+            self.failkids[target].discard(node)
+            self.failkids[node] = set()
+            self.free.append(node)
+            node = parent
+
+    def linkoutput(self, node):
+        # not meant to be called directly
+        # the nearest node with a literal part along the failure links, for node and the nodes failing to it
+        # (those failing to it only change if its own link does)
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            target = self.fail[node]
+            outlink = target if self.literal[target] is not None else self.outlink[target]
+            if self.outlink[node] == outlink:
+                continue
+
+            self.outlink[node] = outlink
+            if self.literal[node] is None:
+                stack.extend(self.failkids[node])
+
+    def checkcasemapping(self):
+        # not meant to be called directly
+        table = self.casemapping()
+        if table is self.table:
+            return
+
+        entries = [(self.originals[n], self.masks[n][2]) for n in self.masks]
+        self.table = table
+        self.clear()
+        for mask, value in entries:
+            self.add(mask, value)
+
+    # --- matching ---
+
+    def match(self, prefix):
+        # the masks (as added) matching prefix, e.g. "nick!user@host"
+        self.checkcasemapping()
+
+        text = self.normalize(prefix)
+        candidates = set(self.unanchored)
+        goto, fail, outlink, literals, byliteral = self.goto, self.fail, self.outlink, self.literal, self.byliteral
+
+        node = 0
+        for c in text:
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+
+            state = node if literals[node] is not None else outlink[node]
+            while state:
+                candidates.update(byliteral[literals[state]])
+                state = outlink[state]
+
+        return [self.originals[n] for n in candidates if self.masks[n][0](text)]
+
+    def matches(self, prefix):
+        return bool(self.match(prefix))
+
+
+# --- helpers ---
+
+def compilemask(mask):
+    # a function telling whether a (normalized) string matches the (normalized) mask
+    pattern = "".join(".*" if c == "*" else "." if c == "?" else re.escape(c) for c in mask)
+    return re.compile(pattern, re.DOTALL).fullmatch
+
+
+def matchmask(mask, prefix, casemapping=strings.DEFAULTCASEMAPPING):
+    # a single match, for masks that are not worth an index
+    table = strings.casemappings[casemapping]
+    return compilemask(mask.translate(table))(prefix.translate(table)) is not None
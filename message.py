@@ -0,0 +1,159 @@
+import logging
+import strings
+
+# discard incomplete data beyond this size (lines are 512 bytes, plus up to 8191 bytes of tags)
+MAXBUFFER = 16384
+
+
+class LineFramer(object):
+    # splits received data into messages, accepting both "\r\n" and "\n" line endings
+    # data is appended to a single bytearray; all complete lines are decoded in one go (without copying
+    # them out of the buffer first), split, and parsed in a single loop (see parselines), after which the
+    # consumed bytes are dropped from the front of the buffer
+    # NOTE: the lines are still copied into str objects, which every handler needs anyway
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.scan = 0  # position from where to look for the last line ending
+
+    def reset(self):
+        self.buffer = bytearray()
+        self.scan = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def __iter__(self):
+        return iter(parselines(self.lines()))
+
+    def lines(self):
+        # the complete lines received so far, decoded but not parsed
+        buffer = self.buffer
+        end = buffer.rfind(b"\n", self.scan)
+
+        if end == -1:
+            # leave incomplete lines in buffer
+            if len(buffer) > MAXBUFFER:
+                logging.warning("Discarding {} bytes of unterminated data.".format(len(buffer)))
+                del buffer[:]
+
+            self.scan = len(buffer)
+            return []
+
+        with memoryview(buffer) as view, view[:end + 1] as encoded:
+            try:
+                text = str(encoded, "utf-8", "strict")
+            except UnicodeDecodeError:
+                # decode line by line, so one badly encoded line does not affect the others
+                lines = [strings.decode(encoded_line.rstrip(b"\r"))
+                         for encoded_line in bytes(encoded).split(b"\n")]
+            else:
+                lines = text.split("\r\n")
+                # as many line endings as lines means there are bare newlines as well
+                if text.count("\n") >= len(lines):
+                    lines = text.replace("\r\n", "\n").split("\n")
+
+        del buffer[:end + 1]
+        self.scan = len(buffer)
+
+        return lines
+
+
+class Message(object):
+    # a single line, split up in prefix, command and arguments; tags are only split up once they are read
+    # NOTE: made by parselines(), Message(line) does the same for a single line
+
+    __slots__ = ("line", "prefix", "command", "args", "_tags")
+
+    def __new__(cls, line):
+        return parselines((line,))[0]
+
+    def __str__(self):
+        return self.line
+
+    def __repr__(self):
+        return "Message({!r})".format(self.line)
+
+    @property
+    def tags(self):
+        try:
+            return self._tags
+        except AttributeError:
+            line = self.line
+            self._tags = parsetags(line[1:].partition(" ")[0]) if line[0] == "@" else {}
+            return self._tags
+
+
+def parselines(lines):
+    # Message objects for lines, skipping empty ones
+    # NOTE: this is the innermost loop of receiving, so messages are filled in here rather than by calling an
+    # __init__ for every line
+    messages = []
+    append = messages.append
+    new = object.__new__
+    for line in lines:
+        if not line:
+            continue
+
+        msg = new(Message)
+        msg.line = line
+
+        # [@tags ][:prefix ]COMMAND args, most lines start with a prefix and few have tags (which are left
+        # in the line until they are read)
+        if line[0] == ":":
+            msg.prefix, _, line = line[1:].partition(" ")
+        else:
+            if line[0] == "@":
+                line = line.partition(" ")[2].lstrip(" ")
+            if line[:1] == ":":
+                msg.prefix, _, line = line[1:].partition(" ")
+            else:
+                msg.prefix = ""
+
+        i = line.find(" :")
+        if i == -1:
+            args = line.split()
+        else:
+            args = line[:i].split()
+            args.append(line[i + 2:])
+
+        msg.command = args.pop(0) if args else ""
+        msg.args = args
+        append(msg)
+
+    return messages
+
+
+# --- helpers ---
+
+TAGESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+
+def parsetags(tagstring):
+    tags = {}
+    for tag in tagstring.split(";"):
+        if not tag:
+            continue
+
+        key, _, value = tag.partition("=")
+        if "\\" in value:
+            value = unescapetag(value)
+        tags[key] = value
+
+    return tags
+
+
+def unescapetag(value):
+    chars = []
+    i = 0
+    while i < len(value):
+        c = value[i]
+        if c == "\\":
+            i += 1
+            if i < len(value):
+                chars.append(TAGESCAPES.get(value[i], value[i]))
+        else:
+            chars.append(c)
+        i += 1
+
+    return "".join(chars)
@@ -0,0 +1,248 @@
+import outbound
+import strings
+
+# seconds during which mode changes for a channel are collected into as few MODE lines as possible
+MODEWINDOW = 0.2
+# seconds to wait for the server to confirm a change before giving up on it
+CONFIRMTIMEOUT = 30
+
+
+class ModeChange(object):
+    __slots__ = ("adding", "mode", "arg", "futures", "deadline")
+
+    def __init__(self, adding, mode, arg, future):
+        self.adding = adding
+        self.mode = mode
+        self.arg = arg
+        self.futures = [future]
+        self.deadline = None
+
+
+class ModeQueue(object):
+    # channel mode changes requested by remotes, gathered per channel for MODEWINDOW seconds and sent packed
+    # up to the server's MODES limit ("+ooo a b c")
+    # requested changes that cancel each other out (+o then -o) are not sent, neither are changes to prefix
+    # modes that are already in effect according to UserData. every change has a future that is set to True
+    # once the server echoes it (or if it was in effect already), and to False if it is not made
+
+    def __init__(self, userdata, send, tasks):
+        self.userdata = userdata
+        self.send = send
+        self.tasks = tasks
+        self.builder = outbound.LineBuilder(userdata)
+
+        self.pending = {}  # changes waiting to be sent per channel key, by (mode, argument key)
+        self.names = {}  # channel names per channel key, as requested
+        self.waiting = {}  # changes waiting to be confirmed per channel key, by (adding, mode, argument key)
+        self.flushing = False
+        self.expiring = False
+
+    def change(self, channelname, flags, args=None):
+        # returns a future set to True once all changes are in effect, False if any of them is not made
+        # handlers are given Channel and Nick objects, which are accepted in place of names
+        channelname = str(channelname)
+        args = modeargs(args)
+
+        key = self.userdata.key(channelname)
+        self.names[key] = channelname
+        pending = self.pending.setdefault(key, {})
+        waiting = self.waiting.get(key, {})
+
+        futures = []
+        for adding, mode, arg in strings.parsechannelmodes(flags, args, self.userdata.profile):
+            future = self.tasks.loop.create_future()
+            futures.append(future)
+
+            argkey = self.argkey(mode, arg)
+            slot = (mode, argkey)
+            queued = pending.get(slot)
+            if queued is not None and queued.adding != adding:
+                # cancel each other out, nothing changes
+                del pending[slot]
+                for f in queued.futures + [future]:
+                    f.set_result(False)
+            elif queued is not None:
+                queued.futures.append(future)
+            elif (adding, mode, argkey) in waiting:
+                # sent already, settled once the server echoes it
+                waiting[(adding, mode, argkey)].futures.append(future)
+            elif (not adding, mode, argkey) not in waiting and self.ineffect(key, adding, mode, arg, future):
+                # (UserData does not know yet about the opposite change that was sent, so it is not asked)
+                continue
+            else:
+                pending[slot] = ModeChange(adding, mode, arg, future)
+
+        if not pending:
+            del self.pending[key]
+        elif not self.flushing:
+            self.flushing = True
+            self.tasks.addtimer("_modequeue", MODEWINDOW, 1, self.flush)
+
+        return combine(self.tasks.loop, futures)
+
+    def argkey(self, mode, arg):
+        # nicks and masks are compared in the server's case mapping, keys and limits are not
+        profile = self.userdata.profile
+        if mode in profile.modebits or mode in profile.listmodes:
+            return self.userdata.key(arg)
+
+        return arg
+
+    def ineffect(self, key, adding, mode, arg, future):
+        # settles the future of a prefix mode change that would not change anything
+        modebits = self.userdata.profile.modebits
+        channel = self.userdata.channels.get(key)
+        if mode not in modebits or channel is None or channel._gettingnicks:
+            return False
+
+        nick = self.userdata.nicks.get(self.userdata.key(arg))
+        if nick not in channel.members:
+            # the server would refuse it
+            future.set_result(False)
+            return True
+
+        if bool(channel.members[nick] & modebits[mode]) == adding:
+            future.set_result(True)
+            return True
+
+        return False
+
+    def clear(self):
+        for changes in list(self.pending.values()) + list(self.waiting.values()):
+            for change in changes.values():
+                settle(change.futures, False)
+
+        self.pending = {}
+        self.waiting = {}
+
+    # --- sending ---
+
+    def flush(self):
+        self.flushing = False
+        deadline = self.tasks.loop.time() + CONFIRMTIMEOUT
+
+        for key, changes in self.pending.items():
+            name = self.names.get(key, key)
+            waiting = self.waiting.setdefault(key, {})
+            for line in self.modelines(name, list(changes.values())):
+                self.send(line)
+            for (mode, argkey), change in changes.items():
+                change.deadline = deadline
+                slot = (change.adding, mode, argkey)
+                if slot in waiting:
+                    waiting[slot].futures.extend(change.futures)
+                else:
+                    waiting[slot] = change
+
+        self.pending = {}
+        self.names = {}
+
+        if self.waiting and not self.expiring:
+            self.expiring = True
+            self.tasks.addtimer("_modeexpire", CONFIRMTIMEOUT, 1, self.expire)
+
+    def modelines(self, channelname, changes):
+        # "MODE #channel +oo-v a b c", at most MODES changes with an argument per line
+        maxmodes = self.userdata.profile.modes
+        room = outbound.MAXLINE - self.builder.prefixlength() - 2
+
+        lines = []
+        flags, args, sign = "", [], None
+        for change in changes:
+            extra = ("" if change.adding == sign else "+" if change.adding else "-") + change.mode
+            newargs = args + [change.arg] if change.arg else args
+            if flags and (len(newargs) > maxmodes or len(strings.encode(modeline(channelname, flags + extra,
+                                                                                  newargs))) > room):
+                lines.append(modeline(channelname, flags, args))
+                flags, args = "", []
+                extra = ("+" if change.adding else "-") + change.mode
+                newargs = [change.arg] if change.arg else []
+
+            flags += extra
+            args = newargs
+            sign = change.adding
+
+        if flags:
+            lines.append(modeline(channelname, flags, args))
+        return lines
+
+    # --- confirming ---
+
+    def confirm(self, key, adding, mode, arg):
+        # called by UserData for every mode change the server announces
+        waiting = self.waiting.get(key)
+        if not waiting:
+            return
+
+        change = waiting.pop((adding, mode, self.argkey(mode, arg)), None)
+        if change is not None:
+            settle(change.futures, True)
+        if not waiting:
+            del self.waiting[key]
+
+    def refuse(self, key):
+        # the server will not change modes on this channel (e.g. 482, not a channel operator)
+        for change in self.waiting.pop(key, {}).values():
+            settle(change.futures, False)
+
+    def expire(self):
+        self.expiring = False
+        now = self.tasks.loop.time()
+        for key in list(self.waiting):
+            waiting = self.waiting[key]
+            for slot in [s for s, c in waiting.items() if c.deadline <= now]:
+                settle(waiting.pop(slot).futures, False)
+            if not waiting:
+                del self.waiting[key]
+
+        if self.waiting:
+            self.expiring = True
+            delay = min(c.deadline for w in self.waiting.values() for c in w.values()) - now
+            self.tasks.addtimer("_modeexpire", max(delay, 0), 1, self.expire)
+
+
+# --- helpers ---
+
+def modeargs(args):
+    # a list of names from a space separated string, a Nick (or anything else with a name, like a limit), or
+    # a list of either
+    if args is None:
+        return None
+    if isinstance(args, str):
+        return args.split()
+
+    return outbound.targetnames(args)
+
+
+def modeline(channelname, flags, args):
+    return " ".join(["MODE", channelname, flags] + args)
+
+
+def settle(futures, result):
+    for future in futures:
+        if not future.done():
+            future.set_result(result)
+
+
+def combine(loop, futures):
+    # a future set to True once all futures are True, or to False as soon as one of them is not
+    combined = loop.create_future()
+    remaining = [len(futures)]
+
+    def done(future):
+        if combined.done():
+            return
+        if not future.result():
+            combined.set_result(False)
+            return
+
+        remaining[0] -= 1
+        if not remaining[0]:
+            combined.set_result(True)
+
+    if not futures:
+        combined.set_result(True)
+    for future in futures:
+        future.add_done_callback(done)
+
+    return combined
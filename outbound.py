@@ -0,0 +1,79 @@
+import strings
+
+# maximum line length, including "\r\n"
+MAXLINE = 512
+
+# assumed length of our nick before the server has told us what it is
+NICKLEN = 30
+
+# text is never split into pieces smaller than this many bytes, however long the targets are
+MINTEXT = 16
+
+
+class LineBuilder(object):
+    # builds messages that fit a line each, once the server has put our prefix (":nick!user@host ") in front
+    # of them for their recipients: text is split on spaces and UTF-8 character boundaries, and targets are
+    # packed into comma separated lists up to the server's TARGMAX
+    # until our own host has been seen (in a JOIN) the longest possible prefix is assumed
+
+    def __init__(self, userdata):
+        self.userdata = userdata
+
+    def prefixlength(self):
+        userdata = self.userdata
+        me = userdata.nicks.get(userdata.key(userdata.me)) if userdata.me else None
+        if me and "@" in me.host:
+            return len(strings.encode(me.host)) + 2
+
+        profile = userdata.profile
+        nicklen = len(strings.encode(userdata.me)) if userdata.me else min(profile.nicklen, NICKLEN)
+        # user names without ident get a "~" in front
+        return nicklen + 1 + profile.userlen + 1 + 1 + profile.hostlen + 2
+
+    def messages(self, command, targets, text, ctcp=None):
+        # lines sending text to targets (see targetnames); lines in text are sent separately, every piece is
+        # wrapped in a CTCP request if ctcp is given
+        targets = targetnames(targets)
+        head, tail = ("\001{} ".format(ctcp), "\001") if ctcp else ("", "")
+
+        # "COMMAND targets :text\r\n"
+        room = MAXLINE - self.prefixlength() - len(strings.encode(command + head + tail)) - 5
+        longest = max(len(strings.encode(t)) for t in targets)
+
+        # str.splitlines() would split on IRC formatting codes (\x1c-\x1e) as well
+        pieces = []
+        for line in text.replace("\r", "\n").split("\n"):
+            pieces.extend(p for p in strings.splittext(line, max(room - longest, MINTEXT)) if p)
+        if not pieces:
+            pieces = [""]
+
+        # as many targets per line as every piece leaves room for
+        size = max(len(strings.encode(p)) for p in pieces)
+        maxtargets = self.userdata.profile.maxtargets(command)
+        groups = []
+        group = []
+        length = 0
+        for target in targets:
+            extra = len(strings.encode(target)) + (1 if group else 0)
+            if group and (len(group) >= maxtargets or length + extra + size > room):
+                groups.append(group)
+                group = []
+                length = 0
+                extra -= 1
+
+            group.append(target)
+            length += extra
+        groups.append(group)
+
+        return ["{} {} :{}{}{}".format(command, ",".join(g), head, p, tail) for g in groups for p in pieces]
+
+
+# --- helpers ---
+
+def targetnames(targets):
+    # a list of names from a Nick or Channel object, a comma separated string, or any iterable of either
+    # Nick and Channel objects are not iterable, so only strings need telling apart
+    if isinstance(targets, str) or not hasattr(targets, "__iter__"):
+        return str(targets).split(",")
+
+    return [str(t) for t in targets]
@@ -0,0 +1,445 @@
+import collections
+import json
+import logging
+import sqlite3
+import time
+import executors
+import strings
+
+# default persistence settings
+DEFAULTS = {
+    # SQLite database file, None disables persistence (remote storage is then kept in memory)
+    "file": None,
+    # seconds between writing journaled changes to disk
+    "flushinterval": 5,
+    # remembered accounts older than this many seconds are looked up again instead of being trusted
+    "staleafter": 24 * 3600,
+    # nicks not seen for this many seconds are forgotten
+    "pruneafter": 30 * 24 * 3600,
+    # remote storage: values kept in memory, changes written without waiting for the flush interval, and
+    # the maximum size of a single (JSON encoded) value in bytes
+    "cachesize": 4096,
+    "batchsize": 512,
+    "maxvaluesize": 64 * 1024,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nicks (
+    key TEXT PRIMARY KEY, name TEXT, host TEXT, account TEXT, realname TEXT, seen REAL);
+CREATE TABLE IF NOT EXISTS variables (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS store (
+    namespace TEXT, key TEXT, value TEXT, PRIMARY KEY (namespace, key)) WITHOUT ROWID;
+"""
+
+# account column values; NULL is used for nicks known not to be authed
+UNKNOWN = ""
+
+# journal entry for a deleted value in remote storage
+DELETED = object()
+
+
+class Database(object):
+    # a SQLite database in WAL mode, only touched from a thread of its own so the event loop never waits for
+    # the disk; shared by the StateStore and RemoteStorage of a connection
+
+    def __init__(self, loop, path):
+        self.path = path
+        # sqlite connections belong to a single thread
+        self.pool = executors.ExecutorPool(loop, "persist", "thread", workers=1, queue=1024)
+        self.connection = None
+
+    def submit(self, function, *args, callback=None):
+        # runs function(connection, *args) on the database thread, returns a future for the result
+        return self.pool.submit(self.run, function, *args, callback=callback)
+
+    def run(self, function, *args):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(SCHEMA)
+
+        return function(self.connection, *args)
+
+    def drain(self):
+        # finishes all submitted work (also what has not been started yet) and accepts no more, after which
+        # run() can be used from the calling thread
+        self.pool.drain()
+
+    def close(self):
+        self.drain()
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+
+class StateStore(object):
+    # tracked nick details (hosts, accounts) and remote variables
+    # changes are journaled in memory, coalesced per nick or variable, and written in a single transaction
+    # every flush interval. on startup the database is read in the background and applied as it comes in
+
+    def __init__(self, loop, tasks, database, settings, scope=None, writenicks=True):
+        settings = dict(DEFAULTS, **settings)
+        self.loop = loop
+        self.tasks = tasks
+        self.database = database
+        # appended to variable names, for stores sharing a database without seeing each other's variables
+        self.scope = scope
+        # stores sharing a database and the same view of nicks leave writing them to one of them
+        self.writenicks = writenicks
+        self.flushinterval = settings["flushinterval"]
+        self.staleafter = settings["staleafter"]
+        self.pruneafter = settings["pruneafter"]
+
+        self.nickjournal = {}  # changed nick rows per key
+        self.variablejournal = {}  # changed variables, None for deleted ones
+        self.known = {}  # remembered nick rows per key, once loaded
+        self.loaded = False
+
+        self.userdata = None
+        self.variables = None
+
+    def attach(self, remoteset):
+        # has to happen before remotes are loaded, as they are handed the variables dict
+        self.userdata = remoteset.userdata
+        self.userdata.persistence = self
+        self.variables = remoteset.variables = JournaledDict(self)
+
+        self.database.submit(self._load, time.time(), callback=self.applyloaded)
+        self.tasks.addtimer("_persist", self.flushinterval, 0, self.flush)
+
+    # --- tracking ---
+
+    def nickchanged(self, key, nick):
+        if not self.writenicks:
+            return
+        self.nickjournal[key] = (nick.name, nick.host, nick.account, nick.realname, time.time())
+
+    def variablechanged(self, name, value):
+        if value is not None:
+            try:
+                value = json.dumps(value)
+            except (TypeError, ValueError) as e:
+                logging.warning("Variable {!r} can not be stored: {}".format(name, e))
+                return
+
+        self.variablejournal[name] = value
+
+    def recall(self, key, nick):
+        # fill in what is remembered about a nick that was just created
+        row = self.known.get(key)
+        if row is None:
+            return
+
+        name, host, account, realname, seen = row
+        # anyone can take a nick, so the account is only trusted for the same user@host; otherwise it is left
+        # unknown for the account tracker to look up
+        if (nick.account == UNKNOWN and account != UNKNOWN and time.time() - seen < self.staleafter and
+                nick.host and host and strings.getuserhost(nick.host) == strings.getuserhost(host)):
+            nick.account = account
+        if not nick.host:
+            nick.host = host
+        if not nick.realname:
+            nick.realname = realname
+
+    def applyloaded(self, loaded):
+        # not meant to be called directly
+        nicks, variables = loaded
+        self.known = nicks
+        self.loaded = True
+
+        for key, nick in self.userdata.nicks.items():
+            self.recall(key, nick)
+
+        # variables set since starting up take precedence
+        for name, value in variables.items():
+            if name not in self.variables and name not in self.variablejournal:
+                dict.__setitem__(self.variables, name, json.loads(value))
+
+        logging.info("Loaded {} nick(s) and {} variable(s) from {!r}.".format(
+            len(nicks), len(variables), self.database.path))
+
+    # --- writing ---
+
+    def flush(self):
+        if not self.nickjournal and not self.variablejournal:
+            return
+
+        nicks, self.nickjournal = self.nickjournal, {}
+        variables, self.variablejournal = self.variablejournal, {}
+        self.known.update(nicks)
+        self.database.submit(self._write, nicks, variables)
+
+    def close(self):
+        # writes out the journal and waits for it, for shutting down
+        nicks, self.nickjournal = self.nickjournal, {}
+        variables, self.variablejournal = self.variablejournal, {}
+        self.database.drain()
+
+        if nicks or variables:
+            self.database.run(self._write, nicks, variables)
+
+    # --- database thread ---
+
+    def _load(self, connection, now):
+        # not meant to be called directly
+        with connection:
+            connection.execute("DELETE FROM nicks WHERE seen < ?", (now - self.pruneafter,))
+
+        nicks = {row[0]: row[1:] for row in connection.execute(
+            "SELECT key, name, host, account, realname, seen FROM nicks")}
+        variables = dict(connection.execute("SELECT name, value FROM variables"))
+        if self.scope:
+            suffix = "@" + self.scope
+            variables = {n[:-len(suffix)]: v for n, v in variables.items() if n.endswith(suffix)}
+        return nicks, variables
+
+    def _write(self, connection, nicks, variables):
+        # not meant to be called directly
+        if self.scope:
+            variables = {"{}@{}".format(n, self.scope): v for n, v in variables.items()}
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO nicks VALUES (?, ?, ?, ?, ?, ?)",
+                                   [(key,) + row for key, row in nicks.items()])
+            connection.executemany("INSERT OR REPLACE INTO variables VALUES (?, ?)",
+                                   [(n, v) for n, v in variables.items() if v is not None])
+            connection.executemany("DELETE FROM variables WHERE name = ?",
+                                   [(n,) for n, v in variables.items() if v is None])
+
+
+class JournaledDict(dict):
+    # RemoteSet.variables, recording changes for the store
+    # NOTE: only assignments are noticed, a changed list or dict has to be assigned again to be stored
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def __setitem__(self, name, value):
+        super().__setitem__(name, value)
+        self.store.variablechanged(name, value)
+
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        self.store.variablechanged(name, None)
+
+    def pop(self, name, *default):
+        if name in self:
+            self.store.variablechanged(name, None)
+        return super().pop(name, *default)
+
+    def popitem(self):
+        name, value = super().popitem()
+        self.store.variablechanged(name, None)
+        return name, value
+
+    def setdefault(self, name, default=None):
+        if name not in self:
+            self[name] = default
+        return self[name]
+
+    def update(self, *args, **kwargs):
+        for name, value in dict(*args, **kwargs).items():
+            self[name] = value
+
+    def clear(self):
+        for name in list(self):
+            del self[name]
+
+
+class RemoteStorage(object):
+    # key/value storage for remotes, one namespace per remote (see Remote.store)
+    # values are JSON encoded. writes go to a journal and are committed together every flush interval, or
+    # as soon as batchsize changes are waiting; recently used values are kept in an LRU cache. a value is
+    # looked up in the journal, then in the changes being written, then in the cache, and only then read
+    # from the database (on its thread, hence get() and scan() being coroutines)
+
+    def __init__(self, loop, tasks, database, settings, scope=None):
+        settings = dict(DEFAULTS, **settings)
+        self.loop = loop
+        self.tasks = tasks
+        self.database = database
+        # appended to namespaces, for storages sharing a database without seeing each other's changes
+        self.scope = scope
+        self.cachesize = settings["cachesize"]
+        self.batchsize = settings["batchsize"]
+        self.maxvaluesize = settings["maxvaluesize"]
+
+        self.journal = {}  # changed values per (namespace, key), DELETED for deleted ones
+        self.writing = {}  # changes handed to the database thread, until written
+        self.cache = collections.OrderedDict()  # values per (namespace, key), least recently used first
+        self.namespaces = {}
+
+        self.tasks.addtimer("_storage", settings["flushinterval"], 0, self.flush)
+
+    def attach(self, remoteset):
+        remoteset.storage = self
+
+    def namespace(self, name):
+        if self.scope:
+            name = "{}@{}".format(name, self.scope)
+        if name not in self.namespaces:
+            self.namespaces[name] = Namespace(self, name)
+        return self.namespaces[name]
+
+    # --- values ---
+
+    def lookup(self, entry):
+        # (found, value) without reading the database; a deleted value is found as None
+        for changes in (self.journal, self.writing):
+            if entry in changes:
+                value = changes[entry]
+                return True, None if value is DELETED else value
+
+        if entry in self.cache:
+            self.cache.move_to_end(entry)
+            return True, self.cache[entry]
+
+        return False, None
+
+    def remember(self, entry, value):
+        # not meant to be called directly
+        self.cache[entry] = value
+        self.cache.move_to_end(entry)
+        while len(self.cache) > self.cachesize:
+            self.cache.popitem(last=False)
+
+    def change(self, entry, value):
+        if value is not DELETED:
+            if len(strings.encode(json.dumps(value))) > self.maxvaluesize:
+                raise ValueError("value for {!r} exceeds {} bytes".format(entry[1], self.maxvaluesize))
+            self.remember(entry, value)
+        else:
+            self.cache.pop(entry, None)
+
+        self.journal[entry] = value
+        if len(self.journal) >= self.batchsize:
+            self.flush()
+
+    async def load(self, entry):
+        value = await self.database.submit(self._read, entry)
+        # changed while it was being read
+        found, current = self.lookup(entry)
+        if found:
+            return current
+
+        if value is not None:
+            self.remember(entry, value)
+        return value
+
+    async def loadrange(self, namespace, prefix, limit):
+        rows = await self.database.submit(self._readrange, namespace, prefix)
+
+        values = dict(rows)
+        for changes in (self.writing, self.journal):
+            for (ns, key), value in changes.items():
+                if ns == namespace and key.startswith(prefix):
+                    if value is DELETED:
+                        values.pop(key, None)
+                    else:
+                        values[key] = value
+
+        items = sorted(values.items())
+        return items[:limit] if limit is not None else items
+
+    # --- writing ---
+
+    def flush(self):
+        if not self.journal:
+            return
+
+        changes, self.journal = self.journal, {}
+        self.writing.update(changes)
+        self.database.submit(self._write, changes).add_done_callback(lambda f: self.written(changes, f))
+
+    def written(self, changes, future):
+        # not meant to be called directly
+        failed = future.cancelled() or future.exception() is not None
+        if failed:
+            logging.warning("Could not write {} stored value(s), keeping them for the next flush: {!r}".format(
+                len(changes), None if future.cancelled() else future.exception()))
+
+        for entry, value in changes.items():
+            # unless changed again and handed over by a later flush
+            if entry in self.writing and self.writing[entry] is value:
+                del self.writing[entry]
+                # a failed change goes back to the journal, unless it was changed again since
+                if failed and entry not in self.journal:
+                    self.journal[entry] = value
+
+    def close(self):
+        # writes out the journal and waits for it, for shutting down
+        self.database.drain()
+
+        # changes handed to a flush are written again along with the journal, in case their write failed
+        changes = dict(self.writing)
+        changes.update(self.journal)
+        self.journal = {}
+        if changes:
+            self.database.run(self._write, changes)
+        self.writing = {}
+
+    # --- database thread ---
+
+    def _read(self, connection, entry):
+        # not meant to be called directly
+        row = connection.execute("SELECT value FROM store WHERE namespace = ? AND key = ?", entry).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _readrange(self, connection, namespace, prefix):
+        # not meant to be called directly
+        if prefix:
+            rows = connection.execute("SELECT key, value FROM store WHERE namespace = ? AND key >= ? AND key < ?",
+                                      (namespace, prefix, prefix + "\U0010ffff"))
+        else:
+            rows = connection.execute("SELECT key, value FROM store WHERE namespace = ?", (namespace,))
+
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def _write(self, connection, changes):
+        # not meant to be called directly
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO store VALUES (?, ?, ?)",
+                                   [e + (json.dumps(v),) for e, v in changes.items() if v is not DELETED])
+            connection.executemany("DELETE FROM store WHERE namespace = ? AND key = ?",
+                                   [e for e, v in changes.items() if v is DELETED])
+
+
+class Namespace(object):
+    # the storage of a single remote
+    # NOTE: like RemoteSet.variables, changing a stored list or dict in place does not store it, set it again
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+
+    async def get(self, key, default=None):
+        entry = (self.name, key)
+        found, value = self.storage.lookup(entry)
+        if not found:
+            value = await self.storage.load(entry)
+
+        return default if value is None else value
+
+    def set(self, key, value):
+        # None deletes the key
+        self.storage.change((self.name, key), DELETED if value is None else value)
+
+    def delete(self, key):
+        self.storage.change((self.name, key), DELETED)
+
+    async def incr(self, key, amount=1):
+        # returns the new value; concurrent increments of the same key are all counted
+        entry = (self.name, key)
+        found, value = self.storage.lookup(entry)
+        if not found:
+            await self.storage.load(entry)
+            found, value = self.storage.lookup(entry)
+
+        value = (value or 0) + amount
+        self.set(key, value)
+        return value
+
+    async def scan(self, prefix="", limit=None):
+        # sorted (key, value) pairs for keys starting with prefix
+        return await self.storage.loadrange(self.name, prefix, limit)
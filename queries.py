@@ -0,0 +1,324 @@
+import collections
+import strings
+
+# seconds results are kept for, and the amount of results kept
+QUERYTTL = 60
+CACHESIZE = 1024
+# delay in seconds during which requests are collected, so identical ones are sent once
+QUERYDELAY = 0.05
+# seconds to wait for a reply before giving up on a request
+QUERYTIMEOUT = 30
+# nicks per USERHOST command
+USERHOSTNICKS = 5
+# maximum line length, including "\r\n"
+MAXLINE = 512
+
+
+class QueryManager(object):
+    # WHOIS, WHO, USERHOST and ISON requests whose replies are routed back to the requester
+    # requests are collected for QUERYDELAY seconds; identical requests (also while one is waiting for its
+    # reply) share a single future, and results are cached for the TTL, up to cachesize results, so remotes
+    # asking about the same users cause a single query
+    # replies to WHO, USERHOST and ISON do not say what they answer; they are matched to requests in order
+    # and by the nicks or mask they mention. USERHOST and ISON lines remotes send through CommandSet are
+    # tracked in order along with ours (see watch()), so their replies, empty ones included, are not taken
+    # for replies to ours
+
+    def __init__(self, userdata, send, tasks):
+        self.userdata = userdata
+        self.send = send
+        self.tasks = tasks
+        self.ttl = QUERYTTL
+        self.cachesize = CACHESIZE
+
+        self.cache = collections.OrderedDict()  # (expiry, result) per (command, key), least recently used first
+        self.inflight = {}  # futures per (command, key), until their reply is in
+        self.queued = collections.OrderedDict()  # names per (command, key) waiting to be sent
+        self.deadlines = {}  # times at which requests are given up on, per (command, key)
+        # keys (WHO) or sets of keys asked about, in the order sent; frozensets for lines sent by remotes
+        self.sent = {"WHO": collections.deque(), "USERHOST": collections.deque(), "ISON": collections.deque()}
+        self.whoisresults = {}  # WHOIS results being filled in, per nick key
+        self.whorows = []  # WHO replies since the last end of WHO
+        self.flushing = False
+        self.expiring = False
+
+        # counters, see stats()
+        self.counters = collections.Counter()
+
+    def stats(self):
+        return dict(self.counters, cached=len(self.cache), inflight=len(self.inflight))
+
+    # --- queries ---
+
+    async def whois(self, nickname):
+        # a dict with nick, user, host, realname, channels, server, idle, account, away and operator (if the
+        # server tells), None if there is no such nick
+        return await self.request("WHOIS", nickname)
+
+    async def who(self, mask):
+        # a list of dicts with channel, user, host, server, nick, flags and realname, one per user
+        return await self.request("WHO", mask)
+
+    async def userhost(self, nicknames):
+        # "nick!user@host" per nick, None for nicks that are not online
+        futures = [(n, self.request("USERHOST", n)) for n in nicknames]
+        results = {}
+        for nickname, future in futures:
+            results[nickname] = await future
+
+        return results
+
+    async def ison(self, nicknames):
+        # the nicks that are online
+        futures = [(n, self.request("ISON", n)) for n in nicknames]
+        online = []
+        for nickname, future in futures:
+            if await future:
+                online.append(nickname)
+
+        return online
+
+    def request(self, command, name):
+        # returns a future for the result
+        entry = (command, self.userdata.key(name))
+        self.counters["requested"] += 1
+
+        cached = self.cache.get(entry)
+        if cached is not None and cached[0] > self.tasks.loop.time():
+            self.cache.move_to_end(entry)
+            self.counters["hits"] += 1
+            future = self.tasks.loop.create_future()
+            future.set_result(cached[1])
+            return future
+
+        if entry in self.inflight:
+            self.counters["merged"] += 1
+            return self.inflight[entry]
+
+        future = self.inflight[entry] = self.tasks.loop.create_future()
+        self.queued[entry] = name
+        if not self.flushing:
+            self.flushing = True
+            self.tasks.addtimer("_queries", QUERYDELAY, 1, self.flush)
+
+        return future
+
+    def forget(self, nickname):
+        # a nick changed or quit, what was known about it no longer holds
+        key = self.userdata.key(nickname)
+        for command in ("WHOIS", "USERHOST", "ISON"):
+            self.cache.pop((command, key), None)
+
+    def clear(self):
+        for future in self.inflight.values():
+            if not future.done():
+                future.set_result(None)
+
+        self.inflight = {}
+        self.queued.clear()
+        self.deadlines = {}
+        for sent in self.sent.values():
+            sent.clear()
+        self.whoisresults = {}
+        self.whorows = []
+
+    # --- sending ---
+
+    def watch(self, line):
+        # called for lines remotes send through CommandSet.raw()
+        command, _, rest = line.partition(" ")
+        command = command.upper()
+        if command in ("USERHOST", "ISON"):
+            self.sent[command].append(frozenset(self.userdata.key(n) for n in rest.replace(":", " ").split()))
+
+    def flush(self):
+        self.flushing = False
+        deadline = self.tasks.loop.time() + QUERYTIMEOUT
+
+        batches = {"USERHOST": [], "ISON": []}
+        for entry, name in self.queued.items():
+            command, key = entry
+            self.deadlines[entry] = deadline
+            if command == "WHOIS":
+                self.whoisresults[key] = {"nick": name, "channels": []}
+                self.sendquery("WHOIS {}".format(name))
+            elif command == "WHO":
+                self.sent["WHO"].append(key)
+                self.sendquery("WHO {}".format(name))
+            else:
+                batches[command].append((key, name))
+        self.queued.clear()
+
+        # several nicks per USERHOST and ISON command
+        for i in range(0, len(batches["USERHOST"]), USERHOSTNICKS):
+            batch = batches["USERHOST"][i:i + USERHOSTNICKS]
+            self.sent["USERHOST"].append({key for key, _ in batch})
+            self.sendquery("USERHOST {}".format(" ".join(name for _, name in batch)))
+
+        batch = []
+        for key, name in batches["ISON"]:
+            if batch and len(strings.encode("ISON {} {}\r\n".format(" ".join(n for _, n in batch), name))) > MAXLINE:
+                self.sent["ISON"].append({k for k, _ in batch})
+                self.sendquery("ISON {}".format(" ".join(n for _, n in batch)))
+                batch = []
+            batch.append((key, name))
+        if batch:
+            self.sent["ISON"].append({k for k, _ in batch})
+            self.sendquery("ISON {}".format(" ".join(n for _, n in batch)))
+
+        if not self.expiring:
+            self.expiring = True
+            self.tasks.addtimer("_queryexpire", QUERYTIMEOUT, 1, self.expire)
+
+    def sendquery(self, line):
+        # not meant to be called directly
+        self.counters["sent"] += 1
+        self.send(line)
+
+    def settle(self, command, key, result, cache=True):
+        # not meant to be called directly
+        entry = (command, key)
+        self.deadlines.pop(entry, None)
+        future = self.inflight.pop(entry, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+        if cache and self.ttl:
+            self.cache[entry] = (self.tasks.loop.time() + self.ttl, result)
+            self.cache.move_to_end(entry)
+            while len(self.cache) > self.cachesize:
+                self.cache.popitem(last=False)
+
+    def expire(self):
+        self.expiring = False
+        now = self.tasks.loop.time()
+        for entry in [e for e, d in self.deadlines.items() if d <= now]:
+            command, key = entry
+            self.whoisresults.pop(key, None)
+            sent = self.sent.get(command)
+            if sent:
+                for keys in list(sent):
+                    if keys == key or isinstance(keys, set) and key in keys:
+                        sent.remove(keys)
+            self.settle(command, key, None, cache=False)
+
+        if self.deadlines:
+            self.expiring = True
+            self.tasks.addtimer("_queryexpire", max(min(self.deadlines.values()) - now, 0), 1, self.expire)
+
+    # --- WHOIS replies ---
+
+    def handlewhoisuser(self, prefix, args):
+        # me nick user host * :realname
+        result = self.whoisresults.get(self.userdata.key(args[1]))
+        if result is not None and len(args) > 5:
+            result.update(nick=args[1], user=args[2], host=args[3], realname=args[5])
+
+    def handlewhoischannels(self, prefix, args):
+        # me nick :@#channel +#channel ...
+        result = self.whoisresults.get(self.userdata.key(args[1]))
+        if result is not None:
+            result["channels"].extend(args[-1].split())
+
+    def handleaway(self, prefix, args):
+        # me nick :away message
+        self.setfield(args, "away", 2)
+
+    def handlewhoisserver(self, prefix, args):
+        # me nick server :server info
+        self.setfield(args, "server", 2)
+
+    def handlewhoisidle(self, prefix, args):
+        # me nick seconds signon :seconds idle, signon time
+        if self.setfield(args, "idle", 2) and args[2].isdigit():
+            self.whoisresults[self.userdata.key(args[1])]["idle"] = int(args[2])
+
+    def handlewhoisaccount(self, prefix, args):
+        # me nick account :is authed as
+        if self.setfield(args, "account", 2):
+            # keep the account tracker up to date while at it
+            nick = self.userdata.nicks.get(self.userdata.key(args[1]))
+            if nick is not None:
+                self.userdata.accounts.setaccount(nick, args[2])
+
+    def setfield(self, args, field, index):
+        # not meant to be called directly
+        result = self.whoisresults.get(self.userdata.key(args[1]))
+        if result is None or len(args) <= index:
+            return False
+
+        result[field] = args[index]
+        return True
+
+    def handlewhoisoperator(self, prefix, args):
+        result = self.whoisresults.get(self.userdata.key(args[1]))
+        if result is not None:
+            result["operator"] = True
+
+    def handleendofwhois(self, prefix, args):
+        # me nick :End of /WHOIS list.
+        key = self.userdata.key(args[1])
+        if key in self.whoisresults:
+            self.settle("WHOIS", key, self.whoisresults.pop(key))
+
+    def handlenosuchnick(self, prefix, args):
+        # me nick :No such nick
+        key = self.userdata.key(args[1])
+        if key in self.whoisresults:
+            del self.whoisresults[key]
+            self.settle("WHOIS", key, None)
+
+    # --- WHO replies ---
+
+    def handlewho(self, prefix, args):
+        # me channel user host server nick flags :hopcount realname
+        if len(args) == 8 and self.sent["WHO"]:
+            self.whorows.append({
+                "channel": args[1], "user": args[2], "host": args[3], "server": args[4], "nick": args[5],
+                "flags": args[6], "realname": args[7].partition(" ")[2],
+            })
+
+    def handleendofwho(self, prefix, args):
+        # me mask :End of /WHO list.
+        rows, self.whorows = self.whorows, []
+        key = self.userdata.key(args[1]) if len(args) > 1 else ""
+        sent = self.sent["WHO"]
+        if key in sent:
+            sent.remove(key)
+            self.settle("WHO", key, rows)
+
+    # --- USERHOST and ISON replies ---
+
+    def handleuserhost(self, prefix, args):
+        # me :nick*=+user@host ... ("*" for operators, "-" instead of "+" for away users)
+        hosts = {}
+        for reply in args[-1].split():
+            nickname, _, userhost = reply.partition("=")
+            nickname = nickname.rstrip("*")
+            hosts[self.userdata.key(nickname)] = "{}!{}".format(nickname, userhost[1:])
+
+        keys = self.matchreply("USERHOST", hosts)
+        for key in keys or ():
+            self.settle("USERHOST", key, hosts.get(key))
+
+    def handleison(self, prefix, args):
+        # me :nick nick ...
+        online = {self.userdata.key(n) for n in args[-1].split()}
+        keys = self.matchreply("ISON", online)
+        for key in keys or ():
+            self.settle("ISON", key, key in online)
+
+    def matchreply(self, command, mentioned):
+        # not meant to be called directly
+        # the oldest request all mentioned nicks were asked about (the oldest one for an empty reply), None
+        # if that was sent by a remote. remotes' lines sent before it have been answered by now
+        sent = self.sent[command]
+        for i, keys in enumerate(sent):
+            if keys.issuperset(mentioned):
+                older = [k for k in list(sent)[:i] if isinstance(k, set)]
+                for _ in range(i + 1):
+                    sent.popleft()
+                sent.extendleft(reversed(older))
+                return keys if isinstance(keys, set) else None
+
+        return None
@@ -0,0 +1,83 @@
+import logging
+import random
+import socket
+
+# default reconnect settings: the delay after every server failed doubles from base up to cap seconds, and
+# a random part of it is taken so reconnecting bots do not all come back at once
+BASEDELAY = 2
+MAXDELAY = 300
+# seconds a registered session has to last for the delay to start from base again; a server that accepts
+# and then drops the connection is backed off from like one that refuses it
+STABLEAFTER = 60
+# seconds to wait for a connection to be made, before trying the next address
+CONNECTTIMEOUT = 30
+
+# seconds resolved addresses are used for, and for at most once none of them could be connected to
+DNSTTL = 3600
+FAILEDTTL = 60
+
+
+class Backoff(object):
+    def __init__(self, base=BASEDELAY, cap=MAXDELAY):
+        self.base = base
+        self.cap = cap
+        self.failed = 0
+
+    def reset(self):
+        self.failed = 0
+
+    def next(self):
+        # between half and all of the capped exponential delay
+        delay = min(self.cap, self.base * 2 ** self.failed)
+        self.failed += 1
+        return random.uniform(delay / 2, delay)
+
+
+class DNSCache(object):
+    # addresses per host and port, kept across connection attempts; if resolving fails later on, the
+    # addresses that were last known are used anyway
+
+    def __init__(self, loop, ttl=DNSTTL):
+        self.loop = loop
+        self.ttl = ttl
+        self.entries = {}  # (expiry, addresses) per (host, port)
+
+    async def resolve(self, host, port):
+        entry = self.entries.get((host, port))
+        if entry and entry[0] > self.loop.time():
+            return entry[1]
+
+        try:
+            infos = await self.loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            if entry:
+                logging.warning("Could not resolve {!r}, using known addresses: {}".format(host, e))
+                return entry[1]
+            raise
+
+        addresses = []
+        for info in infos:
+            address = info[4][:2]
+            if address not in addresses:
+                addresses.append(address)
+
+        self.entries[(host, port)] = (self.loop.time() + self.ttl, addresses)
+        return addresses
+
+    def expire(self, host, port, ttl=FAILEDTTL):
+        # the server may have moved, resolve it again soon (without doing so on every attempt)
+        entry = self.entries.get((host, port))
+        if entry:
+            self.entries[(host, port)] = (min(entry[0], self.loop.time() + ttl), entry[1])
+
+
+# --- helpers ---
+
+def serverlist(settings):
+    # the main server followed by its alternates, as (host, port)
+    servers = [(settings["server"], int(settings["port"]))]
+    for host, port in settings.get("servers", []):
+        if (host, int(port)) not in servers:
+            servers.append((host, int(port)))
+
+    return servers
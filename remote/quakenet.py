@@ -1,6 +1,5 @@
 import hashlib
 import hmac
-import random
 import handlers
 import remotes
 import strings
@@ -25,6 +24,8 @@ class Connect(remotes.Remote):
     def connecthandler(self):
         self.authwait = True
         self.cmd.timer("retryauth", AUTHDELAY, 0, self.retryauth)
+        # channels are only joined (again after reconnecting) once our host is hidden
+        self.cmd.holdrejoin()
         self.cmd.mode(self.id.me(), "+x")
         self.cmd.msg("q@cserve.quakenet.org", "CHALLENGE")
 
@@ -39,28 +40,39 @@ class Connect(remotes.Remote):
                 username = settings["authname"]
                 lcusername = self.id.irclower(username)
                 truncpassword = settings["password"][:10]
-                response = challengeauth(lcusername, truncpassword, words[1])
 
-                command = "CHALLENGEAUTH {} {} HMAC-SHA-256"
-                self.cmd.msg("q@cserve.quakenet.org", command.format(username, response))
+                def sendresponse(response):
+                    command = "CHALLENGEAUTH {} {} HMAC-SHA-256"
+                    self.cmd.msg("q@cserve.quakenet.org", command.format(username, response))
+
+                # hashing is done in the cpu pool, the response is sent from the event loop
+                self.cmd.bgprocess(challengeauth, lcusername, truncpassword, words[1], pool="cpu",
+                                   callback=sendresponse)
 
     @handlers.raw("396", "")
     def hiddenhosthandler(self, *args):
         if self.authwait:
             self.authwait = False
             self.cmd.timerdel("retryauth")
-            channels = settings["channels"]
-
-            if channels:
-                self.cmd.join(channels)
+            self.cmd.rejoin(settings["channels"])
 
 # --------------------------------------------------
 
 
 class Control(remotes.Remote):
+    @handlers.onload
+    def setuphandler(self):
+        # admins are hostmasks, or nicks (any user@host)
+        self.admins = self.id.maskindex()
+        for admin in settings["admins"]:
+            self.admins.add(admin if "!" in admin or "@" in admin else admin + "!*@*")
+
+    def isadmin(self, nick):
+        return self.admins.matches(nick.host or nick.name + "!@")
+
     @handlers.ontext("^:load", "")
     def loadhandler(self, nick, target, msg):
-        if nick.name in settings["admins"]:
+        if self.isadmin(nick):
             target = target if target.ischannel() else nick
 
             words = msg.split()
@@ -80,7 +92,7 @@ class Control(remotes.Remote):
 
     @handlers.ontext("^:unload", "")
     def unloadhandler(self, nick, target, msg):
-        if nick.name in settings["admins"]:
+        if self.isadmin(nick):
             target = target if target.ischannel() else nick
 
             words = msg.split()
@@ -98,81 +110,55 @@ class Control(remotes.Remote):
             else:
                 self.cmd.msg(target, "could not unload remotes")
 
+    @handlers.ontext("^:stats", "")
+    def statshandler(self, nick, target, msg):
+        if self.isadmin(nick):
+            target = target if target.ischannel() else nick
+
+            stats = self.id.stats()
+            words = msg.split()
+            if stats is None or len(words) > 2 or (len(words) == 2 and words[1] not in ["on", "off", "reset"]):
+                self.cmd.msg(target, "usage = :stats [on|off|reset]")
+                return
+
+            if len(words) == 2:
+                if words[1] == "on":
+                    stats.enable()
+                elif words[1] == "off":
+                    stats.disable()
+                else:
+                    stats.reset()
+                self.cmd.msg(target, "stats {}".format(words[1]))
+                return
+
+            if not stats.enabled:
+                self.cmd.msg(target, "stats are off, use :stats on")
+            for line in stats.report():
+                self.cmd.msg(target, line)
+
 
 # --------------------------------------------------
 
 
-# specify a maximum amount of targets to include in a WHO command
-# (note: It would be better to calculate the command length, but that would then also require combining
-# the optimal nicks etc. It is chosen to keep this simple.)
-MAXTARGETS = 20
 # delay in seconds between WHO commands on previously unauthed users
 WHODELAY = 60
 
 
 class Auths(remotes.Remote):
+    # account lookups themselves are done by userdata.AccountTracker, merged with those of other remotes
     @handlers.onload
     def loadhandler(self):
-        self.whoid = random.randint(1, 999)
-        self.whos = set()
-        self.unauthed = set()
-        self.timer = False
+        # QuakeNet does not notify us of users authing, so keep checking unauthed users
+        self.id.accounts().setrecheck(WHODELAY)
+
+    @handlers.onunload
+    def unloadhandler(self):
+        self.id.accounts().setrecheck(None)
 
     @handlers.onjoin("#")
     def joinhandler(self, nick, channel):
         if nick.isme():
-            self.who(channel)
-        elif not nick.account:
-            self.who(nick)
-
-    @handlers.raw("315", "")
-    def endofwhohandler(self, *args):
-        whoid = args[0].split(",")[-1]
-        self.whos.discard(whoid)
-
-        # start/stop timer as necessary
-        if self.unauthed and not self.timer:
-            self.timer = True
-            self.cmd.timer("authwho", WHODELAY, 0, self.checkunauthed)
-        elif not self.unauthed and self.timer:
-            self.timer = False
-            self.cmd.timerdel("authwho")
-
-    @handlers.raw("354", "")
-    def whohandler(self, *args):
-        if args[1] in self.whos:
-            username, host, nickname, account, realname = args[2:]
-            nick = self.id.nick(nickname)
-
-            nick.host = "{}!{}@{}".format(nickname, username, host)
-            nick.realname = realname
-
-            if account != "0":
-                nick.account = account
-            else:
-                nick.account = None
-                self.unauthed.add(nick)
-
-    def checkunauthed(self):
-        # see if efficient checks can be done using channels
-        for channel in self.id.channels():
-            if len(self.unauthed) < MAXTARGETS:
-                break
-
-            common = self.unauthed.intersection(channel.getnicks())
-            if len(common) >= MAXTARGETS:
-                self.unauthed.difference_update(common)
-                self.who(channel)
-
-        # WHO the remaining nicks in chunks
-        unauthed = list(self.unauthed)
-        for i in range(0, len(unauthed), MAXTARGETS):
-            nicks = unauthed[i:i + MAXTARGETS]
-            self.unauthed.difference_update(nicks)
-            self.who(",".join([n.name for n in nicks]))
-
-    def who(self, targets):
-        self.whos.add(str(self.whoid))
-        # returns (user name, host, nick, account name, real name)
-        self.cmd.who("{},{}".format(targets, self.whoid), "n%tuhnar,{}".format(self.whoid))
-        self.whoid = (self.whoid + 1) % 1000
+            self.id.accounts().lookupchannel(self.id.channel(channel))
+        elif nick.account == "":
+            # unknown, unlike None (known not to be authed, e.g. from extended-join)
+            self.id.accounts().lookup(nick)
@@ -1,9 +1,14 @@
+import asyncio
 import importlib
 import inspect
 import logging
+import time
 import commands
+import dispatch
 import identifiers
+import outbound
 import userdata
+from tasks import HandlerTasks
 
 MODULEPATH = "remote."
 
@@ -11,16 +16,25 @@ MODULEPATH = "remote."
 # NOTE: modules are the files remote classes reside in
 
 class RemoteSet(object):
-    def __init__(self, send, tasks):
+    def __init__(self, send, tasks, profile=None, stats=None, network=None):
         self.modules = {}  # used to keep track of loaded modules
         self.remotes = {}  # used to keep track of loaded remotes and handlers per remote
-        self.handlers = {}  # used to look up handlers for incoming commands
+        self.handlers = dispatch.HandlerIndex(stats)  # used to look up handlers for incoming commands
+        self.running = {}  # used to keep track of coroutines started by async handlers per remote
 
-        self.cmd = commands.CommandSet(send, tasks, self.loadremote, self.unloadremote)
+        self.tasks = tasks
+        self.stats = stats  # optional instrumentation (see stats.py)
+
+        self.userdata = userdata.UserData(profile, send, tasks)
+        builder = outbound.LineBuilder(self.userdata)
+        self.cmd = commands.CommandSet(send, tasks, self.loadremote, self.unloadremote, network, builder,
+                                       self.userdata.modequeue, self.userdata.rejoin, self.userdata.holdrejoin,
+                                       self.userdata.queries.watch)
         self.aliases = {}
         self.variables = {}
-        self.userdata = userdata.UserData()
-        self.id = identifiers.IdentifierSet(self.userdata)
+        self.storage = None  # key/value storage for remotes, see persist.RemoteStorage
+        self.floodfilter = None  # drops messages of flooders before dispatching, see floodfilter.py
+        self.id = identifiers.IdentifierSet(self.userdata, stats)
 
     def loadremote(self, modulename, remotenames=None):
         # allows for reloading too!
@@ -36,7 +50,7 @@ class RemoteSet(object):
             for cname in dir(module):
                 c = getattr(module, cname)
                 if inspect.isclass(c) and issubclass(c, Remote):  # could use isinstance() but avoiding confusion
-                    remote = c(self.cmd, self.id, self.aliases, self.variables)
+                    remote = self._newremote(modulename, cname, c)
                     self._loadhandlers(modulename, cname, remote)
                     loadedremotes.append(cname)
         else:
@@ -45,7 +59,7 @@ class RemoteSet(object):
                 if cname in dir(module):
                     c = getattr(module, cname)
                     if inspect.isclass(c) and issubclass(c, Remote):
-                        remote = c(self.cmd, self.id, self.aliases, self.variables)
+                        remote = self._newremote(modulename, cname, c)
                         self._loadhandlers(modulename, cname, remote)
                         loadedremotes.append(cname)
                         success = True
@@ -56,6 +70,15 @@ class RemoteSet(object):
 
         return loadedremotes
 
+    def _newremote(self, modulename, cname, c):
+        # not meant to be called directly
+        remote = c(self.cmd, self.id, self.aliases, self.variables)
+        # storage is namespaced per remote and outlives reloads
+        if self.storage:
+            remote.store = self.storage.namespace("{}.{}".format(modulename, cname))
+
+        return remote
+
     def _loadmodule(self, modulename):
         # not meant to be called directly
         if modulename not in self.modules:
@@ -82,6 +105,7 @@ class RemoteSet(object):
 
         # if handlers were previously loaded, unload them
         if remotename in self.remotes[modulename]:
+            self._canceltasks(modulename, remotename)
             self._removehandlersfromdict(modulename, remotename)
 
         handlers = {}
@@ -96,11 +120,8 @@ class RemoteSet(object):
                 else:
                     handlers[command].append(c)
 
-                # add handlers to handlers dict
-                if command not in self.handlers:
-                    self.handlers[command] = [c]
-                else:
-                    self.handlers[command].append(c)
+                # add handlers to handlers index
+                self.handlers.add(c)
 
         self.remotes[modulename][remotename] = handlers
 
@@ -154,6 +175,7 @@ class RemoteSet(object):
                     warning = "Could not process onunload handler for module {!r} / remote {!r}: {}"
                     logging.warning(warning.format(modulename, remotename, e))
 
+        self._canceltasks(modulename, remotename)
         self._removehandlersfromdict(modulename, remotename)
 
         # remove handlers from remotes dict
@@ -163,38 +185,107 @@ class RemoteSet(object):
     def _removehandlersfromdict(self, modulename, remotename):
         # not meant to be called directly
 
-        # remove handlers from handlers dict
+        # remove handlers from handlers index
         for command, handlers in self.remotes[modulename][remotename].items():
             for h in handlers:
-                self.handlers[command].remove(h)
+                self.handlers.remove(h)
+
+    def _canceltasks(self, modulename, remotename):
+        # not meant to be called directly
+        remotes = {h.__self__ for handlers in self.remotes[modulename][remotename].values() for h in handlers}
+        for remote in remotes:
+            running = self.running.pop(remote, None)
+            if running:
+                running.cancel()
 
-            if not self.handlers[command]:
-                del self.handlers[command]
+    def _runasync(self, handler, coroutine, args, handlerstats=None):
+        # not meant to be called directly
+        remote = handler.__self__
+        running = self.running.get(remote)
+        if running is None:
+            name = "module {!r} / remote {!r}".format(remote.__module__.split(".")[-1], remote.__class__.__name__)
+            running = self.running[remote] = HandlerTasks(self.tasks.loop, remote.maxtasks, name,
+                                                          remote.maxwaitingtasks, remote.taskpolicy)
+
+        # keep the order of handlers for the same target (e.g. replies to a channel)
+        key = self.userdata.key(args[0]) if args and getattr(handler, "ordered", False) else None
+        task = running.run(coroutine, key)
+        if task is None:
+            # rejected, too many are waiting already
+            return
+
+        # async handlers are timed from being started until they finish, including waiting for their turn
+        if handlerstats is not None:
+            start = time.perf_counter()
+            task.add_done_callback(lambda t: handlerstats.add(time.perf_counter() - start))
 
     def process(self, prefix, command, args):
+        # outstanding async handlers belong to the lost connection
+        if command == "_DISCONNECT":
+            for running in self.running.values():
+                running.cancel()
+
         self.userdata.process(prefix, command, args)
 
+        if self.floodfilter is not None and not self.floodfilter.allow(prefix, command, args):
+            return
+
+        # only handlers accepting the line are returned
+        rawhandlers, commandhandlers = self.handlers.lookup(command, args)
+
+        if self.stats is not None and self.stats.enabled:
+            self._processtimed(prefix, command, args, rawhandlers, commandhandlers)
+            return
+
         # raw handlers
-        if "_RAW" in self.handlers:
-            for h in self.handlers["_RAW"]:
-                try:
-                    h(prefix, command, args)
-                except Exception as e:
-                    # cannot obtain original function name because of decorators
-                    msg = "Could not process raw handler for command {!r} in module {!r} / remote {!r}: {}"
-                    logging.warning(msg.format(command, h.__self__.__module__.split(".")[-1],
-                                               h.__self__.__class__.__name__, e))
+        for h in rawhandlers:
+            try:
+                result = h(prefix, command, args)
+                # async handlers are run as tasks, without holding up the processing of other lines
+                if result is not None and asyncio.iscoroutine(result):
+                    self._runasync(h, result, args)
+            except Exception as e:
+                # cannot obtain original function name because of decorators
+                msg = "Could not process raw handler for command {!r} in module {!r} / remote {!r}: {}"
+                logging.warning(msg.format(command, h.__self__.__module__.split(".")[-1],
+                                           h.__self__.__class__.__name__, e))
 
         # command specific handlers
-        if command in self.handlers:
-            for h in self.handlers[command]:
-                try:
-                    h(prefix, command, args)
-                except Exception as e:
-                    # cannot obtain original function name because of decorators
-                    msg = "Could not process command handler for {!r} in module {!r} / remote {!r}: {}"
-                    logging.warning(msg.format(command, h.__self__.__module__.split(".")[-1],
-                                               h.__self__.__class__.__name__, e))
+        for h in commandhandlers:
+            try:
+                result = h(prefix, command, args)
+                if result is not None and asyncio.iscoroutine(result):
+                    self._runasync(h, result, args)
+            except Exception as e:
+                # cannot obtain original function name because of decorators
+                msg = "Could not process command handler for {!r} in module {!r} / remote {!r}: {}"
+                logging.warning(msg.format(command, h.__self__.__module__.split(".")[-1],
+                                           h.__self__.__class__.__name__, e))
+
+    def _processtimed(self, prefix, command, args, rawhandlers, commandhandlers):
+        # not meant to be called directly
+        # same as the handler loops in process(), recording calls, errors and execution times per handler
+        handlers = [(h, getattr(h, "numeric", None)) for h in rawhandlers]
+        handlers.extend((h, command) for h in commandhandlers)
+
+        for h, offered in handlers:
+            handlerstats = self.stats.handler(h, offered)
+            start = time.perf_counter()
+            try:
+                result = h(prefix, command, args)
+                if result is not None and asyncio.iscoroutine(result):
+                    self._runasync(h, result, args, handlerstats)
+                    continue
+            except Exception as e:
+                handlerstats.errors += 1
+                msg = "Could not process handler {!r} for command {!r}: {}"
+                logging.warning(msg.format(handlerstats.name, command, e))
+
+            handlerstats.add(time.perf_counter() - start)
+
+    def taskstats(self):
+        # counters of the async handlers per remote
+        return {running.name: running.stats() for running in self.running.values()}
 
     def signal(self, name, args):
         self.process("{}!".format(name), "_SIGNAL", args)
@@ -203,9 +294,18 @@ class RemoteSet(object):
 class Remote(object):
     # remote blueprint
 
+    # maximum amount of async handlers running at the same time
+    maxtasks = 8
+    # maximum amount of async handlers waiting for their turn (None for no limit), and what to do with more
+    # of them: executors.REJECT does not run the new one, executors.DROPOLDEST cancels the oldest waiting one
+    maxwaitingtasks = 256
+    taskpolicy = "reject"
+
     # not shadowing built-in name id
     def __init__(self, cmd, ids, aliases, variables):
         self.cmd = cmd
         self.id = ids
         self.aliases = aliases
         self.variables = variables
+        # key/value storage of this remote (see persist.Namespace), set once the remote is created
+        self.store = None
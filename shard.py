@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import multiprocessing
+import socket
+import sys
+import zlib
+import bot
+import isupport
+import message
+import persist
+import remotes
+import stats
+import strings
+import tasks
+from config.bot import settings as defaultsettings
+
+# NOTE: in sharded mode the connection process only frames and parses lines, and forwards them to worker
+# processes over Unix socket pairs, one line per frame:
+#   D<line>  -- update user data and dispatch to handlers
+#   S<line>  -- only update user data (every worker keeps the same view of channels and nicks)
+#   C<caps>  -- capabilities acknowledged by the server
+#   L<module> [remote1,remote2,...]  /  U<module> [remote1,remote2,...]  -- load / unload remotes
+# workers send back:
+#   P<priority or -> <line>  -- a line for the connection's (single, throttled) send scheduler
+#   L... / U...  -- remotes loaded or unloaded by a handler, repeated to the other workers
+
+# NOTE: every worker has remote storage of its own, in the same database file (if any) but under namespaces
+# of its own ("module.Class@shard<index>"): workers cache and journal values independently, so sharing
+# namespaces would lose updates. lines for a channel always go to the same worker, so do its values
+
+# NOTE: nicks and remote variables live in the workers, not in the connection process, so the workers persist
+# them (with a persist file set): every worker recalls remembered nicks, but as they all see the same nicks
+# only the first one writes them. variables are stored per worker, like remote storage ("name@shard<index>")
+
+# default amount of worker processes
+WORKERS = 2
+
+# commands dispatched in every worker, instead of in the one the line is sharded to
+EVERYWHERE = ("_DISCONNECT",)
+
+
+class ShardRouter(object):
+    # stands in for the RemoteSet of the connection: state changing lines go to every worker, but each
+    # line is dispatched by a single worker, chosen by its target, so replies to a channel or user stay
+    # in order and handlers run once
+
+    def __init__(self, remoteset, workers):
+        self.userdata = remoteset.userdata
+        self.floodfilter = remoteset.floodfilter
+        self.statecommands = frozenset(self.userdata.handlers)
+        self.workers = []  # StreamWriters per worker, see attach()
+        self.pending = [[] for _ in range(workers)]  # frames for workers that are not attached yet
+
+    def attach(self, writers):
+        self.workers = writers
+        for writer, frames in zip(writers, self.pending):
+            writer.writelines(frames)
+        self.pending = None
+
+    def write(self, index, frame):
+        if self.pending is not None:
+            self.pending[index].append(encodeframe(frame))
+        else:
+            self.workers[index].write(encodeframe(frame))
+
+    def process(self, prefix, command, args):
+        # the connection itself only tracks our nick and the server's protocol details
+        if command in ("001", "005"):
+            self.userdata.process(prefix, command, args)
+
+        # messages of flooders are not even forwarded
+        if self.floodfilter is not None and command not in self.statecommands and \
+                not self.floodfilter.allow(prefix, command, args):
+            return
+
+        line = joinline(prefix, command, args)
+        if command in EVERYWHERE:
+            self.broadcast("D" + line)
+            return
+
+        shard = self.shard(prefix, args)
+        if command in self.statecommands:
+            for i in range(self.count()):
+                self.write(i, ("D" if i == shard else "S") + line)
+        else:
+            self.write(shard, "D" + line)
+
+    def shard(self, prefix, args):
+        # by channel, or by the user talking to us, so a conversation is handled by one worker
+        target = args[0] if args else ""
+        if not self.userdata.profile.ischannel(target) and "!" in prefix:
+            target = strings.getnick(prefix)
+
+        # a stable hash (str hashes differ per run), so values workers store stay with their channel
+        return zlib.crc32(strings.encode(self.userdata.key(target))) % self.count()
+
+    def count(self):
+        return len(self.pending) if self.pending is not None else len(self.workers)
+
+    def broadcast(self, frame, skip=None):
+        for i in range(self.count()):
+            if i != skip:
+                self.write(i, frame)
+
+    def loadremote(self, modulename, remotenames=None):
+        self.broadcast("L" + joinremotes(modulename, remotenames))
+
+    def unloadremote(self, modulename, remotenames=None):
+        self.broadcast("U" + joinremotes(modulename, remotenames))
+
+
+class ShardedBot(bot.Bot):
+    # the connection process: receives and sends for all workers
+    keepsstate = False
+
+    def __init__(self, loop, settings, sockets):
+        super().__init__(loop, settings)
+        self.sockets = sockets
+        self.remoteset = ShardRouter(self.remoteset, len(sockets))
+
+    async def startworkers(self):
+        writers = []
+        for i, sock in enumerate(self.sockets):
+            reader, writer = await asyncio.open_connection(sock=sock)
+            writers.append(writer)
+            asyncio.ensure_future(self.readworker(i, reader))
+
+        self.remoteset.attach(writers)
+
+    async def readworker(self, index, reader):
+        while True:
+            frame = await reader.readline()
+            if not frame:
+                logging.warning("Lost worker {}.".format(index))
+                return
+
+            frame = decodeframe(frame)
+            kind, rest = frame[0], frame[1:]
+            if kind == "P":
+                priority, _, line = rest.partition(" ")
+                self.send(line, None if priority == "-" else int(priority))
+            elif kind in "LU":
+                self.remoteset.broadcast(frame, skip=index)
+
+    def negotiate_caps(self, args):
+        super().negotiate_caps(args)
+        if args[1] == "ACK":
+            self.remoteset.broadcast("C" + args[-1])
+
+    async def mainloop(self):
+        await self.startworkers()
+        await super().mainloop()
+
+    def close(self):
+        super().close()
+        for sock in self.sockets:
+            sock.close()
+
+
+class Worker(object):
+    # a worker process: runs the remotes on its share of the lines
+
+    def __init__(self, loop, index, settings, reader, writer):
+        self.loop = loop
+        self.index = index
+        self.reader = reader
+        self.writer = writer
+
+        self.tasks = tasks.TaskSet(loop, pools=settings.get("executors"))
+        self.profile = isupport.ServerProfile()
+        self.stats = stats.Stats(settings.get("stats"))
+        self.remoteset = remotes.RemoteSet(self.send, self.tasks, self.profile, self.stats)
+        # every worker sees the end of the MOTD, only one of them joins the channels again
+        self.remoteset.userdata.autorejoin = settings.get("rejoin", True) and index == 0
+
+        # remotes loaded by a handler are loaded in the other workers too
+        cmd = self.remoteset.cmd
+        cmd.loadcommand = self.loadremote
+        cmd.unloadcommand = self.unloadremote
+
+        # nicks, variables and remote storage, see the notes above
+        persistsettings = settings.get("persist") or {}
+        self.database = persist.Database(loop, persistsettings.get("file") or ":memory:")
+        self.persistence = None
+        if persistsettings.get("file"):
+            self.persistence = persist.StateStore(loop, self.tasks, self.database, persistsettings,
+                                                  "shard{}".format(index), writenicks=index == 0)
+            self.persistence.attach(self.remoteset)
+        self.storage = persist.RemoteStorage(loop, self.tasks, self.database, persistsettings,
+                                             "shard{}".format(index))
+        self.storage.attach(self.remoteset)
+
+    def send(self, line, priority=None):
+        self.writer.write(encodeframe("P{} {}".format("-" if priority is None else priority, line)))
+
+    def loadremote(self, modulename, remotenames=None):
+        self.writer.write(encodeframe("L" + joinremotes(modulename, remotenames)))
+        return self.remoteset.loadremote(modulename, remotenames)
+
+    def unloadremote(self, modulename, remotenames=None):
+        self.writer.write(encodeframe("U" + joinremotes(modulename, remotenames)))
+        return self.remoteset.unloadremote(modulename, remotenames)
+
+    async def run(self):
+        while True:
+            frame = await self.reader.readline()
+            if not frame:
+                break
+
+            frame = decodeframe(frame)
+            kind, rest = frame[0], frame[1:]
+            if kind in "DS":
+                msg = message.Message(rest)
+                if kind == "D":
+                    self.remoteset.process(msg.prefix, msg.command, msg.args)
+                else:
+                    self.remoteset.userdata.process(msg.prefix, msg.command, msg.args)
+            elif kind == "C":
+                self.profile.caps.update(rest.split())
+            elif kind in "LU":
+                modulename, _, remotenames = rest.partition(" ")
+                remotenames = remotenames.split(",") if remotenames else None
+                if kind == "L":
+                    self.remoteset.loadremote(modulename, remotenames)
+                else:
+                    self.remoteset.unloadremote(modulename, remotenames)
+
+            if self.writer.transport.get_write_buffer_size() > bot.WRITE_HIGH:
+                await self.writer.drain()
+
+        if self.persistence:
+            self.persistence.close()
+        self.storage.close()
+        self.database.close()
+        self.tasks.executors.shutdown()
+
+
+def runworker(index, settings, sock, inherited):
+    # sockets of earlier workers are inherited too, they would keep those workers from seeing the connection
+    # process go away
+    for other in inherited:
+        other.close()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def main():
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await Worker(loop, index, settings, reader, writer).run()
+
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+
+# --- helpers ---
+
+def joinline(prefix, command, args):
+    # a parsed line put back together, without tags
+    parts = [":" + prefix] if prefix else []
+    parts.append(command)
+    if args:
+        parts.extend(args[:-1])
+        last = args[-1]
+        parts.append(":" + last if not last or " " in last or last[0] == ":" else last)
+
+    return " ".join(parts)
+
+
+def joinremotes(modulename, remotenames):
+    return modulename + (" " + ",".join(remotenames) if remotenames else "")
+
+
+def encodeframe(frame):
+    return (frame + "\n").encode("utf-8", "surrogateescape")
+
+
+def decodeframe(frame):
+    return frame.decode("utf-8", "surrogateescape").rstrip("\n")
+
+
+def startworkers(settings, workers=WORKERS):
+    # worker processes are started before the connection's event loop, returns the connection's sockets
+    sockets = []
+    for i in range(workers):
+        parent, child = socket.socketpair()
+        process = multiprocessing.Process(target=runworker, args=(i, settings, child, list(sockets)), daemon=True)
+        process.start()
+        child.close()
+        sockets.append(parent)
+
+    return sockets
+
+
+def runsharded(settings, workers=WORKERS):
+    sockets = startworkers(settings, workers)
+
+    loop = asyncio.get_event_loop()
+    b = ShardedBot(loop, settings, sockets)
+    b.loadmodules()
+
+    try:
+        loop.run_until_complete(b.mainloop())
+    finally:
+        b.close()
+        loop.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    runsharded(defaultsettings, int(sys.argv[1]) if len(sys.argv) > 1 else WORKERS)
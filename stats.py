@@ -0,0 +1,224 @@
+import json
+import logging
+import time
+
+# default instrumentation settings
+DEFAULTS = {
+    "enabled": False,
+    # file snapshots are appended to as JSON lines, None to disable
+    "dumpfile": None,
+    "dumpinterval": 60,
+}
+
+# size of the ring of recent timings kept per handler and command, used for percentiles
+SAMPLES = 512
+
+
+class Samples(object):
+    # fixed size ring of recent values, so recording is O(1) and memory does not grow
+
+    __slots__ = ("values", "index", "full")
+
+    def __init__(self, size=SAMPLES):
+        self.values = [0.0] * size
+        self.index = 0
+        self.full = False
+
+    def add(self, value):
+        self.values[self.index] = value
+        self.index += 1
+        if self.index == len(self.values):
+            self.index = 0
+            self.full = True
+
+    def percentile(self, p):
+        values = self.values if self.full else self.values[:self.index]
+        if not values:
+            return 0.0
+
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class HandlerStats(object):
+    __slots__ = ("name", "command", "calls", "errors", "time", "samples")
+
+    def __init__(self, name, command):
+        self.name = name
+        self.command = command  # command whose lines the handler is offered (None for all lines)
+        self.calls = 0
+        self.errors = 0
+        self.time = 0.0
+        self.samples = Samples()
+
+    def add(self, seconds):
+        self.calls += 1
+        self.time += seconds
+        self.samples.add(seconds)
+
+
+class CommandStats(object):
+    __slots__ = ("lines", "parsetime", "dispatchtime", "samples")
+
+    def __init__(self):
+        self.lines = 0
+        self.parsetime = 0.0
+        self.dispatchtime = 0.0
+        self.samples = Samples()
+
+    def add(self, parsetime, dispatchtime):
+        self.lines += 1
+        self.parsetime += parsetime
+        self.dispatchtime += dispatchtime
+        self.samples.add(dispatchtime)
+
+
+class Stats(object):
+    # optional instrumentation of the receive and send paths; while disabled nothing is recorded, so the
+    # only cost is checking the enabled flag once per line
+    # counters are plain attributes updated in place, exporting (snapshot) does the summarising
+
+    def __init__(self, settings=None):
+        settings = dict(DEFAULTS, **(settings or {}))
+        self.enabled = settings["enabled"]
+        self.dumpfile = settings["dumpfile"]
+        self.dumpinterval = settings["dumpinterval"]
+
+        self.handlers = {}  # HandlerStats per handler
+        self.commands = {}  # CommandStats per command
+        self.framing = 0.0  # seconds spent splitting received data into lines
+        self.sources = {}  # functions returning counters kept elsewhere, e.g. by the send scheduler
+        self.started = time.time()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        # handlers stay registered, only their counters start over
+        self.handlers = {key: HandlerStats(h.name, h.command) for key, h in self.handlers.items()}
+        self.commands = {}
+        self.framing = 0.0
+        self.started = time.time()
+
+    def watch(self, name, source):
+        self.sources[name] = source
+
+    # --- recording ---
+
+    def handler(self, h, command):
+        # returns the HandlerStats of a (bound) handler offered the lines of command (None for all lines)
+        key = handlerkey(h)
+        stats = self.handlers.get(key)
+        if stats is None:
+            stats = self.handlers[key] = HandlerStats(handlername(h), command)
+
+        return stats
+
+    def forget(self, h):
+        # an unloaded handler is no longer offered lines
+        self.handlers.pop(handlerkey(h), None)
+
+    def command(self, command, parsetime, dispatchtime):
+        stats = self.commands.get(command)
+        if stats is None:
+            stats = self.commands[command] = CommandStats()
+
+        stats.add(parsetime, dispatchtime)
+
+    # --- exporting ---
+
+    def snapshot(self):
+        lines = sum(c.lines for c in self.commands.values())
+
+        handlers = {}
+        for h in self.handlers.values():
+            # a handler is offered every line of its command, the ones it was not called for were rejected
+            offered = lines if h.command is None else self.commands[h.command].lines if \
+                h.command in self.commands else h.calls
+            handlers[h.name] = {
+                "calls": h.calls,
+                "rejected": max(offered - h.calls, 0),
+                "errors": h.errors,
+                "time": h.time,
+                "p99": h.samples.percentile(99),
+            }
+
+        commands = {}
+        for command, c in self.commands.items():
+            commands[command] = {
+                "lines": c.lines,
+                "parsetime": c.parsetime,
+                "dispatchtime": c.dispatchtime,
+                "p99": c.samples.percentile(99),
+            }
+
+        snapshot = {
+            "time": time.time(),
+            "since": self.started,
+            "enabled": self.enabled,
+            "lines": lines,
+            "framing": self.framing,
+            "handlers": handlers,
+            "commands": commands,
+        }
+
+        for name, source in self.sources.items():
+            try:
+                snapshot[name] = source()
+            except Exception as e:
+                logging.warning("Could not collect stats from {!r}: {}".format(name, e))
+
+        return snapshot
+
+    def report(self, top=5):
+        # short summary lines, e.g. for replying to an admin
+        snapshot = self.snapshot()
+        elapsed = max(snapshot["time"] - snapshot["since"], 1e-9)
+        report = ["{} lines in {:.0f} s ({:.1f}/s), {} handler(s) seen".format(
+            snapshot["lines"], elapsed, snapshot["lines"] / elapsed, len(snapshot["handlers"]))]
+
+        ranked = sorted(snapshot["handlers"].items(), key=lambda item: item[1]["time"], reverse=True)
+        for name, h in ranked[:top]:
+            line = "{}: {} calls, {} rejected, {} errors, {:.1f} ms total, p99 {:.2f} ms"
+            report.append(line.format(name, h["calls"], h["rejected"], h["errors"], h["time"] * 1000,
+                                      h["p99"] * 1000))
+
+        if "send" in snapshot:
+            send = snapshot["send"]
+            line = "send queue: {} queued (max {}), {} sent, throttled {} times for {:.1f} s"
+            report.append(line.format(send["queued"], send["maxqueued"], send["sent"], send["throttles"],
+                                      send["throttled"]))
+
+        return report
+
+    def start(self, tasks):
+        # periodically append snapshots to the dump file
+        if self.dumpfile:
+            tasks.addtimer("_statsdump", self.dumpinterval, 0, lambda: self.dump(tasks))
+
+    def dump(self, tasks):
+        # the snapshot is taken on the event loop, writing it is left to the io pool
+        if self.enabled:
+            tasks.dobgprocess(appendline, self.dumpfile, json.dumps(self.snapshot()))
+
+
+# --- helpers ---
+
+def handlerkey(h):
+    # the index calls the body of decorated handlers directly, which is keyed the same as the handler itself
+    return h.__self__, getattr(h.__func__, "dispatch", h.__func__)
+
+
+def handlername(h):
+    # module / remote / function, the decorators in handlers.py keep the original function name
+    remote = h.__self__
+    return "{}.{}.{}".format(remote.__module__.split(".")[-1], remote.__class__.__name__,
+                             getattr(h, "handlername", h.__name__))
+
+
+def appendline(path, line):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
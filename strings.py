@@ -1,17 +1,17 @@
-import re
 import logging
 
 
 # text decoding / encoding
 
 def decode(line):
+    # accepts bytes or any other buffer (e.g. a memoryview) without copying it first
     # try utf-8
     try:
-        return line.decode("utf-8", "strict")
+        return str(line, "utf-8", "strict")
     except UnicodeDecodeError:
         # try iso-8859-1
         try:
-            return line.decode("iso-8859-1", "strict")
+            return str(line, "iso-8859-1", "strict")
         except UnicodeDecodeError:
             logging.warning("Could not decode line.")
             return None
@@ -22,46 +22,88 @@ def encode(line):
     return line.encode("utf-8")
 
 
+def splittext(text, size):
+    # splits text into pieces of at most size bytes once encoded, at the last space that fits unless that
+    # would leave a piece less than half full, and never inside a UTF-8 encoded character; returns the
+    # pieces as strings
+    data = encode(text)
+    pieces = []
+    while len(data) > size:
+        cut = data.rfind(b" ", size // 2, size + 1)
+        if cut > 0:
+            pieces.append(data[:cut])
+            data = data[cut + 1:]
+            continue
+
+        # back off to the start of the character that does not fit
+        cut = size
+        while cut > 0 and data[cut] & 0xc0 == 0x80:
+            cut -= 1
+        if cut == 0:
+            # a single character larger than size, only possible for tiny sizes
+            cut = size
+        pieces.append(data[:cut])
+        data = data[cut:]
+
+    pieces.append(data)
+    return [piece.decode("utf-8") for piece in pieces]
+
+
 # hostmask conversion
 
 def getnick(prefix):
     return prefix.split("!")[0]
 
 
+def getuserhost(prefix):
+    return prefix.split("!", 1)[-1]
+
+
 # sting recognition
 
+# only look at the first and last characters, these are called for every message and notice
+
 def isaction(msg):
-    return re.match("^\\001ACTION.*\\001$", msg)
+    return len(msg) > 7 and msg[-1] == "\001" and msg.startswith("\001ACTION")
 
 
 def isctcp(msg):
-    return re.match("^\\001.*\\001$", msg)
+    return len(msg) > 1 and msg[0] == "\001" and msg[-1] == "\001"
 
 
-def ischannel(name):
-    channelprefixes = "#&"
-    return name[0] in channelprefixes
+def ischannel(name, chantypes="#&"):
+    return name[:1] in chantypes
 
 
 # mode parsing
 
-def parsechannelmodes(modestring, args=None):
-    argmodes = "abhkloqv"
-    signs = {"+": "add", "-": "remove"}
+# modes taking an argument when set / unset, used when no server profile (see isupport.py) is given
+SETARGMODES = frozenset("abhkloqv")
+UNSETARGMODES = frozenset("abhkoqv")
+
+
+def parsechannelmodes(modestring, args=None, profile=None):
+    # returns a list of (adding, mode, argument) tuples, in order
+    setargmodes = profile.setargmodes if profile else SETARGMODES
+    unsetargmodes = profile.unsetargmodes if profile else UNSETARGMODES
 
     # avoid a mutable default argument
     if not args:
         args = []
 
-    sign = ""
-    modechanges = {"add": {}, "remove": {}}
+    adding = True
+    i = 0
+    modechanges = []
     for c in modestring:
-        if c in signs:
-            sign = signs[c]
-        elif c in argmodes and not (sign == "remove" and c == "l"):
-            modechanges[sign][c] = args.pop(0)
+        if c == "+":
+            adding = True
+        elif c == "-":
+            adding = False
+        elif c in (setargmodes if adding else unsetargmodes):
+            modechanges.append((adding, c, args[i] if i < len(args) else ""))
+            i += 1
         else:
-            modechanges[sign][c] = ""
+            modechanges.append((adding, c, ""))
 
     return modechanges
 
@@ -82,12 +124,25 @@ def parseusermodes(modestring):
 
 # string to lower
 
+# case mappings by value of the CASEMAPPING token, see https://modern.ircdocs.horse/#casemapping-parameter
+UPPERCASE = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+LOWERCASE = "abcdefghijklmnopqrstuvwxyz"
+casemappings = {
+    "ascii": str.maketrans(UPPERCASE, LOWERCASE),
+    "strict-rfc1459": str.maketrans(UPPERCASE + "[]\\", LOWERCASE + "{}|"),
+    # maps the same way as irclower() below, so keys from either agree
+    "rfc1459": str.maketrans(UPPERCASE + "[]\\^", LOWERCASE + "{}|~"),
+}
+DEFAULTCASEMAPPING = "rfc1459"
+
+
+def casefold(string, casemapping=DEFAULTCASEMAPPING):
+    return string.translate(casemappings[casemapping])
+
+
 # based on http://script.quakenet.org/wiki/ChallengeAuth
-def irclower(string):
-    string = string.lower()
+IRCLOWER = str.maketrans("[]\\^", "{}|~")
 
-    symrep = {"[": "{", "]": "}", "\\": "|", "^": "~"}
-    for char, rep in symrep.items():
-        string = string.replace(char, rep)
 
-    return string
+def irclower(string):
+    return string.lower().translate(IRCLOWER)
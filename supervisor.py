@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import bot
+import executors
+import wirelog
+from config.bot import bots as defaultbots
+
+
+class Supervisor(object):
+    # runs several connections (to different networks, or clones on one network) in a single event loop
+    # every connection has its own remotes and user data; remote modules are only imported once, and the
+    # executor pools and the wire log writer are shared, so a connection costs little more than its state
+
+    def __init__(self, loop, settings):
+        # shared resources are set up from the settings of the first connection
+        self.loop = loop
+        self.bots = {}  # per name, in order of adding
+
+        self.executors = executors.ExecutorSet(loop, settings.get("executors"))
+        self.wirelog = wirelog.WireLog(settings.get("wirelog"), None)
+
+    def addbot(self, settings):
+        name = settings.get("name", "bot")
+        if name in self.bots:
+            logging.warning("Connection {!r} already exists.".format(name))
+            return None
+
+        b = bot.Bot(self.loop, settings, self)
+        self.bots[name] = b
+        b.loadmodules()
+
+        return b
+
+    def network(self, name):
+        # a connection by name, or the least busy connection to a network (see the "network" setting)
+        if name in self.bots:
+            return self.bots[name]
+
+        clones = [b for b in self.bots.values() if b.settings.get("network") == name]
+        if not clones:
+            return None
+
+        # prefer registered connections, then the shortest send queue
+        return min(clones, key=lambda b: (not b.connect_success, len(b.scheduler)))
+
+    def networkcommands(self, name):
+        # see CommandSet.network
+        b = self.network(name)
+        return b.remoteset.cmd if b else None
+
+    async def run(self):
+        await asyncio.gather(*(b.mainloop() for b in self.bots.values()))
+
+    def close(self):
+        for b in self.bots.values():
+            b.close()
+
+        self.executors.shutdown()
+        self.wirelog.close()
+
+
+def runbots(settingslist):
+    loop = asyncio.get_event_loop()
+
+    supervisor = Supervisor(loop, settingslist[0])
+    for settings in settingslist:
+        supervisor.addbot(settings)
+
+    try:
+        loop.run_until_complete(supervisor.run())
+    finally:
+        supervisor.close()
+        loop.close()
+
+
+if __name__ == "__main__":
+    # lines sent and received are logged separately, see the "wirelog" setting
+    logging.basicConfig(level=logging.INFO)
+    runbots(defaultbots)
@@ -1,34 +1,62 @@
 import asyncio
+import collections
+import executors
+import heapq
 import logging
+import math
+
+# timers due within the same tick of this many seconds are fired together
+TIMERTICK = 0.01
+
+
+class Timer(object):
+    __slots__ = ("name", "delay", "reps", "command", "start", "count", "skipped", "cancelled", "tick")
+
+    def __init__(self, name, delay, reps, command, start):
+        self.name = name
+        self.delay = delay
+        self.reps = reps
+        self.command = command
+        self.start = start
+        self.count = 0  # times fired
+        self.skipped = 0  # repetitions missed while the event loop was held up, which are not made up for
+        self.cancelled = False
+        self.tick = None  # of the bucket it is in
+
+    def deadline(self):
+        # scheduled against the start time, so repetitions do not drift
+        return self.start + (self.count + self.skipped + 1) * self.delay
 
 
 class TaskSet(object):
-    def __init__(self, loop):
+    # all timers share a single wakeup of the event loop: timers are kept in buckets per tick, and a heap
+    # holds the ticks that have a bucket, so adding a timer to an existing tick and removing one are O(1)
+    # (the tick of an emptied bucket is left in the heap, and skipped once it comes up)
+
+    def __init__(self, loop, tick=TIMERTICK, pools=None, executorset=None):
         self.loop = loop
+        self.tick = tick
         self.timers = {}
+        # named executor pools for background processes (see executors.py), possibly shared with other bots
+        self.executors = executorset or executors.ExecutorSet(loop, pools)
 
-    def addtimer(self, name, delay, reps, command):
-        async def timerprocess():
-            # treat unlimited reps as a negative number
-            i = reps if reps != 0 else -1
-            while i != 0:
-                await asyncio.sleep(delay)
-
-                logging.debug("Executing timer {!r} ".format(name))
-                try:
-                    command()
-                except Exception as e:
-                    logging.warning("Failed to execute timer {!r}: {}".format(name, e))
-
-                if i > 0:
-                    i -= 1
+        self.buckets = {}  # timers per tick, as dictionary keys
+        self.ticks = []  # heap of ticks with a bucket
+        self.wakeup = None
+        self.wakeuptick = None
 
-            if name in self.timers:
-                del self.timers[name]
+    def addtimer(self, name, delay, reps, command):
+        # treat 0 reps as unlimited
+        if name in self.timers:
+            self._cancel(self.timers.pop(name))
 
         message = "Adding timer {!r} with {} seconds delay and {} repetitions."
         logging.debug(message.format(name, delay, reps))
-        self.timers[name] = asyncio.ensure_future(timerprocess(), loop=self.loop)
+
+        timer = Timer(name, delay, reps, command, self.loop.time())
+        self.timers[name] = timer
+        self._schedule(timer, 0)
+        self._arm()
 
     def removetimer(self, name):
         if name not in self.timers:
@@ -36,19 +64,192 @@ class TaskSet(object):
             return
 
         logging.debug("Removing timer {!r}.".format(name))
-        timer = self.timers.pop(name)
-        timer.cancel()
-
-    def dobgprocess(self, command):
-        def bgprocess():
-            try:
-                command()
-            except Exception as e:
-                logging.warning("Failed to execute background process: {}".format(e))
-
-        async def bgroutine():
-            await self.loop.run_in_executor(None, bgprocess)
-            logging.debug("Finished executing background process.")
-
-        logging.debug("Executing background process.")
-        asyncio.ensure_future(bgroutine(), loop=self.loop)
+        self._cancel(self.timers.pop(name))
+        self._arm()
+
+    def _schedule(self, timer, mintick):
+        # not meant to be called directly
+        tick = max(math.ceil(timer.deadline() / self.tick), mintick)
+        timer.tick = tick
+        if tick in self.buckets:
+            self.buckets[tick][timer] = None
+        else:
+            self.buckets[tick] = {timer: None}
+            heapq.heappush(self.ticks, tick)
+
+    def _cancel(self, timer):
+        # not meant to be called directly
+        timer.cancelled = True
+        bucket = self.buckets.get(timer.tick)
+        if bucket is not None and timer in bucket:
+            del bucket[timer]
+            if not bucket:
+                del self.buckets[timer.tick]
+
+    def _arm(self):
+        # not meant to be called directly
+        # ticks whose bucket was emptied
+        while self.ticks and self.ticks[0] not in self.buckets:
+            heapq.heappop(self.ticks)
+
+        if not self.ticks or self.ticks[0] == self.wakeuptick:
+            return
+
+        if self.wakeup:
+            self.wakeup.cancel()
+
+        self.wakeuptick = self.ticks[0]
+        self.wakeup = self.loop.call_at(self.wakeuptick * self.tick, self._fire)
+
+    def _fire(self):
+        # not meant to be called directly
+        self.wakeup = None
+        self.wakeuptick = None
+        now = self.loop.time()
+        current = math.floor(now / self.tick)
+
+        while self.ticks and self.ticks[0] <= current:
+            for timer in self.buckets.pop(heapq.heappop(self.ticks), ()):
+                if timer.cancelled:
+                    continue
+
+                logging.debug("Executing timer {!r} ".format(timer.name))
+                try:
+                    timer.command()
+                except Exception as e:
+                    logging.warning("Failed to execute timer {!r}: {}".format(timer.name, e))
+
+                timer.count += 1
+                if timer.cancelled:
+                    continue
+
+                if timer.reps and timer.count >= timer.reps:
+                    del self.timers[timer.name]
+                    continue
+
+                # after a stall, a repeating timer fires once rather than once for every repetition it missed
+                if timer.delay > 0 and timer.deadline() <= now:
+                    timer.skipped += int((now - timer.deadline()) // timer.delay) + 1
+                self._schedule(timer, current + 1)
+
+        self._arm()
+
+    def dobgprocess(self, command, *args, pool=executors.DEFAULTPOOL, callback=None):
+        # runs command(*args) in one of the executor pools, returns a future for the result
+        # commands for process pools have to be picklable (e.g. module level functions)
+        def finished(future):
+            if future.cancelled():
+                logging.debug("Background process was cancelled.")
+            elif isinstance(future.exception(), asyncio.QueueFull):
+                # already reported by the pool
+                pass
+            elif future.exception() is not None:
+                logging.warning("Failed to execute background process: {}".format(future.exception()))
+            else:
+                logging.debug("Finished executing background process.")
+
+        logging.debug("Executing background process in pool {!r}.".format(pool))
+        future = self.executors[pool].submit(command, *args, callback=callback)
+        future.add_done_callback(finished)
+        return future
+
+
+class HandlerTasks(object):
+    # coroutines started by the async handlers of a single remote
+    # at most limit of them run at the same time, and those sharing an ordering key (e.g. a channel) run one
+    # after the other, in the order they were started. at most maxwaiting of them wait for their turn, beyond
+    # that the policy applies, as for executor pools (see executors.py): the new coroutine is not run
+    # (REJECT), or the oldest waiting one is cancelled (DROPOLDEST)
+
+    def __init__(self, loop, limit, name, maxwaiting=None, policy=executors.REJECT):
+        self.loop = loop
+        self.name = name
+        self.semaphore = asyncio.Semaphore(limit)
+        self.maxwaiting = maxwaiting
+        self.policy = policy
+        self.tasks = set()
+        self.waiting = {}  # coroutines of the tasks that have not started yet, oldest first
+        self.running = 0
+        self.last = {}  # most recently started task per ordering key
+        self.counters = collections.Counter()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "waiting": len(self.waiting),
+            "maxwaiting": self.counters["maxwaiting"],
+            "started": self.counters["started"],
+            "rejected": self.counters["rejected"],
+            "dropped": self.counters["dropped"],
+        }
+
+    def run(self, coroutine, key=None):
+        # returns the task, or None if the coroutine is rejected
+        if self.maxwaiting is not None and len(self.waiting) >= self.maxwaiting:
+            if self.policy == executors.DROPOLDEST and self.waiting:
+                oldest = next(iter(self.waiting))
+                # a task cancelled before it starts never gets to close its coroutine itself
+                self.waiting.pop(oldest).close()
+                oldest.cancel()
+                self.counters["dropped"] += 1
+                logging.warning("Dropped oldest waiting handler task for {}.".format(self.name))
+            else:
+                # avoid warnings about coroutines that were never started
+                coroutine.close()
+                self.counters["rejected"] += 1
+                logging.warning("Rejected handler task for {}, too many are waiting.".format(self.name))
+                return None
+
+        previous = self.last.get(key) if key is not None else None
+        task = asyncio.ensure_future(self._run(coroutine, previous), loop=self.loop)
+
+        self.tasks.add(task)
+        self.waiting[task] = coroutine
+        self.counters["started"] += 1
+        self.counters["maxwaiting"] = max(self.counters["maxwaiting"], len(self.waiting))
+        if key is not None:
+            self.last[key] = task
+        task.add_done_callback(lambda t: self._done(t, key))
+
+        return task
+
+    def cancel(self):
+        if self.tasks:
+            logging.debug("Cancelling {} handler task(s) for {}.".format(len(self.tasks), self.name))
+
+        for coroutine in self.waiting.values():
+            coroutine.close()
+        for task in self.tasks:
+            task.cancel()
+        self.waiting = {}
+        self.last = {}
+
+    async def _run(self, coroutine, previous):
+        # not meant to be called directly
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+
+            async with self.semaphore:
+                self.waiting.pop(asyncio.current_task(), None)
+                self.running += 1
+                try:
+                    return await coroutine
+                finally:
+                    self.running -= 1
+        except asyncio.CancelledError:
+            # avoid warnings about coroutines that were never started
+            coroutine.close()
+            raise
+        except Exception as e:
+            logging.warning("Could not process async handler in {}: {}".format(self.name, e))
+
+    def _done(self, task, key):
+        # not meant to be called directly
+        self.tasks.discard(task)
+        self.waiting.pop(task, None)
+        if key is not None and self.last.get(key) is task:
+            del self.last[key]
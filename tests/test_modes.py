@@ -0,0 +1,54 @@
+import asyncio
+import unittest
+import commands
+import tasks
+import userdata
+
+
+class ModeQueueObjectsTest(unittest.TestCase):
+    # handlers are given Channel and Nick objects, which mode changes should accept in place of names
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.sent = []
+        self.tasks = tasks.TaskSet(self.loop)
+        self.userdata = userdata.UserData(send=self.sent.append, tasks=self.tasks)
+        self.userdata.me = "bot"
+        self.userdata.handlejoin("bot!b@bot.host", ["#chan"])
+        self.userdata.handlenames("server", ["bot", "=", "#chan", "@bot alice +bob"])
+        self.userdata.handleeendofnames("server", ["bot", "#chan", "End of /NAMES list."])
+        self.cmd = commands.CommandSet(self.sent.append, self.tasks, None, None,
+                                       modequeue=self.userdata.modequeue)
+
+        self.channel = self.userdata.channels[self.userdata.key("#chan")]
+        self.alice = self.userdata.nicks[self.userdata.key("alice")]
+        self.bob = self.userdata.nicks[self.userdata.key("bob")]
+
+    def tearDown(self):
+        self.tasks.executors.shutdown()
+        self.loop.close()
+
+    def flush(self):
+        self.userdata.modequeue.flush()
+        return [line for line in self.sent if line.startswith("MODE")]
+
+    def test_single_nick(self):
+        self.cmd.op(self.channel, self.alice)
+        self.assertEqual(self.flush(), ["MODE #chan +o alice"])
+
+    def test_list_of_nicks(self):
+        self.cmd.voice(self.channel, [self.alice, self.bob])
+        # bob has voice already
+        self.assertEqual(self.flush(), ["MODE #chan +v alice"])
+
+    def test_changemode(self):
+        self.cmd.changemode(self.channel, "+ol", [self.alice, 10])
+        self.assertEqual(self.flush(), ["MODE #chan +ol alice 10"])
+
+    def test_string_arguments(self):
+        self.cmd.devoice("#chan", "alice bob")
+        self.assertEqual(self.flush(), ["MODE #chan -v bob"])
+
+
+if __name__ == "__main__":
+    unittest.main()
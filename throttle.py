@@ -0,0 +1,291 @@
+import asyncio
+import collections
+import logging
+from strings import encode
+
+# default flood control settings, modelled after the ircd's penalty rules: every line costs PENALTY
+# seconds plus a second per BYTEPENALTY bytes, and the server processes lines while our penalty is
+# less than BURST seconds ahead of the current time
+BURST = 10
+PENALTY = 2
+BYTEPENALTY = 120
+# amount of targets identical messages may be combined into (None follows the server's TARGMAX)
+MAXTARGETS = None
+
+# maximum line length, including "\r\n"
+MAXLINE = 512
+
+# priority lanes
+URGENT = 0  # connection upkeep and authentication, never held back
+CONTROL = 1  # channel management
+QUERY = 2  # information requests
+CHAT = 3  # messages and anything else
+LANES = 4
+
+PRIORITIES = {
+    "PONG": URGENT,
+    "PING": URGENT,
+    "PASS": URGENT,
+    "USER": URGENT,
+    "NICK": URGENT,
+    "CAP": URGENT,
+    "AUTHENTICATE": URGENT,
+    # after the lines queued before it, which would be lost otherwise
+    "QUIT": CHAT,
+    "MODE": CONTROL,
+    "KICK": CONTROL,
+    "TOPIC": CONTROL,
+    "INVITE": CONTROL,
+    "JOIN": CONTROL,
+    "PART": CONTROL,
+    "WHO": QUERY,
+    "WHOIS": QUERY,
+    "WHOWAS": QUERY,
+    "USERHOST": QUERY,
+    "ISON": QUERY,
+    "NAMES": QUERY,
+}
+
+# commands whose lines are combined by target
+CHATCOMMANDS = ("PRIVMSG", "NOTICE")
+# commands whose lines are dropped when an identical one is still queued, as sending it twice gets the same
+# reply twice (unlike e.g. MODE, where "+o x", "-o x", "+o x" must all be sent)
+IDEMPOTENT = frozenset(("WHO", "WHOIS", "WHOWAS", "USERHOST", "ISON", "NAMES"))
+# services messages to which are sent in the URGENT lane, as they are used for authentication
+SERVICES = ("Q@CServe.quakenet.org",)
+
+
+class Outgoing(object):
+    # a queued line; messages keep their targets separately so they can be combined
+
+    __slots__ = ("line", "command", "targets", "text", "names")
+
+    def __init__(self, line, command, targets=None, text=None):
+        self.line = line
+        self.command = command
+        self.targets = targets
+        self.text = text
+        self.names = None  # lower case targets counted in SendScheduler.targets, for lines in the CHAT lane
+
+    def render(self):
+        if self.targets is None:
+            return self.line
+
+        return "{} {} :{}".format(self.command, ",".join(self.targets), self.text)
+
+
+class SendScheduler(object):
+    # token bucket in seconds of penalty, refilled at one token per second up to the burst size
+
+    def __init__(self, loop, settings, profile, wirelog=None):
+        self.loop = loop
+        self.profile = profile
+        self.wirelog = wirelog  # see wirelog.py
+        # returns the length of the prefix the server puts in front of our messages (see outbound.py)
+        self.prefixlength = None
+
+        throttle = settings.get("throttle", {})
+        self.burst = throttle.get("burst", BURST)
+        self.penalty = throttle.get("penalty", PENALTY)
+        self.bytepenalty = throttle.get("bytepenalty", BYTEPENALTY)
+        self.maxtargets = throttle.get("maxtargets", MAXTARGETS)
+        self.services = {t.lower() for t in throttle.get("services", SERVICES)}
+
+        self.lanes = [collections.deque() for _ in range(LANES)]
+        self.count = 0  # lines queued in all lanes
+        self.queued = {}  # queued lines per line or (command, text), used for combining
+        self.targets = {}  # lines queued in the CHAT lane per (lower case) target
+        self.wakeup = asyncio.Event()
+
+        self.tokens = self.burst
+        self.updated = 0.0
+
+        # counters, see stats()
+        self.sent = 0
+        self.maxqueued = 0
+        self.throttles = 0
+        self.throttled = 0.0  # seconds spent waiting for tokens
+
+    def reset(self):
+        for lane in self.lanes:
+            lane.clear()
+        self.count = 0
+        self.queued = {}
+        self.targets.clear()
+
+        self.tokens = self.burst
+        self.updated = self.loop.time()
+
+    def __len__(self):
+        return self.count
+
+    def stats(self):
+        return {
+            "queued": len(self),
+            "lanes": [len(lane) for lane in self.lanes],
+            "maxqueued": self.maxqueued,
+            "sent": self.sent,
+            "throttles": self.throttles,
+            "throttled": self.throttled,
+            "tokens": self.tokens,
+        }
+
+    def put(self, line, priority=None):
+        command, _, rest = line.partition(" ")
+        command = command.upper()
+
+        names = None
+        if command in CHATCOMMANDS:
+            target, _, text = rest.partition(" :")
+            names = rest.partition(" ")[0].lower().split(",")
+            lane = URGENT if target.lower() in self.services else CHAT
+        else:
+            target, text = None, None
+            lane = PRIORITIES.get(command, CHAT)
+            if lane == CONTROL:
+                # channel management follows messages to the same target that are queued already, so e.g. a
+                # goodbye is sent before the PART
+                names = rest.partition(" ")[0].lower().split(",")
+                if any(name in self.targets for name in names):
+                    lane = CHAT
+
+        if priority is not None:
+            lane = priority
+
+        if lane == CHAT and names is not None:
+            for name in names:
+                self.targets[name] = self.targets.get(name, 0) + 1
+        else:
+            names = None
+
+        maxtargets = self.profile.maxtargets(command) if target is not None else 1
+        if self.maxtargets:
+            maxtargets = min(maxtargets, self.maxtargets)
+
+        if lane == CHAT and maxtargets > 1 and "," not in target and " " not in target:
+            # combine identical messages to several targets, as long as that does not change the order
+            # of lines to a target (nothing else may be queued for it)
+            key = (command, text)
+            item = self.queued.get(key)
+            if item and self.targets[names[0]] == 1 and len(item.targets) < maxtargets and \
+                    (self.prefixlength() if self.prefixlength else 0) + len(encode(item.render())) + \
+                    len(encode(target)) + 3 <= MAXLINE:
+                item.targets.append(target)
+                item.names.append(names[0])
+                return
+
+            item = Outgoing(line, command, [target], text)
+            self.queued[key] = item
+        elif command in IDEMPOTENT:
+            # drop repeated requests that are still queued
+            if line in self.queued:
+                return
+
+            item = Outgoing(line, command)
+            self.queued[line] = item
+        else:
+            item = Outgoing(line, command)
+
+        item.names = names
+        self.lanes[lane].append(item)
+        self.count += 1
+        self.wakeup.set()
+
+        if self.count > self.maxqueued:
+            self.maxqueued = self.count
+
+    def cost(self, encoded_line):
+        if not self.bytepenalty:
+            return self.penalty
+
+        return self.penalty + len(encoded_line) / self.bytepenalty
+
+    async def get(self):
+        # wait for the next line the server will process without delay
+        while True:
+            encoded_line, delay = self.take()
+            if encoded_line:
+                return encoded_line
+
+            self.wakeup.clear()
+            if delay is None:
+                await self.wakeup.wait()
+                continue
+
+            # wait for tokens, or for a more urgent line to come in
+            self.throttles += 1
+            start = self.loop.time()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self.throttled += self.loop.time() - start
+
+    def getready(self, maxbytes):
+        # all lines that can be sent right away, up to about maxbytes
+        # (nothing is queued in the meantime, so a lane is only looked at again once the ones before it are
+        # empty, rather than for every line)
+        encoded_lines = []
+        size = 0
+        now = self.loop.time()
+        for lane, queue in enumerate(self.lanes):
+            while queue and size < maxbytes:
+                encoded_line, delay = self.takefrom(lane, queue, now)
+                if not encoded_line:
+                    return encoded_lines
+
+                encoded_lines.append(encoded_line)
+                size += len(encoded_line)
+
+        return encoded_lines
+
+    def take(self, now=None):
+        # returns (encoded line, None) if a line can be sent, otherwise (None, seconds to wait or None)
+        for lane, queue in enumerate(self.lanes):
+            if queue:
+                return self.takefrom(lane, queue, now)
+
+        return None, None
+
+    def takefrom(self, lane, queue, now=None):
+        # not meant to be called directly
+        item = queue[0]
+        line = item.render()
+        encoded_line = encode(line + "\r\n")
+        cost = self.cost(encoded_line)
+
+        if cost:
+            if now is None:
+                now = self.loop.time()
+            self.tokens = min(self.burst, self.tokens + now - self.updated)
+            self.updated = now
+
+            # lines costing more than the burst size are sent once the bucket is full
+            needed = min(cost, self.burst)
+            if lane != URGENT and self.tokens < needed:
+                return None, needed - self.tokens
+
+            self.tokens -= cost
+
+        queue.popleft()
+        self.count -= 1
+        self.forget(item)
+        self.sent += 1
+
+        if self.wirelog:
+            self.wirelog.sent(line)
+        return encoded_line, None
+
+    def forget(self, item):
+        # remove a line that is being sent from the combining index
+        key = item.line if item.targets is None else (item.command, item.text)
+        if self.queued.get(key) is item:
+            del self.queued[key]
+
+        if item.names is not None:
+            for name in item.names:
+                left = self.targets[name] - 1
+                if left:
+                    self.targets[name] = left
+                else:
+                    del self.targets[name]
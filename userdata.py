@@ -1,25 +1,65 @@
+import random
+import sys
+import isupport
+import modes
+import queries
 import strings
 
 # The bot does not issue a WHO command upon joining a channel, because of ircd-specific syntax. Hosts (and
-# account names) are therefore not generally available.
+# account names) are therefore not generally available, unless requested through the AccountTracker.
 
 
-prefixmodes = {
-    "~": "q",
-    "&": "a",
-    "@": "o",
-    "%": "h",
-    "+": "v",
-}
+# NOTE: membership is a two-way index of objects: Channel.members maps nicks to their prefix mode bits and
+# Nick.channels holds the channels a nick is on. Renaming a nick therefore only touches UserData.nicks.
+
+# NOTE: nicks and channels are stored under their name in the server's case mapping (see key()), while
+# their objects keep the name as last sent by the server for display.
+
+# NOTE: after a disconnect, channels and nicks are put aside instead of being dropped. Channels joined again
+# and nicks seen again get their old objects back (with memberships rebuilt from JOIN and NAMES), so
+# references held by remotes stay valid; whatever is not seen again is dropped after RESYNCTIMEOUT.
+
+# NOTE: with persistence enabled (see persist.py), nicks whose host or account changed are passed to
+# remember(), and nicks seen for the first time get what was remembered about them filled in by the store.
+
+# amount of names whose case mapped key is remembered
+KEYCACHESIZE = 4096
+
+# delay in seconds during which account lookups are collected into WHO commands
+WHOFLUSHDELAY = 1
+# query a channel as a whole once this many of its members are waiting for a lookup
+CHANNELWHOMINIMUM = 10
+# maximum line length, including "\r\n"
+MAXLINE = 512
+# seconds after reconnecting during which channels and nicks from before the disconnect are reused
+RESYNCTIMEOUT = 120
 
 
 class UserData(object):
-    def __init__(self):
+    def __init__(self, profile=None, send=None, tasks=None):
+        # protocol details of the server, updated here from RPL_ISUPPORT
+        self.profile = profile if profile else isupport.ServerProfile()
+        self.accounts = AccountTracker(self, send, tasks)
+        # mode changes requested by remotes, confirmed by the MODE handler (see modes.py)
+        self.modequeue = modes.ModeQueue(self, send, tasks)
+        # WHOIS, WHO, USERHOST and ISON requests of remotes (see queries.py)
+        self.queries = queries.QueryManager(self, send, tasks)
+
         self.me = ""
         self.usermodes = set()
         self.channels = {}
         self.nicks = {}
+        self.previouschannels = {}  # channels from before a disconnect, by key
+        self.previousnicks = {}  # nicks from before a disconnect, by key
+        self.autorejoin = True
+        self.rejoinheld = False  # whether a remote rejoins channels itself, see holdrejoin()
+        self.persistence = None  # a persist.StateStore, if any
+        self.tasks = tasks
+        self.send = send
+        self.casemapping = self.profile.casemapping
+        self.keycache = {}
         self.handlers = {
+            "ACCOUNT": self.handleaccount,
             "JOIN": self.handlejoin,
             "KICK": self.handlekick,
             "MODE": self.handlemode,
@@ -27,8 +67,27 @@ class UserData(object):
             "PART": self.handlepart,
             "QUIT": self.handlequit,
             "001": self.handleconnect,
+            "005": self.handleisupport,
+            "301": self.queries.handleaway,
+            "302": self.queries.handleuserhost,
+            "303": self.queries.handleison,
+            "311": self.queries.handlewhoisuser,
+            "312": self.queries.handlewhoisserver,
+            "313": self.queries.handlewhoisoperator,
+            "315": self.handleendofwho,
+            "317": self.queries.handlewhoisidle,
+            "324": self.handlechannelmodeis,
+            "318": self.queries.handleendofwhois,
+            "319": self.queries.handlewhoischannels,
+            "330": self.queries.handlewhoisaccount,
+            "352": self.queries.handlewho,
             "353": self.handlenames,
+            "354": self.accounts.handlewho,
             "366": self.handleeendofnames,
+            "376": self.handleendofmotd,
+            "401": self.queries.handlenosuchnick,
+            "482": self.handlechanoprivsneeded,
+            "422": self.handleendofmotd,
             "_DISCONNECT": self.handledisconnect,
         }
 
@@ -36,14 +95,19 @@ class UserData(object):
         return self.channels.values()
 
     def getchannel(self, channelname):
-        if channelname in self.channels:
-            return self.channels[channelname]
+        channel = self.channels.get(self.key(channelname))
+        if channel:
+            return channel
 
         return Channel(self, channelname)
 
     def getnick(self, nickname, host=""):
-        if nickname in self.nicks:
-            return self.nicks[nickname]
+        nick = self.nicks.get(self.key(nickname))
+        if nick:
+            # a prefix just received is more recent than anything remembered (e.g. after a host change)
+            if host:
+                nick.host = host
+            return nick
 
         return Nick(self, nickname, host)
 
@@ -57,47 +121,126 @@ class UserData(object):
 
     # --- helper methods ---
 
-    def isme(self, prefix):
-        return strings.getnick(prefix) == self.me
+    def key(self, name):
+        # case mapped name, folded only once for names seen often
+        key = self.keycache.get(name)
+        if key is None:
+            if len(self.keycache) >= KEYCACHESIZE:
+                self.keycache.clear()
 
-    def addtochannel(self, channelname, nickname, modes, host=""):
-        if nickname not in self.nicks:
-            self.nicks[nickname] = Nick(self, nickname, host)
+            key = self.keycache[name] = sys.intern(name.translate(self.casemapping))
 
-        nick = self.nicks[nickname]
-        nick.channels.add(channelname)
+        return key
 
-        channel = self.channels[channelname]
-        channel.nicks[nickname] = modes
+    def isme(self, prefix):
+        return self.key(strings.getnick(prefix)) == self.key(self.me)
+
+    def addtochannel(self, channelname, nickname, modebits, host=""):
+        key = self.key(nickname)
+        nick = self.nicks.get(key)
+        if nick is None:
+            nick = self.previousnicks.pop(key, None)
+            if nick is not None:
+                # seen again after reconnecting, its account may have changed in the meantime
+                nick.channels = {}
+                nick.account = ""
+                nick.name = sys.intern(nickname)
+                nick.host = host or nick.host
+                self.nicks[key] = nick
+            else:
+                nick = self.nicks[key] = Nick(self, sys.intern(nickname), host)
+
+            if self.persistence:
+                self.persistence.recall(key, nick)
+
+        channel = self.channels[self.key(channelname)]
+        channel.members[nick] = modebits
+        nick.channels[channel] = None
+
+    def remember(self, nick):
+        if self.persistence:
+            self.persistence.nickchanged(self.key(nick.name), nick)
 
     def removechannel(self, channelname):
-        channel = self.channels[channelname]
-        for nickname in channel.nicks:
-            nick = self.nicks[nickname]
-            nick.channels.remove(channelname)
+        channel = self.channels.pop(self.key(channelname))
+        for nick in channel.members:
+            del nick.channels[channel]
 
             # remove nicks without common channels
             if not nick.channels:
-                del self.nicks[nick]
-        del self.channels[channelname]
+                del self.nicks[self.key(nick.name)]
 
     def removenick(self, nickname):
-        nick = self.nicks[nickname]
-        for channelname in nick.channels:
-            channel = self.channels[channelname]
-            del channel.nicks[nickname]
-        del self.nicks[nickname]
+        nick = self.nicks.pop(self.key(nickname))
+        for channel in nick.channels:
+            del channel.members[nick]
 
     def removefromchannel(self, channelname, nickname):
-        channel = self.channels[channelname]
-        del channel.nicks[nickname]
-
-        nick = self.nicks[nickname]
-        nick.channels.remove(channelname)
+        channel = self.channels[self.key(channelname)]
+        nick = self.nicks[self.key(nickname)]
+        del channel.members[nick]
+        del nick.channels[channel]
 
         # remove nick if no common channels are left
         if not nick.channels:
-            del self.nicks[nickname]
+            del self.nicks[self.key(nickname)]
+
+    def setcasemapping(self, casemapping):
+        if casemapping == self.casemapping:
+            return
+
+        self.casemapping = casemapping
+        self.keycache = {}
+
+        # store everything under the new keys
+        self.channels = {self.key(c.name): c for c in self.channels.values()}
+        self.nicks = {self.key(n.name): n for n in self.nicks.values()}
+        self.previouschannels = {self.key(c.name): c for c in self.previouschannels.values()}
+        self.previousnicks = {self.key(n.name): n for n in self.previousnicks.values()}
+
+    # --- resyncing ---
+
+    def holdrejoin(self):
+        # a remote joins the channels again itself once it is ready (e.g. once our host is hidden), by
+        # calling rejoin(); until the next disconnect they are not joined at the end of the MOTD
+        self.rejoinheld = True
+
+    def rejoin(self, channels=None):
+        # join the channels from before the disconnect again (unless autorejoin is off) along with channels
+        # (a comma separated string or a list), each of them once and in as few JOIN commands as the server
+        # allows. channels with a key go first, the server matches keys to channels by position
+        if not self.send:
+            return
+
+        if isinstance(channels, str):
+            channels = channels.split(",")
+
+        joining = {}
+        if self.autorejoin:
+            for key, channel in self.previouschannels.items():
+                joining[key] = (channel.name, channel.key)
+        for name in channels or ():
+            key = self.key(name)
+            if name and key not in joining:
+                joining[key] = (name, "")
+
+        entries = sorted((e for k, e in joining.items() if k not in self.channels), key=lambda e: not e[1])
+        limit = self.profile.targmax.get("JOIN", isupport.UNLIMITED)
+        batch = []
+        for entry in entries:
+            length = len(strings.encode(joinline(batch + [entry]))) + 2
+            if batch and (len(batch) >= limit or length > MAXLINE):
+                self.send(joinline(batch))
+                batch = []
+            batch.append(entry)
+
+        if batch:
+            self.send(joinline(batch))
+
+    def endresync(self):
+        # channels not joined again and nicks not seen again are gone
+        self.previouschannels = {}
+        self.previousnicks = {}
 
     # --- handlers ---
 
@@ -105,67 +248,149 @@ class UserData(object):
         # set initial bot nickname
         self.me = args[0]
 
+        if self.tasks and (self.previouschannels or self.previousnicks):
+            self.tasks.addtimer("_resync", RESYNCTIMEOUT, 1, self.endresync)
+
+    def handleaccount(self, prefix, args):
+        # account-notify: "*" when logging out
+        nick = self.nicks.get(self.key(strings.getnick(prefix)))
+        if nick:
+            self.accounts.setaccount(nick, None if args[0] == "*" else args[0])
+
+    def handlechanoprivsneeded(self, prefix, args):
+        # me channel :You're not channel operator
+        if len(args) > 1:
+            self.modequeue.refuse(self.key(args[1]))
+
     def handledisconnect(self, prefix, args):
+        self.accounts.clear()
+        self.modequeue.clear()
+        self.queries.clear()
+        self.rejoinheld = False
+
+        # kept aside for resyncing after reconnecting
+        self.previouschannels.update(self.channels)
+        self.previousnicks.update(self.nicks)
         self.channels = {}
         self.nicks = {}
 
+    def handleendofwho(self, prefix, args):
+        # ends both WHOX account lookups and queries of remotes
+        self.accounts.handleendofwho(prefix, args)
+        self.queries.handleendofwho(prefix, args)
+
+    def handleendofmotd(self, prefix, args):
+        # registration (and RPL_ISUPPORT) is complete
+        if self.autorejoin and self.previouschannels and not self.rejoinheld:
+            self.rejoin()
+
+    def handleisupport(self, prefix, args):
+        # RPL_ISUPPORT: me token1 token2 ... :are supported by this server
+        self.profile.update(args[1:-1])
+        self.setcasemapping(self.profile.casemapping)
+
     def handleeendofnames(self, prefix, args):
-        channel = self.channels[args[1]]
+        channel = self.channels[self.key(args[1])]
         channel._gettingnicks = False
 
     def handlejoin(self, prefix, args):
         if self.isme(prefix):
-            self.channels[args[0]] = Channel(self, args[0])
+            key = self.key(args[0])
+            channel = self.previouschannels.pop(key, None)
+            if channel is not None:
+                # joined again after reconnecting, members are filled in again by NAMES
+                channel.members = {}
+                channel._gettingnicks = True
+                channel.name = sys.intern(args[0])
+            else:
+                channel = Channel(self, sys.intern(args[0]))
+            self.channels[key] = channel
 
         nickname = strings.getnick(prefix)
-        self.addtochannel(args[0], nickname, set(), prefix)
+        self.addtochannel(args[0], nickname, 0, prefix)
+
+        # extended-join: channel account :realname
+        if len(args) > 2:
+            nick = self.nicks[self.key(nickname)]
+            nick.realname = args[2]
+            self.accounts.setaccount(nick, None if args[1] == "*" else args[1])
+        else:
+            self.remember(self.nicks[self.key(nickname)])
 
     def handlekick(self, prefix, args):
-        if args[1] == self.me:
+        if self.key(args[1]) == self.key(self.me):
             self.removechannel(args[0])
         else:
             self.removefromchannel(args[0], args[1])
 
     def handlemode(self, prefix, args):
-        if args[0] == self.me:
+        if self.key(args[0]) == self.key(self.me):
             # handle change in bot user modes
             modechanges = strings.parseusermodes(args[1])
             self.usermodes.update(modechanges["add"])
             self.usermodes.difference_update(modechanges["remove"])
         else:
             # handle change in channel modes
-            channel = self.channels[args[0]]
-            modechanges = strings.parsechannelmodes(args[1], args[2:])
-            for mode, arg in modechanges["add"].items():
-                if arg in channel.nicks:
-                    channel.nicks[arg].add(mode)
-
-            for mode, arg in modechanges["remove"].items():
-                if arg in channel.nicks:
-                    channel.nicks[arg].discard(mode)
+            key = self.key(args[0])
+            channel = self.channels[key]
+            modebits = self.profile.modebits
+            for adding, mode, arg in strings.parsechannelmodes(args[1], args[2:], self.profile):
+                self.modequeue.confirm(key, adding, mode, arg)
+                if mode == "k":
+                    # remembered for joining again after reconnecting
+                    channel.key = arg if adding else ""
+                if mode not in modebits:
+                    continue
+
+                nick = self.nicks.get(self.key(arg))
+                if nick not in channel.members:
+                    continue
+
+                if adding:
+                    channel.members[nick] |= modebits[mode]
+                else:
+                    channel.members[nick] &= ~modebits[mode]
+
+    def handlechannelmodeis(self, prefix, args):
+        # me channel modes args...
+        channel = self.channels.get(self.key(args[1])) if len(args) > 2 else None
+        if channel is None:
+            return
+
+        channel.key = ""
+        for adding, mode, arg in strings.parsechannelmodes(args[2], args[3:], self.profile):
+            if mode == "k":
+                channel.key = arg
 
     def handlenames(self, prefix, args):
+        prefixes = self.profile.prefixes
+        modebits = self.profile.modebits
         for nickname in args[3].split():
-            modes = set()
-            if nickname[0] in prefixmodes:
-                modes.add(prefixmodes[nickname[0]])
+            bits = 0
+            # there may be several prefixes (multi-prefix)
+            while nickname and nickname[0] in prefixes:
+                bits |= modebits[prefixes[nickname[0]]]
                 nickname = nickname[1:]
 
-            self.addtochannel(args[2], nickname, modes)
+            if not nickname:
+                # a token made of prefixes only, nobody to add
+                continue
+
+            self.addtochannel(args[2], nickname, bits)
 
     def handlenick(self, prefix, args):
         if self.isme(prefix):
             # update bot nickname
             self.me = args[0]
 
-        oldnick = strings.getnick(prefix)
-        self.nicks[args[0]] = self.nicks[oldnick]
-        del self.nicks[oldnick]
+        self.queries.forget(strings.getnick(prefix))
+        self.queries.forget(args[0])
 
-        for channelname in self.nicks[args[0]].channels:
-            channel = self.channels[channelname]
-            channel.nicks[args[0]] = channel.nicks[oldnick]
-            del channel.nicks[oldnick]
+        # memberships refer to the nick object, so they stay as they are
+        nick = self.nicks.pop(self.key(strings.getnick(prefix)))
+        nick.name = sys.intern(args[0])
+        self.nicks[self.key(nick.name)] = nick
+        self.remember(nick)
 
     def handlepart(self, prefix, args):
         if self.isme(prefix):
@@ -177,16 +402,230 @@ class UserData(object):
     def handlequit(self, prefix, args):
         nickname = strings.getnick(prefix)
         self.removenick(nickname)
+        self.queries.forget(nickname)
+
+
+class AccountTracker(object):
+    # resolves account names of nicks for all remotes together
+    # lookups are collected for a moment and sent as WHOX commands packed up to the line length, querying
+    # channels as a whole where that is cheaper; with account-notify and extended-join the server keeps
+    # accounts up to date without any WHO
+
+    def __init__(self, userdata, send, tasks):
+        self.userdata = userdata
+        self.send = send
+        self.tasks = tasks
+
+        self.token = random.randint(1, 999)
+        self.pending = {}  # futures per nick key waiting for a lookup
+        self.channels = set()  # channel keys to query as a whole
+        self.inflight = {}  # nick keys and their futures per WHO token
+        self.unauthed = set()  # nick keys without account, rechecked if there is no account-notify
+        self.flushing = False
+        self.recheck = None
+
+    def resolve(self, nick):
+        # returns a future for the account name of a nick (None if not authed)
+        future = self.tasks.loop.create_future()
+        self.lookup(nick, future)
+        return future
+
+    def lookup(self, nick, future=None):
+        # only nicks whose account is unknown are looked up, the others are settled right away
+        if nick.account != "":
+            if future and not future.done():
+                future.set_result(nick.account)
+            return
+
+        key = self.userdata.key(nick.name)
+        futures = self.pending.setdefault(key, [])
+        if future:
+            futures.append(future)
+
+        self.schedule()
+
+    def lookupchannel(self, channel):
+        self.channels.add(self.userdata.key(channel.name))
+        self.schedule()
+
+    def setrecheck(self, delay):
+        # look up unauthed nicks again every delay seconds (None to stop)
+        if self.recheck:
+            self.tasks.removetimer("_accountrecheck")
+
+        self.recheck = delay
+        if delay:
+            self.tasks.addtimer("_accountrecheck", delay, 0, self.recheckunauthed)
+
+    def setaccount(self, nick, account):
+        nick.account = account
+        self.userdata.remember(nick)
+
+        key = self.userdata.key(nick.name)
+        if account:
+            self.unauthed.discard(key)
+        else:
+            self.unauthed.add(key)
+
+        for future in self.pending.pop(key, []):
+            if not future.done():
+                future.set_result(account)
+
+    def clear(self):
+        for futures in list(self.pending.values()) + [f for b in self.inflight.values() for f in b.values()]:
+            for future in futures:
+                if not future.done():
+                    future.set_result(None)
+
+        self.pending = {}
+        self.channels = set()
+        self.inflight = {}
+        self.unauthed = set()
+
+    # --- WHO handling ---
+
+    def schedule(self):
+        if not self.flushing:
+            self.flushing = True
+            self.tasks.addtimer("_accountwho", WHOFLUSHDELAY, 1, self.flush)
+
+    def recheckunauthed(self):
+        if "account-notify" in self.userdata.profile.caps:
+            return
+
+        for key in self.unauthed:
+            self.pending.setdefault(key, [])
+        self.unauthed = set()
+
+        if self.pending:
+            self.schedule()
+
+    def flush(self):
+        self.flushing = False
+        userdata = self.userdata
+
+        # drop lookups for nicks that have quit since
+        for key in [k for k in self.pending if k not in userdata.nicks]:
+            for future in self.pending.pop(key):
+                if not future.done():
+                    future.set_result(None)
+
+        if not userdata.profile.whox:
+            # without WHOX there is no way to ask for accounts, unknown ones are taken as not authed
+            for key, futures in self.pending.items():
+                for future in futures:
+                    if not future.done():
+                        future.set_result(userdata.nicks[key].account or None)
+            self.pending = {}
+            self.channels = set()
+            return
+
+        # query channels as a whole if enough of their members are waiting; of a requested channel whose
+        # accounts are mostly known already (remembered, or from account-notify), only the rest is looked up
+        channels = []
+        for key in self.channels:
+            channel = userdata.channels.get(key)
+            if channel is None:
+                continue
+
+            unknown = [userdata.key(n.name) for n in channel.members if n.account == ""]
+            if len(unknown) >= CHANNELWHOMINIMUM:
+                channels.append(channel)
+            else:
+                for k in unknown:
+                    self.pending.setdefault(k, [])
+
+        for channel in userdata.channels.values():
+            if channel not in channels and \
+                    sum(1 for n in channel.members if userdata.key(n.name) in self.pending) >= CHANNELWHOMINIMUM:
+                channels.append(channel)
+
+        for channel in channels:
+            batch = {}
+            for nick in channel.members:
+                key = userdata.key(nick.name)
+                if key in self.pending:
+                    batch[key] = self.pending.pop(key)
+            self.who([channel.name], batch)
+        self.channels = set()
+
+        # pack the remaining nicks into as few commands as the line length allows
+        targets = []
+        batch = {}
+        for key, futures in self.pending.items():
+            name = userdata.nicks[key].name
+            if targets and self.wholength(targets + [name]) > MAXLINE:
+                self.who(targets, batch)
+                targets = []
+                batch = {}
+
+            targets.append(name)
+            batch[key] = futures
+
+        if targets:
+            self.who(targets, batch)
+        self.pending = {}
+
+    def who(self, targets, batch):
+        # returns (query type, user name, host, nick, account name, real name)
+        self.token = self.token % 999 + 1
+        self.inflight[str(self.token)] = batch
+        self.send("WHO {},{} n%tuhnar,{}".format(",".join(targets), self.token, self.token))
+
+    def wholength(self, targets):
+        return len(strings.encode("WHO {},999 n%tuhnar,999\r\n".format(",".join(targets))))
+
+    def handlewho(self, prefix, args):
+        # me token user host nick account :realname
+        if len(args) != 7 or args[1] not in self.inflight:
+            return
+
+        username, host, nickname, account, realname = args[2:]
+        nick = self.userdata.nicks.get(self.userdata.key(nickname))
+        if not nick:
+            return
+
+        nick.host = "{}!{}@{}".format(nickname, username, host)
+        nick.realname = realname
+
+        account = account if account != "0" else None
+        nick.account = account
+        self.userdata.remember(nick)
+        if account:
+            self.unauthed.discard(self.userdata.key(nickname))
+        elif self.recheck:
+            self.unauthed.add(self.userdata.key(nickname))
+
+        for future in self.inflight[args[1]].pop(self.userdata.key(nickname), []):
+            if not future.done():
+                future.set_result(account)
+
+    def handleendofwho(self, prefix, args):
+        # me mask :End of /WHO list.
+        token = args[1].split(",")[-1] if len(args) > 1 else ""
+        if token not in self.inflight:
+            return
+
+        # nicks without a reply are no longer around
+        for key, futures in self.inflight.pop(token).items():
+            nick = self.userdata.nicks.get(key)
+            for future in futures:
+                if not future.done():
+                    future.set_result(nick.account if nick else None)
 
 
 class Channel(object):
+    # the attributes below are slots; __dict__ is kept so remotes can still set attributes of their own
+    __slots__ = ("userdata", "name", "topic", "modes", "key", "members", "_gettingnicks", "__dict__")
+
     def __init__(self, userdata, name):
         self.userdata = userdata
         self.name = name
         self.topic = ""
         self.modes = ""
-        # also contains modes
-        self.nicks = {}
+        self.key = ""  # channel key (+k), if known
+        # nicks and their prefix mode bits
+        self.members = {}
         self._gettingnicks = True
 
     def __str__(self):
@@ -196,19 +635,26 @@ class Channel(object):
         return True
 
     def equals(self, channelname):
-        return channelname == self.name
+        return self.userdata.key(channelname) == self.userdata.key(self.name)
 
     def getnicks(self):
-        return [self.userdata.nicks[n] for n in self.nicks]
+        # a view, not a copy
+        return self.members.keys()
 
 
 class Nick(object):
+    # the attributes below are slots; __dict__ is kept so remotes can still set attributes of their own
+    __slots__ = ("userdata", "name", "host", "channels", "account", "realname", "__dict__")
+
     def __init__(self, userdata, name, host=""):
         self.userdata = userdata
         self.name = name
         self.host = host
-        self.channels = set()
+        # channels as dictionary keys, so views can be handed out
+        self.channels = {}
+        # "" while unknown, None if known not to be authed
         self.account = ""
+        self.realname = ""
 
     def __str__(self):
         return self.name
@@ -217,16 +663,29 @@ class Nick(object):
         return False
 
     def equals(self, nickname):
-        return nickname == self.name
+        return self.userdata.key(nickname) == self.userdata.key(self.name)
 
     def getchannels(self):
-        return [self.userdata.channels[c] for c in self.channels]
+        # a view, not a copy
+        return self.channels.keys()
 
     def comchan(self):
         return self.getchannels()
 
     def chanmodes(self, channel):
-        return channel.nicks[self.name]
+        if not isinstance(channel, Channel):
+            channel = self.userdata.getchannel(channel)
+
+        return self.userdata.profile.modestring(channel.members.get(self, 0))
 
     def isme(self):
-        return self.name == self.userdata.me
+        return self.equals(self.userdata.me)
+
+
+# --- helpers ---
+
+def joinline(entries):
+    # "JOIN #a,#b,#c keya,keyb" from (name, key) tuples, those with a key first
+    keys = [k for _, k in entries if k]
+    line = "JOIN {}".format(",".join(n for n, _ in entries))
+    return "{} {}".format(line, ",".join(keys)) if keys else line
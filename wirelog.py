@@ -0,0 +1,173 @@
+import logging
+import logging.handlers
+import queue
+import struct
+import sys
+import time
+
+# default wire logging settings
+DEFAULTS = {
+    "enabled": True,
+    # level of the wire logger, can be raised at runtime to silence it ("WARNING")
+    "level": "INFO",
+    # None logs to the console
+    "file": None,
+    # "text" for readable lines, "binary" for compact length prefixed records (see readwirelog)
+    "format": "text",
+    # rotate files at this size in bytes, keeping this many old files
+    "maxbytes": 10 * 2 ** 20,
+    "backups": 5,
+    # log one in every this many lines
+    "sample": 1,
+    # maximum lines per second, None for no limit
+    "ratelimit": None,
+}
+
+RECEIVED = "<-"
+SENT = "->"
+
+# binary records: timestamp, direction (b"<" or b">"), length of the UTF-8 encoded line, followed by the line
+RECORD = struct.Struct("<dcH")
+DIRECTIONS = {RECEIVED: b"<", SENT: b">"}
+
+
+class WireLog(object):
+    # lines sent and received, logged through their own logger ("wire.<name>" per connection)
+    # records are handed to a queue as they are, formatting and writing them is done by a listener thread,
+    # so the event loop never waits for disk or console I/O; lines that are sampled out or over the rate
+    # limit cost no more than a counter
+
+    def __init__(self, settings=None, name="bot", shared=False):
+        # with shared set, records are passed on to the "wire" logger, whose handler is set up by a WireLog
+        # without a name (see supervisor.py)
+        settings = dict(DEFAULTS, **(settings or {}))
+        self.enabled = settings["enabled"]
+        self.sample = max(int(settings["sample"]), 1)
+        self.ratelimit = settings["ratelimit"]
+
+        self.count = 0
+        self.allowance = self.ratelimit or 0
+        self.updated = time.monotonic()
+        self.dropped = 0
+
+        self.logger = logging.getLogger("wire.{}".format(name) if name else "wire")
+        self.logger.propagate = shared
+        self.logger.setLevel(settings["level"])
+        self.handler = None
+        self.listener = None
+
+        if self.enabled and not shared:
+            records = queue.SimpleQueue()
+            self.handler = LazyQueueHandler(records)
+            self.logger.addHandler(self.handler)
+            self.listener = logging.handlers.QueueListener(records, makehandler(settings))
+            self.listener.start()
+
+    def received(self, line):
+        if self.enabled:
+            self.log(RECEIVED, line)
+
+    def sent(self, line):
+        if self.enabled:
+            self.log(SENT, line)
+
+    def log(self, direction, line):
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+
+        self.count += 1
+        if self.sample > 1 and self.count % self.sample:
+            return
+
+        if self.ratelimit:
+            now = time.monotonic()
+            self.allowance = min(self.ratelimit, self.allowance + (now - self.updated) * self.ratelimit)
+            self.updated = now
+            if self.allowance < 1:
+                self.dropped += 1
+                return
+
+            self.allowance -= 1
+            if self.dropped:
+                self.logger.info("%s %s", "--", "{} line(s) not logged".format(self.dropped))
+                self.dropped = 0
+
+        # formatted by the listener
+        self.logger.info("%s %s", direction, line)
+
+    def close(self):
+        # writes out queued records
+        if self.listener:
+            self.logger.removeHandler(self.handler)
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+        self.enabled = False
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler formats records before queueing them; the arguments of wire records are plain strings, so
+    # they can be left for the listener to format
+    def prepare(self, record):
+        return record
+
+
+class BinaryRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    # writes records as RECORD followed by the line, which keeps any line intact regardless of its contents
+
+    def __init__(self, filename, maxBytes=0, backupCount=0):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount, delay=True)
+
+    def _open(self):
+        # RotatingFileHandler only opens files in text mode
+        return open(self.baseFilename, "ab")
+
+    def pack(self, record):
+        direction, line = record.args
+        encoded_line = line.encode("utf-8", "surrogateescape")[:0xffff]
+        return RECORD.pack(record.created, DIRECTIONS.get(direction, b"-"), len(encoded_line)) + encoded_line
+
+    def emit(self, record):
+        try:
+            data = self.pack(record)
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes > 0 and self.stream.tell() + len(data) >= self.maxBytes:
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+
+            self.stream.write(data)
+            self.flush()
+        except Exception:
+            self.handleError(record)
+
+
+# --- helpers ---
+
+def makehandler(settings):
+    if settings["file"] is None:
+        handler = logging.StreamHandler(sys.stderr)
+    elif settings["format"] == "binary":
+        return BinaryRotatingFileHandler(settings["file"], settings["maxbytes"], settings["backups"])
+    else:
+        handler = logging.handlers.RotatingFileHandler(settings["file"], maxBytes=settings["maxbytes"],
+                                                       backupCount=settings["backups"], encoding="utf-8",
+                                                       errors="surrogateescape", delay=True)
+
+    handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+    return handler
+
+
+def readwirelog(path):
+    # yields (timestamp, direction, line) for every record in a binary wire log
+    directions = {v: k for k, v in DIRECTIONS.items()}
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+
+            timestamp, direction, length = RECORD.unpack(header)
+            yield timestamp, directions.get(direction, "--"), f.read(length).decode("utf-8", "surrogateescape")